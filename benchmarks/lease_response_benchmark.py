@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the bytes and the parse time of a lease response.
+
+A canned FULL lease response is cut down with the fields mask the puller
+sends, the way the server applies it, and each of the full and the masked
+response is measured as is and gzip compressed: the bytes on the wire per
+lease, and the CPU time the client spends decompressing and parsing it.
+  python benchmarks/lease_response_benchmark.py --lease_tasks=100 \\
+      --payload_bytes=64
+"""
+
+
+
+import StringIO
+import base64
+import gzip
+import json
+import random
+import re
+import time
+
+from gtaskqueue.utils import LEASE_FIELDS
+from gtaskqueue.utils import build_cloudtasks_task_name
+from google.apputils import app
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+        'iterations',
+        500,
+        'Number of parses per response.')
+flags.DEFINE_integer(
+        'lease_tasks',
+        100,
+        'Number of tasks in the canned lease response.')
+flags.DEFINE_integer(
+        'payload_bytes',
+        64,
+        'Size of the payload of each canned task, random bytes.')
+flags.DEFINE_string(
+        'fields',
+        LEASE_FIELDS,
+        'Fields mask applied to the response.')
+
+SCHEDULE_TIME = '2018-01-01T00:00:30.123456Z'
+CREATE_TIME = '2018-01-01T00:00:00.654321Z'
+
+
+def parse_fields(mask):
+    """Parses a fields mask into a tree.
+
+    Returns:
+        Dict of the selected fields, whose values are the tree of their
+        selected subfields, or None when the whole field is selected.
+
+    Raises:
+        ValueError: if mask is malformed.
+    """
+    (tree, rest) = _parse_selection(mask)
+    if rest.strip():
+        raise ValueError('Unexpected %r in fields mask' % rest)
+    return tree
+
+
+def _parse_selection(text):
+    tree = {}
+    while True:
+        match = re.match(r'\s*([\w/]+)\s*', text)
+        if not match:
+            raise ValueError('Expected a field name at %r' % text)
+        names = match.group(1).split('/')
+        text = text[match.end():]
+        subtree = None
+        if text.startswith('('):
+            (subtree, text) = _parse_selection(text[1:])
+            if not text.startswith(')'):
+                raise ValueError('Expected ) at %r' % text)
+            text = text[1:].lstrip()
+        node = tree
+        for name in names[:-1]:
+            node = node.setdefault(name, {})
+        node[names[-1]] = subtree
+        if not text.startswith(','):
+            return (tree, text)
+        text = text[1:]
+
+
+def apply_fields(value, tree):
+    """Returns the part of a response value selected by a parsed mask."""
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [apply_fields(item, tree) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return dict((name, apply_fields(value[name], subtree))
+                for (name, subtree) in tree.iteritems() if name in value)
+
+
+def _canned_lease_response():
+    rng = random.Random(0)
+    tasks = []
+    for i in range(FLAGS.lease_tasks):
+        payload = ''.join(chr(rng.randrange(256))
+                          for _ in xrange(FLAGS.payload_bytes))
+        tasks.append({
+            'name': build_cloudtasks_task_name('benchmark', 'us-central1',
+                                               'queue', task_id='%019d'
+                                               % rng.randrange(10 ** 19)),
+            'createTime': CREATE_TIME,
+            'scheduleTime': SCHEDULE_TIME,
+            'view': 'FULL',
+            'status': {'attemptDispatchCount': 1,
+                       'attemptResponseCount': 0},
+            'pullMessage': {'payload': base64.b64encode(payload),
+                            'tag': 'benchmark'},
+        })
+    return {'tasks': tasks}
+
+
+def _gzip(content):
+    s = StringIO.StringIO()
+    f = gzip.GzipFile(fileobj=s, mode='wb')
+    f.write(content)
+    f.close()
+    return s.getvalue()
+
+
+def _gunzip(content):
+    # As httplib2 decompresses a response.
+    return gzip.GzipFile(fileobj=StringIO.StringIO(content)).read()
+
+
+def _time_parse(wire, compressed):
+    start_cpu = time.clock()
+    for _ in xrange(FLAGS.iterations):
+        content = wire
+        if compressed:
+            content = _gunzip(content)
+        json.loads(content)
+    return (time.clock() - start_cpu) / FLAGS.iterations
+
+
+def main(unused_argv):
+    full = _canned_lease_response()
+    masked = apply_fields(full, parse_fields(FLAGS.fields))
+    print 'fields=%s' % FLAGS.fields
+    print '%d tasks per lease, %d payload bytes per task' % (
+        FLAGS.lease_tasks, FLAGS.payload_bytes)
+    print '%-8s %-9s %12s %11s %13s' % (
+        'response', 'encoding', 'bytes/lease', 'bytes/task', 'parse/lease')
+    results = {}
+    for (label, response) in (('full', full), ('masked', masked)):
+        content = json.dumps(response)
+        for (encoding, wire) in (('identity', content),
+                                 ('gzip', _gzip(content))):
+            parse_secs = _time_parse(wire, encoding == 'gzip')
+            results[label, encoding] = (len(wire), parse_secs)
+            print '%-8s %-9s %12d %11.1f %11.1fus' % (
+                label, encoding, len(wire),
+                float(len(wire)) / max(1, FLAGS.lease_tasks),
+                parse_secs * 1e6)
+    (before_bytes, before_secs) = results['full', 'identity']
+    (after_bytes, after_secs) = results['masked', 'gzip']
+    print ('before (full, identity) -> after (masked, gzip): %d -> %d bytes '
+           '(%.0f%% fewer), %.1fus -> %.1fus parse' % (
+               before_bytes, after_bytes,
+               100.0 * (before_bytes - after_bytes) / before_bytes,
+               before_secs * 1e6, after_secs * 1e6))
+
+if __name__ == '__main__':
+    app.run()
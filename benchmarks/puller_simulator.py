@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Discrete-event simulator of the scheduling decisions of the puller.
+
+The real TaskQueuePuller is run against a virtual clock, a simulated queue
+standing in for the Task API and simulated tasks standing in for the
+executable. Its sleeps and the API latencies advance the clock instead of
+taking time, so hours of operation are replayed in seconds, and the
+effect of its flags on a workload can be compared before they are deployed.
+
+The workload is either synthetic (Poisson arrivals, task durations drawn
+from a distribution, exponential API latencies) or recorded, from a file of
+JSON lines:
+    {"arrival_secs": 0.0, "duration_secs": 1.5}
+    {"api_latency_secs": 0.04}
+Task lines give the time a task is enqueued and how long it runs; latency
+lines, if any, are sampled for each API call instead of the exponential.
+
+The puller flags are the base setting, and each --sweep=<flag>=<v1>,<v2>
+tries every value; with several sweeps every combination is run. For each
+setting the simulator prints:
+  tasks/s    completed tasks per second of simulated time, until the last
+             ack;
+  lag        mean and 95th percentile of the time from enqueue to first
+             lease;
+  calls      lease, ack and cancelLease API calls, and failed acks (the
+             lease expired before the ack, so the task runs again);
+  idle       fraction of the num_tasks slot time of the run not spent
+             running a task;
+  held       mean time a finished task holds its slot until the puller
+             notices it.
+
+Only the poll engine is simulated. Tasks succeed unless they run past
+--task_timeout_secs, in which case their lease is cancelled; local retries,
+output posts and the optional limits (tags, admission, autoscaling) are not
+modelled.
+
+Example usage:
+  python benchmarks/puller_simulator.py --arrival_rate_per_sec=20 \\
+      --task_secs_mean=2 --sweep=num_tasks=10,40,80 \\
+      --sweep=min_running_tasks=0,5
+"""
+
+
+
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import tempfile
+
+from gtaskqueue.taskqueue_logger import logger
+from gtaskqueue.taskqueue_puller import TaskQueuePuller
+from google.apputils import app
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+        'workload_file',
+        None,
+        'Recorded workload, as JSON lines. Overrides the synthetic workload.')
+flags.DEFINE_integer(
+        'sim_tasks',
+        2000,
+        'Number of tasks of the synthetic workload.')
+flags.DEFINE_float(
+        'arrival_rate_per_sec',
+        10,
+        'Mean rate at which the synthetic tasks are enqueued.')
+flags.DEFINE_float(
+        'task_secs_mean',
+        1.0,
+        'Mean run time of the synthetic tasks.')
+flags.DEFINE_enum(
+        'task_secs_dist',
+        'exponential',
+        ['exponential', 'lognormal', 'constant'],
+        'Distribution of the run time of the synthetic tasks.')
+flags.DEFINE_float(
+        'task_secs_sigma',
+        1.0,
+        'Sigma of the lognormal run time distribution.')
+flags.DEFINE_float(
+        'api_latency_secs_mean',
+        0.05,
+        'Mean latency of an API call, when no latency is recorded.')
+flags.DEFINE_float(
+        'loop_overhead_secs',
+        0.001,
+        'Time taken by one round of the main loop of the puller.')
+flags.DEFINE_float(
+        'sim_max_secs',
+        24 * 3600,
+        'Simulated time after which a run is stopped, eg. when tasks outlive '
+        'their lease and never complete.')
+flags.DEFINE_multistring(
+        'sweep',
+        [],
+        'Flag and the values to try for it, eg. "num_tasks=10,20,40".')
+flags.DEFINE_integer(
+        'seed',
+        1,
+        'Seed of the random workload and latencies.')
+
+_TASK_NAME_PREFIX = 'projects/sim/locations/sim/queues/sim/tasks/'
+
+
+class VirtualClock(object):
+    """Clock whose time only moves when something sleeps or waits."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += max(0, secs)
+
+
+class _QueuedTask(object):
+    """Server side state of a task of the simulated queue."""
+
+    __slots__ = ('task_id', 'arrival_secs', 'duration_secs', 'available_at',
+                 'schedule_time', 'first_lease_time', 'done')
+
+    def __init__(self, task_id, arrival_secs, duration_secs):
+        self.task_id = task_id
+        self.arrival_secs = arrival_secs
+        self.duration_secs = duration_secs
+        self.available_at = arrival_secs
+        self.schedule_time = None
+        self.first_lease_time = None
+        self.done = False
+
+
+class _Request(object):
+    """Request of the simulated API, run when executed."""
+
+    def __init__(self, api, fn):
+        self._api = api
+        self._fn = fn
+
+    def execute(self):
+        # The call takes effect when it reaches the queue and the caller
+        # gets the response one latency later.
+        result = self._fn()
+        self._api.clock.sleep(self._api.sample_latency())
+        return result
+
+
+class SimulatedTaskApi(object):
+    """Task API handle backed by an in-memory queue on the virtual clock.
+
+    Leases hand out the available tasks with the earliest schedule time,
+    like the real queue. A task whose lease expires before it is acked
+    becomes available again, and its late ack fails.
+    """
+
+    def __init__(self, clock, tasks, latencies, rng):
+        self.clock = clock
+        self._latencies = latencies
+        self._rng = rng
+        self.queued_tasks = dict((task.task_id, task) for task in tasks)
+        # (available at, arrival, task id) of tasks which may be leased;
+        # entries whose task moved on are skipped.
+        self._available = [(task.available_at, task.arrival_secs,
+                            task.task_id) for task in tasks]
+        self._available.sort()
+        self.num_calls = dict.fromkeys(
+            ['lease', 'acknowledge', 'cancelLease', 'failed_acks'], 0)
+
+    def sample_latency(self):
+        if self._latencies:
+            return self._rng.choice(self._latencies)
+        if FLAGS.api_latency_secs_mean <= 0:
+            return 0
+        return self._rng.expovariate(1.0 / FLAGS.api_latency_secs_mean)
+
+    def projects(self):
+        return self
+
+    def locations(self):
+        return self
+
+    def queues(self):
+        return self
+
+    def tasks(self):
+        return self
+
+    def lease(self, parent, body, **unused_query):
+        return _Request(self, lambda: self._lease(body))
+
+    def acknowledge(self, name, body, **unused_query):
+        return _Request(self, lambda: self._acknowledge(name, body))
+
+    def cancelLease(self, name, body, **unused_query):
+        return _Request(self, lambda: self._cancel_lease(name, body))
+
+    def _push(self, task):
+        heapq.heappush(self._available,
+                       (task.available_at, task.arrival_secs, task.task_id))
+
+    def _lease(self, body):
+        self.num_calls['lease'] += 1
+        now = self.clock.time()
+        lease_secs = float(body['leaseDuration'].rstrip('s'))
+        leased = []
+        while (len(leased) < body['maxTasks'] and self._available and
+               self._available[0][0] <= now):
+            (available_at, _, task_id) = heapq.heappop(self._available)
+            task = self.queued_tasks[task_id]
+            if task.done or task.available_at != available_at:
+                continue
+            if task.first_lease_time is None:
+                task.first_lease_time = now
+            task.available_at = now + lease_secs
+            task.schedule_time = '%.6f' % task.available_at
+            self._push(task)
+            leased.append({
+                'name': _TASK_NAME_PREFIX + task_id,
+                'scheduleTime': task.schedule_time,
+                'pullMessage': {'payload': ''},
+            })
+        return {'tasks': leased}
+
+    def _acknowledge(self, name, body):
+        self.num_calls['acknowledge'] += 1
+        task = self.queued_tasks[name.rsplit('/', 1)[1]]
+        if (task.done or task.schedule_time != body['scheduleTime'] or
+                self.clock.time() > task.available_at):
+            self.num_calls['failed_acks'] += 1
+            return {'acknowledged': False}
+        task.done = True
+        return {'acknowledged': True}
+
+    def _cancel_lease(self, name, body):
+        self.num_calls['cancelLease'] += 1
+        task = self.queued_tasks[name.rsplit('/', 1)[1]]
+        if not task.done and task.schedule_time == body['scheduleTime']:
+            task.available_at = self.clock.time()
+            self._push(task)
+        return {}
+
+
+class SimulatedTask(object):
+    """Stands in for ClientTask: runs for the duration of the workload task.
+
+    The run ends or times out at its wakeup time, which the task table of
+    the puller hands back to it on the first poll after that time.
+    """
+
+    def __init__(self, simulation, task, **unused_kwargs):
+        self._simulation = simulation
+        self.task_name = task['name']
+        self.task_id = self.task_name.rsplit('/', 1)[1]
+        self._schedule_time = task['scheduleTime']
+        self._start_time = None
+        self._end_time = None
+        self._deadline = None
+
+    def init(self):
+        clock = self._simulation.clock
+        self._start_time = clock.time()
+        duration = self._simulation.api.queued_tasks[self.task_id].duration_secs
+        self._end_time = self._start_time + duration
+        self._deadline = self._start_time + FLAGS.task_timeout_secs
+        return True
+
+    def get_task_id(self):
+        return self.task_id
+
+    def get_pid(self):
+        return None
+
+    def get_exit_status(self):
+        return None
+
+    def get_cpus(self):
+        return None
+
+    def get_temp_files(self):
+        return []
+
+    def get_max_rss_bytes(self):
+        return None
+
+    def get_wakeup_time(self):
+        return min(self._end_time, self._deadline)
+
+    def is_completed(self, task_api):
+        now = self._simulation.clock.time()
+        tasks = task_api.projects().locations().queues().tasks()
+        body = {'scheduleTime': self._schedule_time}
+        if self._end_time <= self._deadline:
+            if now < self._end_time:
+                return False
+            self._simulation.record_run(self._end_time - self._start_time,
+                                        now - self._end_time)
+            result = tasks.acknowledge(name=self.task_name, body=body).execute()
+            if result['acknowledged']:
+                self._simulation.record_ack()
+            return True
+        if now < self._deadline:
+            return False
+        self._simulation.record_run(self._deadline - self._start_time, 0)
+        self._simulation.num_timeouts += 1
+        tasks.cancelLease(name=self.task_name, body=body).execute()
+        return True
+
+    def abandon(self, task_api):
+        tasks = task_api.projects().locations().queues().tasks()
+        tasks.cancelLease(name=self.task_name,
+                          body={'scheduleTime': self._schedule_time}).execute()
+
+
+class Simulation(object):
+    """One run of the puller over a workload with the current flags."""
+
+    def __init__(self, workload, latencies, seed):
+        """Constructor.
+
+        Args:
+            workload: list of (arrival secs, duration secs) of the tasks.
+            latencies: recorded API latencies to sample, may be empty.
+            seed: seed of the latencies.
+        """
+        self.clock = VirtualClock()
+        tasks = [_QueuedTask('%d' % i, arrival, duration)
+                 for (i, (arrival, duration)) in enumerate(workload)]
+        self.api = SimulatedTaskApi(self.clock, tasks, latencies,
+                                    random.Random(seed))
+        self._num_tasks = len(tasks)
+        self._num_acked = 0
+        self._last_ack_time = 0
+        self._num_runs = 0
+        self._busy_secs = 0
+        self._held_secs = 0
+        self.num_timeouts = 0
+
+    def record_run(self, run_secs, held_secs):
+        self._num_runs += 1
+        self._busy_secs += run_secs
+        self._held_secs += held_secs
+
+    def record_ack(self):
+        self._num_acked += 1
+        self._last_ack_time = self.clock.time()
+
+    def _make_task(self, task, **kwargs):
+        return SimulatedTask(self, task, **kwargs)
+
+    def run(self):
+        """Runs the main loop of the puller until every task is acked.
+
+        Returns:
+            Dict of the metrics of the run.
+        """
+        puller = TaskQueuePuller(task_api=self.api, clock=self.clock,
+                                 task_factory=self._make_task)
+        while (self._num_acked < self._num_tasks and
+               self.clock.time() < FLAGS.sim_max_secs):
+            puller.lease_tasks()
+            puller.poll_tasks()
+            self.clock.sleep(FLAGS.loop_overhead_secs)
+        puller.drain(0)
+        return self._get_metrics()
+
+    def _get_metrics(self):
+        lags = sorted(task.first_lease_time - task.arrival_secs
+                      for task in self.api.queued_tasks.itervalues()
+                      if task.first_lease_time is not None)
+        duration = self._last_ack_time or self.clock.time()
+        metrics = {
+            'completed': self._num_acked,
+            'stop_secs': self.clock.time(),
+            'tasks_per_sec': self._num_acked / duration if duration else 0,
+            'lag_mean': sum(lags) / len(lags) if lags else 0,
+            'lag_p95': lags[int(len(lags) * 0.95)] if lags else 0,
+            # Over the whole run: tasks may still run after the last ack.
+            'idle_fraction': max(0.0, 1 - self._busy_secs / (
+                    FLAGS.num_tasks * self.clock.time() or 1)),
+            'held_mean': (self._held_secs / self._num_runs
+                          if self._num_runs else 0),
+            'runs': self._num_runs,
+            'timeouts': self.num_timeouts,
+        }
+        metrics.update(self.api.num_calls)
+        return metrics
+
+
+def _make_workload(rng):
+    """Returns the synthetic workload as (arrival, duration) tuples."""
+    workload = []
+    arrival = 0.0
+    for _ in xrange(FLAGS.sim_tasks):
+        arrival += rng.expovariate(FLAGS.arrival_rate_per_sec)
+        if FLAGS.task_secs_dist == 'constant':
+            duration = FLAGS.task_secs_mean
+        elif FLAGS.task_secs_dist == 'lognormal':
+            # Mu such that the mean is task_secs_mean.
+            sigma = FLAGS.task_secs_sigma
+            duration = rng.lognormvariate(
+                math.log(FLAGS.task_secs_mean) - sigma * sigma / 2, sigma)
+        else:
+            duration = rng.expovariate(1.0 / FLAGS.task_secs_mean)
+        workload.append((arrival, duration))
+    return workload
+
+
+def _load_workload(path):
+    """Reads a recorded workload.
+
+    Returns:
+        (list of (arrival, duration) tuples, list of API latencies).
+    """
+    workload = []
+    latencies = []
+    f = open(path)
+    try:
+        for (line_number, line) in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if 'api_latency_secs' in record:
+                    latencies.append(float(record['api_latency_secs']))
+                else:
+                    workload.append((float(record['arrival_secs']),
+                                     float(record['duration_secs'])))
+            except (ValueError, KeyError, TypeError), error:
+                raise app.UsageError('%s line %d: %s'
+                                     % (path, line_number, error))
+    finally:
+        f.close()
+    workload.sort()
+    return (workload, latencies)
+
+
+def _parse_sweeps(sweeps):
+    """Returns the (flag name, list of values) of each --sweep."""
+    parsed = []
+    for sweep in sweeps:
+        (name, sep, values) = sweep.partition('=')
+        if not sep or name not in FLAGS:
+            raise app.UsageError('Bad --sweep %r, expected <flag>=<v1>,<v2>'
+                                 % sweep)
+        try:
+            parsed.append((name, [FLAGS[name].parser.Parse(value)
+                                  for value in values.split(',')]))
+        except ValueError, error:
+            raise app.UsageError('Bad value in --sweep %r: %s'
+                                 % (sweep, error))
+    return parsed
+
+
+def main(unused_argv):
+    if FLAGS.workload_file:
+        (workload, latencies) = _load_workload(FLAGS.workload_file)
+    else:
+        workload = _make_workload(random.Random(FLAGS.seed))
+        latencies = []
+    if not workload:
+        raise app.UsageError('The workload has no tasks')
+    sweeps = _parse_sweeps(FLAGS.sweep)
+    logger.setLevel(logging.WARNING)
+    # Keep the simulated acks away from the puller's real retry file.
+    work_dir = tempfile.mkdtemp(prefix='puller-simulator-')
+    FLAGS.ack_retry_file = os.path.join(work_dir, 'acks.json')
+    FLAGS.journal_file = None
+    names = [name for (name, _) in sweeps]
+    print '%d tasks over %.0fs, %s' % (
+        len(workload), workload[-1][0], ' '.join(
+            '%s=%s' % (name, getattr(FLAGS, name)) for name in (
+                'num_tasks', 'min_running_tasks', 'lease_secs',
+                'sleep_interval_secs', 'sleep_before_next_poll_secs',
+                'timeout_secs_for_next_lease_request')
+            if name not in names))
+    widths = [max(len(name), 8) + 2 for name in names]
+    header = ''.join('%-*s' % (width, name)
+                     for (width, name) in zip(widths, names))
+    print (header + '%9s %8s %8s %7s %7s %7s %7s %6s %6s' % (
+        'tasks/s', 'lag', 'lag_p95', 'leases', 'acks', 'failed', 'cancels',
+        'idle', 'held'))
+    base_values = dict((name, getattr(FLAGS, name)) for name in names)
+    try:
+        for values in itertools.product(*[values for (_, values) in sweeps]):
+            for (name, value) in zip(names, values):
+                setattr(FLAGS, name, value)
+            metrics = Simulation(workload, latencies, FLAGS.seed).run()
+            row = ''.join('%-*s' % (width, value)
+                          for (width, value) in zip(widths, values))
+            print (row + '%9.2f %7.1fs %7.1fs %7d %7d %7d %7d %5.0f%% %5.1fs'
+                   % (metrics['tasks_per_sec'], metrics['lag_mean'],
+                      metrics['lag_p95'], metrics['lease'],
+                      metrics['acknowledge'], metrics['failed_acks'],
+                      metrics['cancelLease'],
+                      100 * metrics['idle_fraction'], metrics['held_mean']))
+            if metrics['completed'] < len(workload):
+                print '  stopped after %.0fs with %d of %d tasks completed' % (
+                    metrics['stop_secs'], metrics['completed'], len(workload))
+    finally:
+        for (name, value) in base_values.items():
+            setattr(FLAGS, name, value)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    app.run()
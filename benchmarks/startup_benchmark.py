@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Startup benchmark for the gtaskqueue and gtaskqueue_puller tools.
+
+For each scenario the benchmark starts a fresh interpreter and measures:
+1. The import cost of the entry point, broken down per module in the spirit
+   of "python -X importtime" (which Python 2 does not have), by running the
+   tool under a small bootstrap that times every first-time import.
+2. The wall time until the tool issues its first HTTP request, by pointing
+   --api_host at a local server and timing the arrival of the discovery
+   request.
+
+It fails (exits non-zero) if any scenario goes over its budget or if one of
+the heavy modules that should only load on demand is imported by a --help
+invocation.
+
+Example usage:
+  python benchmarks/startup_benchmark.py --runs=5 --help_budget_secs=0.25
+"""
+
+
+
+import BaseHTTPServer
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from google.apputils import app
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+        'python',
+        sys.executable,
+        'Interpreter used to run the tools.')
+flags.DEFINE_integer(
+        'runs',
+        5,
+        'Number of runs per scenario; the median is reported.')
+flags.DEFINE_float(
+        'help_budget_secs',
+        0.3,
+        'Maximum median wall time for a --help invocation.')
+flags.DEFINE_float(
+        'first_request_budget_secs',
+        1.0,
+        'Maximum median wall time from process start to the first request.')
+flags.DEFINE_list(
+        'lazy_modules',
+        ['googleapiclient.discovery', 'oauth2client.client', 'httplib2',
+         'oauth2', 'requests'],
+        'Modules which must not be imported by a --help invocation.')
+flags.DEFINE_integer(
+        'top_imports',
+        10,
+        'Number of most expensive imports to show per scenario.')
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT_DIR = os.path.join(REPO_DIR, 'gtaskqueue')
+
+# Runs a tool with every first-time import timed, and writes the per-module
+# timings to the file named by the GTQ_IMPORT_REPORT environment variable.
+_BOOTSTRAP = r'''
+import __builtin__
+import json
+import os
+import sys
+import time
+
+_orig_import = __builtin__.__import__
+_stack = []
+_records = []
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    if name in sys.modules:
+        return _orig_import(name, globals, locals, fromlist, level)
+    num_modules = len(sys.modules)
+    start = time.time()
+    _stack.append(0.0)
+    try:
+        return _orig_import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        children = _stack.pop()
+        if _stack:
+            _stack[-1] += elapsed
+        if len(sys.modules) > num_modules:
+            _records.append((name, elapsed - children, elapsed))
+
+
+def _write_report():
+    report = {'imports': _records, 'modules': sorted(sys.modules.keys())}
+    f = open(os.environ['GTQ_IMPORT_REPORT'], 'w')
+    json.dump(report, f)
+    f.close()
+
+__builtin__.__import__ = _timed_import
+script = sys.argv[1]
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(script))
+try:
+    execfile(script, {'__name__': '__main__', '__file__': script})
+except SystemExit:
+    pass
+finally:
+    __builtin__.__import__ = _orig_import
+    _write_report()
+'''
+
+# Credentials which never need a refresh, so the tools go straight to the
+# API host without running the OAuth flow.
+_CREDENTIALS = {
+    '_module': 'oauth2client.client',
+    '_class': 'OAuth2Credentials',
+    'access_token': 'startup-benchmark',
+    'client_id': 'startup-benchmark',
+    'client_secret': 'startup-benchmark',
+    'refresh_token': 'startup-benchmark',
+    'token_expiry': '2099-01-01T00:00:00Z',
+    'token_uri': 'https://accounts.google.com/o/oauth2/token',
+    'user_agent': 'startup-benchmark',
+    'invalid': False,
+}
+
+
+class _FirstRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Records the arrival time of a request and answers with a 404."""
+
+    def do_GET(self):
+        self.server.request_times.append(time.time())
+        self.send_response(404)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write('{}')
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+def _child_env():
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [REPO_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+
+def measure_imports(tool, args):
+    """Runs tool under the import timing bootstrap.
+
+    Args:
+        tool: name of the script in the gtaskqueue directory.
+        args: command line arguments for the tool.
+
+    Returns:
+        Tuple of (wall time in seconds, import report dictionary).
+    """
+    (fd, report_file) = tempfile.mkstemp()
+    os.close(fd)
+    env = _child_env()
+    env['GTQ_IMPORT_REPORT'] = report_file
+    devnull = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        subprocess.call([FLAGS.python, '-c', _BOOTSTRAP,
+                         os.path.join(SCRIPT_DIR, tool)] + args,
+                        env=env, stdout=devnull, stderr=devnull)
+        wall_secs = time.time() - start
+        f = open(report_file)
+        report = json.load(f)
+        f.close()
+    finally:
+        devnull.close()
+        os.remove(report_file)
+    return wall_secs, report
+
+
+def measure_first_request(tool, args):
+    """Runs tool against a local server and times its first request.
+
+    Args:
+        tool: name of the script in the gtaskqueue directory.
+        args: command line arguments for the tool.
+
+    Returns:
+        Seconds from process start to the first request, or None if the
+        tool never sent one.
+    """
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                       _FirstRequestHandler)
+    server.request_times = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    (fd, credentials_file) = tempfile.mkstemp()
+    os.write(fd, json.dumps(_CREDENTIALS))
+    os.close(fd)
+    (fd, log_file) = tempfile.mkstemp()
+    os.close(fd)
+    devnull = open(os.devnull, 'w')
+    try:
+        cmdline = [FLAGS.python, os.path.join(SCRIPT_DIR, tool)] + args + [
+            '--api_host=http://127.0.0.1:%d/' % server.server_address[1],
+            '--credentials_file=%s' % credentials_file]
+        if tool == 'gtaskqueue_puller':
+            cmdline.append('--log_output_file=%s' % log_file)
+        start = time.time()
+        process = subprocess.Popen(cmdline, env=_child_env(),
+                                   stdout=devnull, stderr=devnull)
+        while not server.request_times and process.poll() is None:
+            time.sleep(0.005)
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        if not server.request_times:
+            return None
+        return server.request_times[0] - start
+    finally:
+        server.shutdown()
+        devnull.close()
+        os.remove(credentials_file)
+        os.remove(log_file)
+
+
+def run_help_scenario(tool, args):
+    """Measures a --help style invocation and checks the budgets.
+
+    Returns:
+        True if the scenario is within budget.
+    """
+    walls = []
+    report = None
+    for _ in range(FLAGS.runs):
+        wall_secs, report = measure_imports(tool, args)
+        walls.append(wall_secs)
+    wall_secs = _median(walls)
+    import_secs = sum(r[1] for r in report['imports'])
+    print '%s %s' % (tool, ' '.join(args))
+    print '  wall time (median):   %.3fs (budget %.3fs)' % (
+        wall_secs, FLAGS.help_budget_secs)
+    print '  import time:          %.3fs in %d modules' % (
+        import_secs, len(report['modules']))
+    print '  most expensive imports (self / cumulative):'
+    for name, self_secs, cumulative_secs in sorted(
+            report['imports'], key=lambda r: -r[2])[:FLAGS.top_imports]:
+        print '    %8.1fms %8.1fms  %s' % (self_secs * 1000,
+                                          cumulative_secs * 1000, name)
+    ok = wall_secs <= FLAGS.help_budget_secs
+    loaded = set(report['modules'])
+    eager = [m for m in FLAGS.lazy_modules if m in loaded]
+    if eager:
+        print '  FAIL: imported on startup: %s' % ', '.join(eager)
+        ok = False
+    if wall_secs > FLAGS.help_budget_secs:
+        print '  FAIL: over budget'
+    return ok
+
+
+def run_first_request_scenario(tool, args):
+    """Measures the time to first request and checks the budget.
+
+    Returns:
+        True if the scenario is within budget.
+    """
+    times = []
+    for _ in range(FLAGS.runs):
+        first_request_secs = measure_first_request(tool, args)
+        if first_request_secs is None:
+            print '%s %s' % (tool, ' '.join(args))
+            print '  FAIL: no request was sent'
+            return False
+        times.append(first_request_secs)
+    first_request_secs = _median(times)
+    print '%s %s' % (tool, ' '.join(args))
+    print '  time to first request (median): %.3fs (budget %.3fs)' % (
+        first_request_secs, FLAGS.first_request_budget_secs)
+    if first_request_secs > FLAGS.first_request_budget_secs:
+        print '  FAIL: over budget'
+        return False
+    return True
+
+
+def main(unused_argv):
+    ok = True
+    ok &= run_help_scenario('gtaskqueue', ['--help'])
+    ok &= run_help_scenario('gtaskqueue', ['help', 'gettask'])
+    ok &= run_help_scenario('gtaskqueue_puller', ['--help'])
+    ok &= run_first_request_scenario(
+        'gtaskqueue', ['gettask', '--task_name=startup-benchmark'])
+    ok &= run_first_request_scenario('gtaskqueue_puller', [])
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    app.run()
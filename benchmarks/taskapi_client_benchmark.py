@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the per request CPU cost of the discovery and static clients.
+
+Both clients are driven against an in-process fake transport which returns
+canned responses, so the numbers only contain the client side work: building
+the method, validating parameters, serializing the body and parsing the
+response. The benchmark also checks that both clients send the same method,
+path and body for every call.
+
+The discovery document is read from a file, so no network access is needed:
+  python benchmarks/taskapi_client_benchmark.py \\
+      --discovery_doc=cloudtasks.v2beta2.json --iterations=2000
+"""
+
+
+
+import base64
+import json
+import sys
+import time
+import urlparse
+
+from gtaskqueue.taskqueue_rest_client import StaticTaskApi
+from gtaskqueue.utils import build_cloudtasks_queue_name
+from gtaskqueue.utils import build_cloudtasks_task_name
+from google.apputils import app
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+        'discovery_doc',
+        None,
+        'File containing the cloudtasks discovery document.')
+flags.DEFINE_string(
+        'api_host',
+        'https://cloudtasks.googleapis.com/',
+        'API host name')
+flags.DEFINE_string(
+        'service_version',
+        'v2beta2',
+        'Google taskqueue api version.')
+flags.DEFINE_integer(
+        'iterations',
+        2000,
+        'Number of calls per method and client.')
+flags.DEFINE_integer(
+        'lease_tasks',
+        10,
+        'Number of tasks in the canned lease and list responses.')
+flags.DEFINE_integer(
+        'payload_bytes',
+        256,
+        'Size of the payload of each canned task.')
+
+PARENT = build_cloudtasks_queue_name('benchmark', 'us-central1', 'queue')
+NAME = build_cloudtasks_task_name('benchmark', 'us-central1', 'queue',
+                                  task_id='task0')
+SCHEDULE_TIME = '2018-01-01T00:00:00.000000Z'
+
+
+class FakeHttp(object):
+    """httplib2.Http look-alike answering every request from memory."""
+
+    def __init__(self, content):
+        import httplib2
+        self._resp = httplib2.Response({'status': 200})
+        self._content = content
+        self.last_request = None
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=5, connection_type=None):
+        path = urlparse.urlparse(uri).path
+        self.last_request = (method, path, body and json.loads(body))
+        return self._resp, self._content
+
+
+def _canned_tasks():
+    payload = base64.urlsafe_b64encode('x' * FLAGS.payload_bytes)
+    tasks = []
+    for i in range(FLAGS.lease_tasks):
+        tasks.append({
+            'name': build_cloudtasks_task_name('benchmark', 'us-central1',
+                                               'queue', task_id='task%d' % i),
+            'createTime': SCHEDULE_TIME,
+            'scheduleTime': SCHEDULE_TIME,
+            'pullMessage': {'payload': payload, 'tag': 'benchmark'},
+            'status': {'attemptDispatchCount': 1},
+            'view': 'FULL',
+        })
+    return json.dumps({'tasks': tasks})
+
+
+def _calls():
+    """Returns (method name, request factory, canned response) tuples."""
+    tasks = _canned_tasks()
+    return [
+        ('lease', lambda t: t.lease(parent=PARENT, body={
+            'maxTasks': FLAGS.lease_tasks,
+            'leaseDuration': '30s',
+            'responseView': 'FULL'}), tasks),
+        ('acknowledge', lambda t: t.acknowledge(name=NAME, body={
+            'scheduleTime': SCHEDULE_TIME}), '{}'),
+        ('renewLease', lambda t: t.renewLease(name=NAME, body={
+            'scheduleTime': SCHEDULE_TIME,
+            'leaseDuration': '30s'}), '{}'),
+        ('cancelLease', lambda t: t.cancelLease(name=NAME, body={
+            'scheduleTime': SCHEDULE_TIME}), '{}'),
+        ('get', lambda t: t.get(name=NAME, responseView='FULL'),
+         json.dumps(json.loads(tasks)['tasks'][0])),
+        ('list', lambda t: t.list(parent=PARENT, responseView='BASIC',
+                                  pageSize=100), tasks),
+        ('delete', lambda t: t.delete(name=NAME), '{}'),
+    ]
+
+
+def _time_calls(make_api, make_request, content):
+    http = FakeHttp(content)
+    tasks = make_api(http).projects().locations().queues().tasks()
+    start_cpu = time.clock()
+    for _ in xrange(FLAGS.iterations):
+        make_request(tasks).execute()
+    cpu_secs = time.clock() - start_cpu
+    return cpu_secs / FLAGS.iterations, http.last_request
+
+
+def main(unused_argv):
+    if not FLAGS.discovery_doc:
+        raise app.UsageError('--discovery_doc is required')
+    from apiclient.discovery import build_from_document
+    f = open(FLAGS.discovery_doc)
+    document = f.read()
+    f.close()
+
+    def discovery_api(http):
+        return build_from_document(document, http=http)
+
+    def static_api(http):
+        return StaticTaskApi(http, FLAGS.api_host, FLAGS.service_version)
+
+    ok = True
+    print '%-12s %14s %14s %8s' % ('method', 'discovery', 'static', 'speedup')
+    for name, make_request, content in _calls():
+        discovery_secs, discovery_req = _time_calls(discovery_api,
+                                                    make_request, content)
+        static_secs, static_req = _time_calls(static_api, make_request,
+                                              content)
+        print '%-12s %12.1fus %12.1fus %7.1fx' % (
+            name, discovery_secs * 1e6, static_secs * 1e6,
+            discovery_secs / static_secs)
+        if discovery_req != static_req:
+            print '  MISMATCH: discovery sent %r, static sent %r' % (
+                discovery_req, static_req)
+            ok = False
+    if not ok:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    app.run()
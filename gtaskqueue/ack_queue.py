@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Background retry of failed acks, so completed tasks are not run again.
+
+When the acknowledge call of a completed task fails, the task comes back
+once its lease expires and would be executed again in full. AckRetryQueue
+keeps such acks, keyed by task name and schedule time, and retries them with
+exponential backoff on a background thread. By default they are only kept in
+memory and are lost if the puller restarts; durability is opt-in: with
+--ack_retry_file, they are also kept in a file of the puller's own, so that
+they survive a restart. It also remembers the ids of recently completed
+tasks; the puller re-acks such a task, with the schedule time of its new
+lease, instead of running it when it is delivered again.
+"""
+
+
+
+import collections
+import json
+import os
+import random
+import threading
+import time
+from gtaskqueue.http_pool import get_transport_errors
+from gtaskqueue.taskqueue_logger import logger
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+        'ack_retry_file',
+        None,
+        'File keeping the acks which are still to be retried, so that they '
+        'survive a restart of the puller. Each puller needs a file of its '
+        'own. If not set, acks are only retried in memory and those still '
+        'pending are lost on a restart.')
+flags.DEFINE_float(
+        'ack_retry_backoff_secs',
+        1,
+        'Wait before the first retry of a failed ack; doubled for every '
+        'further retry.')
+flags.DEFINE_float(
+        'ack_retry_max_backoff_secs',
+        60,
+        'Upper limit of the wait between retries of a failed ack.')
+flags.DEFINE_integer(
+        'completed_task_history_size',
+        10000,
+        'Number of recently completed task ids remembered, so that they are '
+        're-acked instead of run again if they are delivered again.')
+
+# Ack errors after which the ack is dropped: the task is gone, or it has been
+# leased again and the schedule time is stale. Anything else is retried.
+_PERMANENT_ERROR_CODES = (400, 404, 410)
+
+
+class _PendingAck(object):
+    """An ack to retry."""
+
+    def __init__(self, task_name, schedule_time):
+        self.task_name = task_name
+        self.schedule_time = schedule_time
+        self.num_attempts = 0
+        self.next_attempt_time = 0
+        # True while a thread is sending the ack.
+        self.in_flight = False
+
+
+class AckRetryQueue(object):
+    """Queue of acks retried with backoff on a background thread.
+
+    The queue is durable only when given a path to keep the acks in.
+    """
+
+    def __init__(self, task_api, path=None, journal=None):
+        """Constructor.
+
+        Loads the acks left over by a previous run of the puller; they are
+        retried as soon as start() is called.
+
+        Args:
+            task_api: handle for taskqueue api collection, used from the
+                background thread.
+            path: file keeping the pending acks, defaults to
+                --ack_retry_file; None keeps them in memory only.
+            journal: TaskJournal in which the tasks whose ack went through
+                or was given up on are recorded, if any.
+        """
+        self._task_api = task_api
+        self._path = path or FLAGS.ack_retry_file
+        self._journal = journal
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        # Pending acks by task name. A newer schedule time for the same task
+        # replaces the older one.
+        self._pending = {}
+        # Ids of recently completed tasks, least recent first.
+        self._completed = collections.OrderedDict()
+        self._num_records = 0
+        self._load()
+
+    def _load(self):
+        """Reads the pending acks from the file and compacts it."""
+        if not self._path:
+            return
+        try:
+            f = open(self._path)
+        except IOError:
+            return
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash.
+                    continue
+                if record.get('done'):
+                    self._pending.pop(record['name'], None)
+                else:
+                    self._pending[record['name']] = _PendingAck(
+                        record['name'], record['schedule_time'])
+        finally:
+            f.close()
+        for task_name in self._pending:
+            self.record_completed(task_name.rsplit('/', 1)[1])
+        if self._pending:
+            logger.info('Loaded %d acks to retry from %s'
+                        % (len(self._pending), self._path))
+        self._compact()
+
+    def _compact(self):
+        """Rewrites the file with only the pending acks."""
+        if not self._path:
+            return
+        tmp_path = self._path + '.tmp'
+        try:
+            f = open(tmp_path, 'w')
+            try:
+                for ack in self._pending.values():
+                    f.write(json.dumps({'name': ack.task_name,
+                                        'schedule_time': ack.schedule_time})
+                            + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(tmp_path, self._path)
+            self._num_records = len(self._pending)
+        except (IOError, OSError), error:
+            logger.error('Error writing ack retry file %s. Error details %s'
+                         % (self._path, str(error)))
+
+    def _append(self, record):
+        """Appends a record to the file; the caller holds the lock."""
+        if not self._path:
+            return
+        try:
+            f = open(self._path, 'a')
+            try:
+                f.write(json.dumps(record) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            self._num_records += 1
+        except (IOError, OSError), error:
+            logger.error('Error writing ack retry file %s. Error details %s'
+                         % (self._path, str(error)))
+        if self._num_records > 2 * len(self._pending) + 1000:
+            self._compact()
+
+    def record_completed(self, task_id):
+        """Remembers that task_id has run to completion."""
+        with self._cond:
+            self._completed.pop(task_id, None)
+            self._completed[task_id] = True
+            while len(self._completed) > FLAGS.completed_task_history_size:
+                self._completed.popitem(last=False)
+
+    def was_completed(self, task_id):
+        """Returns True if task_id has recently run to completion."""
+        with self._cond:
+            return task_id in self._completed
+
+    def add(self, task_name, schedule_time):
+        """Queues the ack of a task for retry.
+
+        Args:
+            task_name: full name of the task.
+            schedule_time: scheduleTime of the task from its lease.
+        """
+        with self._cond:
+            self._pending[task_name] = _PendingAck(task_name, schedule_time)
+            self._append({'name': task_name,
+                          'schedule_time': schedule_time})
+            self._cond.notify()
+
+    def num_pending(self):
+        """Returns the number of acks still to be retried."""
+        with self._cond:
+            return len(self._pending)
+
+    def start(self):
+        """Starts the background thread retrying the acks."""
+        self._thread = threading.Thread(target=self._run,
+                                        name='ack-retry')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread; pending acks stay in the file."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+
+    def flush(self, timeout):
+        """Retries all the pending acks now, for up to timeout seconds.
+
+        Returns:
+            True if no ack is left pending.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            for ack in self._pending.values():
+                ack.next_attempt_time = 0
+            self._cond.notify()
+        while time.time() < deadline:
+            with self._cond:
+                if not self._pending:
+                    return True
+                due = self._get_due_acks(time.time())
+            if not due:
+                time.sleep(min(0.1, max(0, deadline - time.time())))
+            for ack in due:
+                self._attempt(ack)
+        remaining = self.num_pending()
+        if remaining and self._path:
+            logger.error('%d acks still pending, kept in %s for the next run'
+                         % (remaining, self._path))
+        elif remaining:
+            logger.error('%d acks still pending and dropped; their tasks '
+                         'will run again' % remaining)
+        return not remaining
+
+    def _get_due_acks(self, now):
+        """Returns the acks to send now; the caller holds the lock."""
+        return [ack for ack in self._pending.values()
+                if not ack.in_flight and ack.next_attempt_time <= now]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    now = time.time()
+                    due = self._get_due_acks(now)
+                    if due:
+                        break
+                    timeout = None
+                    waiting = [ack.next_attempt_time
+                               for ack in self._pending.values()
+                               if not ack.in_flight]
+                    if waiting:
+                        timeout = min(waiting) - now
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+            for ack in due:
+                self._attempt(ack)
+
+    def _attempt(self, ack):
+        """Sends one ack and updates the queue with the outcome.
+
+        The ack is claimed under the lock first, so that the background
+        thread and flush() never send it at the same time.
+        """
+        from apiclient.errors import HttpError
+        api_errors = (HttpError,) + get_transport_errors()
+        with self._cond:
+            if self._pending.get(ack.task_name) is not ack or ack.in_flight:
+                # Already acked, replaced by a newer lease, or being sent.
+                return
+            ack.in_flight = True
+            ack.num_attempts += 1
+            ack.next_attempt_time = time.time() + random.uniform(0.5, 1) * min(
+                FLAGS.ack_retry_max_backoff_secs,
+                FLAGS.ack_retry_backoff_secs * 2 ** (ack.num_attempts - 1))
+        event = 'ack'
+        try:
+            self._task_api.projects().locations().queues().tasks().acknowledge(
+                name=ack.task_name,
+                body={'scheduleTime': ack.schedule_time}).execute()
+            logger.info('Acked task %s after %d retries'
+                        % (ack.task_name, ack.num_attempts))
+        except api_errors, error:
+            # Connection errors pass like the transient statuses.
+            if (not isinstance(error, HttpError) or
+                    error.resp.status not in _PERMANENT_ERROR_CODES):
+                logger.warn('Retry %d of ack of task %s failed. Error details '
+                            '%s' % (ack.num_attempts, ack.task_name,
+                                    str(error)))
+                with self._cond:
+                    ack.in_flight = False
+                    self._cond.notify()
+                return
+            logger.error('Giving up ack of task %s. Error details %s'
+                         % (ack.task_name, str(error)))
+            event = 'release'
+        with self._cond:
+            ack.in_flight = False
+            if self._pending.get(ack.task_name) is ack:
+                del self._pending[ack.task_name]
+                self._append({'name': ack.task_name, 'done': True})
+        if self._journal:
+            self._journal.record(ack.task_name, event)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Admission control of tasks by payload size and memory.
+
+--num_tasks caps the number of running tasks whatever their size. The
+AdmissionController adds budgets for
+1. the total payload bytes of the running tasks,
+2. the total estimated memory of the running tasks, and
+3. the memory which must stay available on the host, from MemAvailable in
+   /proc/meminfo.
+
+The memory of a task is estimated from the peak RSS of the earlier tasks of
+the same kind, that is with the same tag, or the same executable_binary for
+untagged tasks, as reported by wait4() when their process is reaped. Until a
+kind has been observed, task_memory_estimate_mb is used.
+
+The number of tasks leased is capped by the number of average tasks which
+fit in the budgets, and each leased task is admitted only if it fits; the
+lease of a task which does not fit is cancelled. A task is always admitted
+when nothing is running, so that a task larger than a budget still runs,
+alone.
+"""
+
+
+
+import threading
+import time
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+        'max_payload_mb_in_flight',
+        0,
+        'Limit on the total payload size of the running tasks in MB. 0 '
+        'means no limit.')
+flags.DEFINE_integer(
+        'max_task_memory_mb_in_flight',
+        0,
+        'Limit on the total estimated memory of the running tasks in MB. 0 '
+        'means no limit.')
+flags.DEFINE_integer(
+        'min_free_memory_mb',
+        0,
+        'Do not start a task if that would leave less than this much memory '
+        'available on the host, according to its estimated memory. 0 '
+        'disables the check.')
+flags.DEFINE_integer(
+        'task_memory_estimate_mb',
+        100,
+        'Memory assumed for a kind of task until the peak memory of one has '
+        'been observed.')
+
+_MB = 1024 * 1024
+# Weight of the latest observation in the memory estimate of a kind of task.
+_ESTIMATE_WEIGHT = 0.3
+# Time for which a reading of /proc/meminfo is reused.
+_MEMINFO_TTL_SECS = 1.0
+
+
+def is_enabled():
+    """Returns True if any admission budget is set."""
+    return bool(FLAGS.max_payload_mb_in_flight or
+                FLAGS.max_task_memory_mb_in_flight or
+                FLAGS.min_free_memory_mb)
+
+
+def read_mem_available():
+    """Returns MemAvailable from /proc/meminfo in bytes, None if unknown."""
+    try:
+        f = open('/proc/meminfo')
+        try:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def get_task_kind(task):
+    """Returns the kind of a leased task for its memory estimate."""
+    tag = task.get('pullMessage', {}).get('tag')
+    if tag:
+        return 'tag:' + tag
+    return FLAGS.executable_binary
+
+
+def get_payload_size(task):
+    """Returns the decoded payload size of a leased task."""
+    payload = task.get('pullMessage', {}).get('payload') or ''
+    return len(payload) * 3 // 4
+
+
+class AdmissionController(object):
+    """Keeps the running tasks within the payload and memory budgets."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Payload size, kind and estimated memory of each admitted task.
+        self._admitted = {}
+        self._payload_bytes = 0
+        self._memory_bytes = 0
+        # Estimated peak memory by kind of task, and over all kinds.
+        self._estimates = {}
+        self._mean_estimate = None
+        self._mean_payload = None
+        self._mem_available = None
+        self._mem_available_time = 0
+        self._memory_bytes_at_reading = 0
+
+    def _get_mem_available(self):
+        """Returns the memory available for new tasks, None if unknown.
+
+        The memory of the tasks admitted since /proc/meminfo was read is
+        taken off, as their processes may not have grown yet.
+        """
+        now = time.time()
+        if now - self._mem_available_time > _MEMINFO_TTL_SECS:
+            self._mem_available = read_mem_available()
+            self._mem_available_time = now
+            self._memory_bytes_at_reading = self._memory_bytes
+        if self._mem_available is None:
+            return None
+        return self._mem_available - max(
+            0, self._memory_bytes - self._memory_bytes_at_reading)
+
+    def _estimate(self, kind):
+        estimate = self._estimates.get(kind)
+        if estimate is None:
+            estimate = FLAGS.task_memory_estimate_mb * _MB
+        return estimate
+
+    def max_tasks_to_lease(self, num_tasks):
+        """Caps num_tasks by the number of average tasks the budgets fit.
+
+        Returns:
+            The capped number of tasks, at least 1 if nothing is running.
+        """
+        with self._lock:
+            memory = self._mean_estimate or FLAGS.task_memory_estimate_mb * _MB
+            limits = [num_tasks]
+            if FLAGS.max_task_memory_mb_in_flight and memory:
+                limits.append(int((FLAGS.max_task_memory_mb_in_flight * _MB -
+                                   self._memory_bytes) // memory))
+            if FLAGS.min_free_memory_mb and memory:
+                mem_available = self._get_mem_available()
+                if mem_available is not None:
+                    limits.append(int((mem_available -
+                                       FLAGS.min_free_memory_mb * _MB) //
+                                      memory))
+            if FLAGS.max_payload_mb_in_flight and self._mean_payload:
+                limits.append(int((FLAGS.max_payload_mb_in_flight * _MB -
+                                   self._payload_bytes) //
+                                  self._mean_payload))
+            capped = max(0, min(limits))
+            if not self._admitted:
+                capped = max(capped, min(1, num_tasks))
+            return capped
+
+    def admit(self, task_id, task):
+        """Reserves the budgets for a leased task if it fits.
+
+        Args:
+            task_id: id of the task.
+            task: task object from the lease response.
+
+        Returns:
+            True if the task may be started, False if it does not fit.
+        """
+        payload_bytes = get_payload_size(task)
+        kind = get_task_kind(task)
+        with self._lock:
+            memory = self._estimate(kind)
+            if self._admitted and not self._fits(payload_bytes, memory):
+                return False
+            self._admitted[task_id] = (payload_bytes, kind, memory)
+            self._payload_bytes += payload_bytes
+            self._memory_bytes += memory
+            if self._mean_payload is None:
+                self._mean_payload = payload_bytes
+            else:
+                self._mean_payload += _ESTIMATE_WEIGHT * (
+                    payload_bytes - self._mean_payload)
+            return True
+
+    def _fits(self, payload_bytes, memory):
+        if (FLAGS.max_payload_mb_in_flight and
+                self._payload_bytes + payload_bytes >
+                FLAGS.max_payload_mb_in_flight * _MB):
+            return False
+        if (FLAGS.max_task_memory_mb_in_flight and
+                self._memory_bytes + memory >
+                FLAGS.max_task_memory_mb_in_flight * _MB):
+            return False
+        if FLAGS.min_free_memory_mb:
+            mem_available = self._get_mem_available()
+            if (mem_available is not None and
+                    mem_available - memory < FLAGS.min_free_memory_mb * _MB):
+                return False
+        return True
+
+    def release(self, task_id, max_rss_bytes=None):
+        """Frees the budgets of a task and learns from its peak memory.
+
+        Args:
+            task_id: id of the task.
+            max_rss_bytes: peak RSS of the task process, None if unknown.
+        """
+        with self._lock:
+            admitted = self._admitted.pop(task_id, None)
+            if admitted is None:
+                return
+            (payload_bytes, kind, memory) = admitted
+            self._payload_bytes -= payload_bytes
+            self._memory_bytes -= memory
+            if not max_rss_bytes:
+                return
+            estimate = self._estimates.get(kind)
+            if estimate is None:
+                estimate = max_rss_bytes
+            else:
+                estimate += _ESTIMATE_WEIGHT * (max_rss_bytes - estimate)
+            self._estimates[kind] = estimate
+            if self._mean_estimate is None:
+                self._mean_estimate = estimate
+            else:
+                self._mean_estimate += _ESTIMATE_WEIGHT * (
+                    max_rss_bytes - self._mean_estimate)
+
+    def get_stats_message(self):
+        with self._lock:
+            return ('Admission: %d tasks, %d payload bytes, %d MB estimated '
+                    'memory in flight; estimates %s'
+                    % (len(self._admitted), self._payload_bytes,
+                       self._memory_bytes // _MB,
+                       ', '.join('%s=%dMB' % (kind, estimate // _MB)
+                                 for kind, estimate in
+                                 sorted(self._estimates.items()))))
@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Claim-check payloads: task inputs passed by reference.
+
+A task whose input is too large for a payload can be enqueued with a
+reference to its input instead, as a payload of the form
+    {"claim_check_url": "<url>", "sha256": "<hex digest of the input>"}
+where the url is http://, https://, file:// or an absolute local path, eg.
+on NFS. With --claim_check_payloads, such payloads are recognised and the
+referenced content becomes the input file of the task.
+
+The content is streamed to disk in chunks, never held in memory, and its
+sha256 is checked before it is used. Verified blobs are kept in a directory
+named after their digest, evicted least recently used first once over
+blob_cache_max_mb, so tasks sharing an input fetch it once. Blobs are read
+only and each task gets a copy of its blob as its input file, so a task
+rewriting its input can not corrupt the cache for the tasks after it.
+
+Inputs are fetched on a few fetcher threads, never on the main loop of the
+puller; a task is started once its input is in place, and given up if the
+input is not there within --claim_check_fetch_timeout_secs.
+
+Local references are only followed below --claim_check_local_roots, so that
+a payload can not make the puller hand arbitrary local files to a task.
+"""
+
+
+
+import collections
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from gtaskqueue.taskqueue_logger import logger
+from gtaskqueue.worker_pool import WorkerPool
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_boolean(
+        'claim_check_payloads',
+        False,
+        'Recognise payloads referencing the task input by url and sha256, '
+        'and fetch the input through the blob cache.')
+flags.DEFINE_string(
+        'blob_cache_dir',
+        '/tmp/taskqueue-puller-blobs',
+        'Directory caching the inputs fetched for claim-check payloads.')
+flags.DEFINE_integer(
+        'blob_cache_max_mb',
+        4096,
+        'Size of the blob cache in MB.')
+flags.DEFINE_list(
+        'claim_check_local_roots',
+        [],
+        'Directories under which claim-check payloads may reference local '
+        'files. Local references are rejected if not set.')
+flags.DEFINE_integer(
+        'claim_check_fetch_threads',
+        4,
+        'Number of threads fetching the inputs of claim-check payloads.')
+flags.DEFINE_integer(
+        'claim_check_fetch_timeout_secs',
+        60,
+        'Time in seconds for the input of a claim-check payload to be '
+        'fetched, after which the task is given up. Keep it well under '
+        '--lease_secs.')
+
+# Claim-check payloads are small; larger payloads are not parsed.
+_MAX_REFERENCE_BYTES = 4096
+_CHUNK_BYTES = 1024 * 1024
+# The digest names the blob file, so it must be nothing else.
+_SHA256_PATTERN = re.compile('^[0-9a-f]{64}$')
+
+
+class BlobFetchError(Exception):
+    """Raised when the content of a reference can not be fetched."""
+
+
+class ClaimCheck(object):
+    """Reference to a task input."""
+
+    def __init__(self, url, sha256):
+        self.url = url
+        self.sha256 = sha256.lower()
+
+    def get_cache_key(self):
+        """Returns a payload standing for the referenced content."""
+        return 'claim-check:sha256:' + self.sha256
+
+
+def parse_claim_check(payload):
+    """Returns the ClaimCheck of a payload, None if it is a plain input."""
+    if len(payload) > _MAX_REFERENCE_BYTES or not payload.startswith('{'):
+        return None
+    try:
+        reference = json.loads(payload)
+    except ValueError:
+        return None
+    if (not isinstance(reference, dict) or
+            set(reference) != set(['claim_check_url', 'sha256'])):
+        return None
+    (url, sha256) = (reference['claim_check_url'], reference['sha256'])
+    if (not isinstance(url, basestring) or
+            not isinstance(sha256, basestring) or
+            not _SHA256_PATTERN.match(sha256.lower())):
+        return None
+    return ClaimCheck(str(url), str(sha256))
+
+
+class BlobCache(object):
+    """Disk LRU cache of referenced task inputs, keyed by sha256."""
+
+    def __init__(self, directory, max_bytes, local_roots=()):
+        """Constructor.
+
+        Indexes the blobs left in directory by a previous run.
+
+        Args:
+            directory: directory holding the blobs.
+            max_bytes: total size above which blobs are evicted.
+            local_roots: directories local references may point into.
+        """
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._local_roots = [os.path.realpath(root) for root in local_roots]
+        self._lock = threading.Lock()
+        # Digest to size, least recently used first.
+        self._blobs = collections.OrderedDict()
+        self._total_bytes = 0
+        # Digests being fetched, so that a blob is fetched once at a time.
+        self._fetching = {}
+        self.num_fetches = 0
+        self.num_hits = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        blobs = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.startswith('.'):
+                # Partial fetch of a previous run.
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            blobs.append((stat.st_atime, name, stat.st_size))
+        for (_, name, size) in sorted(blobs):
+            self._blobs[name] = size
+            self._total_bytes += size
+        with self._lock:
+            self._evict()
+
+    def copy_input(self, reference, input_file, timeout_secs=None):
+        """Makes input_file hold a copy of the content of reference.
+
+        The blob is copied rather than linked, so that a task rewriting its
+        input file can not change the cached blob.
+
+        Args:
+            reference: ClaimCheck of the content.
+            input_file: file to write the content to.
+            timeout_secs: timeout of each network operation of a fetch.
+
+        Raises:
+            BlobFetchError: if the content can not be fetched or does not
+                match its digest.
+        """
+        path = os.path.join(self._directory, reference.sha256)
+        source = self._open_cached(reference.sha256)
+        while source is None:
+            with self._lock:
+                fetching = self._fetching.get(reference.sha256)
+                is_fetcher = fetching is None
+                if is_fetcher:
+                    fetching = threading.Event()
+                    self._fetching[reference.sha256] = fetching
+            if is_fetcher:
+                source = self._fetch_and_open(reference, path, fetching,
+                                              timeout_secs)
+            else:
+                # Another thread fetches the same blob; use its result.
+                fetching.wait()
+                source = self._open_cached(reference.sha256)
+        try:
+            try:
+                f = open(input_file, 'wb')
+                try:
+                    shutil.copyfileobj(source, f, _CHUNK_BYTES)
+                finally:
+                    f.close()
+            finally:
+                source.close()
+        except (IOError, OSError), error:
+            raise BlobFetchError('Error copying %s to %s: %s'
+                                 % (reference.sha256, input_file, error))
+
+    def _open_cached(self, digest):
+        """Opens a cached blob, None if it is not cached.
+
+        The blob is opened under the lock, so that it stays readable if it
+        is evicted while being copied.
+        """
+        with self._lock:
+            if digest not in self._blobs:
+                return None
+            size = self._blobs.pop(digest)
+            try:
+                source = open(os.path.join(self._directory, digest), 'rb')
+            except IOError:
+                self._total_bytes -= size
+                return None
+            self._blobs[digest] = size
+            self.num_hits += 1
+            return source
+
+    def _fetch_and_open(self, reference, path, fetching, timeout_secs):
+        try:
+            size = self._fetch(reference, path, timeout_secs)
+            with self._lock:
+                self.num_fetches += 1
+                self._total_bytes += size - self._blobs.pop(reference.sha256,
+                                                            0)
+                self._blobs[reference.sha256] = size
+                source = open(path, 'rb')
+                self._evict()
+            return source
+        finally:
+            with self._lock:
+                del self._fetching[reference.sha256]
+            fetching.set()
+
+    def _open(self, url, timeout_secs=None):
+        """Opens the content of url for reading."""
+        if url.startswith('http://') or url.startswith('https://'):
+            import urllib2
+            try:
+                if timeout_secs:
+                    return urllib2.urlopen(url, timeout=timeout_secs)
+                return urllib2.urlopen(url)
+            except Exception, error:
+                raise BlobFetchError('Error fetching %s: %s' % (url, error))
+        if url.startswith('file://'):
+            url = url[len('file://'):]
+        if not os.path.isabs(url):
+            raise BlobFetchError('Unsupported claim-check url %s' % url)
+        path = os.path.realpath(url)
+        if not [root for root in self._local_roots
+                if path.startswith(os.path.join(root, ''))]:
+            raise BlobFetchError('%s is not under --claim_check_local_roots'
+                                 % path)
+        try:
+            return open(path, 'rb')
+        except IOError, error:
+            raise BlobFetchError('Error opening %s: %s' % (path, error))
+
+    def _fetch(self, reference, path, timeout_secs=None):
+        """Streams the content of reference to path, checking its digest.
+
+        The blob is made read only, as tasks only ever get copies of it.
+
+        Returns:
+            Size of the content.
+        """
+        source = self._open(reference.url, timeout_secs)
+        (fd, tmp_path) = tempfile.mkstemp(dir=self._directory, prefix='.')
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    while True:
+                        chunk = source.read(_CHUNK_BYTES)
+                        if not chunk:
+                            break
+                        digest.update(chunk)
+                        size += len(chunk)
+                        f.write(chunk)
+                finally:
+                    f.close()
+            finally:
+                source.close()
+            if digest.hexdigest() != reference.sha256:
+                raise BlobFetchError('Content of %s has sha256 %s, expected %s'
+                                     % (reference.url, digest.hexdigest(),
+                                        reference.sha256))
+            os.chmod(tmp_path, 0444)
+            os.rename(tmp_path, path)
+        except Exception, error:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if isinstance(error, BlobFetchError):
+                raise
+            raise BlobFetchError('Error fetching %s: %s'
+                                 % (reference.url, error))
+        return size
+
+    def _evict(self):
+        """Evicts least recently used blobs; the caller holds the lock."""
+        while self._total_bytes > self._max_bytes and len(self._blobs) > 1:
+            (digest, size) = self._blobs.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(os.path.join(self._directory, digest))
+            except OSError:
+                pass
+
+    def get_stats_message(self):
+        return ('Blob cache: %d fetches, %d hits, %d blobs, %d bytes'
+                % (self.num_fetches, self.num_hits, len(self._blobs),
+                   self._total_bytes))
+
+
+class BlobFetch(object):
+    """Fetch of the input of a task, run by a BlobFetcher."""
+
+    def __init__(self, task, reference, input_file, deadline):
+        self.task = task
+        self.reference = reference
+        self.input_file = input_file
+        self.deadline = deadline
+        self.error = None
+        self.done = False
+        self.cancelled = False
+
+
+class BlobFetcher(object):
+    """Fetches the inputs of tasks through a BlobCache, off the main loop.
+
+    The tasks whose fetch is done are collected for the main loop to start
+    them, see pop_done().
+    """
+
+    def __init__(self, cache, num_threads=None, timeout_secs=None,
+                 on_done=None):
+        """Constructor.
+
+        Args:
+            cache: BlobCache the inputs are fetched through.
+            num_threads: number of fetcher threads, defaults to
+                --claim_check_fetch_threads.
+            timeout_secs: time for a fetch to be done, defaults to
+                --claim_check_fetch_timeout_secs.
+            on_done: optional callable invoked, on a fetcher thread, each
+                time a fetch is done.
+        """
+        if num_threads is None:
+            num_threads = FLAGS.claim_check_fetch_threads
+        if timeout_secs is None:
+            timeout_secs = FLAGS.claim_check_fetch_timeout_secs
+        self._cache = cache
+        self._timeout_secs = timeout_secs
+        self._on_done = on_done
+        self._lock = threading.Lock()
+        self._done = []
+        self.num_failures = 0
+        self.num_cancelled = 0
+        self._pool = WorkerPool(num_threads, name='blob-fetcher')
+
+    def fetch(self, task, reference, input_file):
+        """Queues the fetch of the content of reference to input_file.
+
+        Returns:
+            BlobFetch, done once input_file holds the content or the fetch
+            failed.
+        """
+        fetch = BlobFetch(task, reference, input_file,
+                          time.time() + self._timeout_secs)
+        self._pool.submit(self._run, fetch)
+        return fetch
+
+    def _run(self, fetch):
+        with self._lock:
+            if fetch.cancelled:
+                return
+        error = None
+        try:
+            self._cache.copy_input(fetch.reference, fetch.input_file,
+                                   self._timeout_secs)
+        except Exception, e:
+            error = e
+        with self._lock:
+            fetch.error = error
+            fetch.done = True
+            if fetch.cancelled:
+                # The task is gone, and with it the owner of the file.
+                _remove_quietly(fetch.input_file)
+                return
+            if error is not None:
+                self.num_failures += 1
+            self._done.append(fetch.task)
+        if self._on_done:
+            self._on_done()
+
+    def cancel(self, fetch):
+        """Cancels a fetch.
+
+        Returns:
+            False if the fetch was done already.
+        """
+        with self._lock:
+            if fetch.done:
+                return False
+            fetch.cancelled = True
+            self.num_cancelled += 1
+            return True
+
+    def is_done(self, fetch):
+        with self._lock:
+            return fetch.done
+
+    def pop_done(self):
+        """Returns the tasks whose fetch was done since the last call."""
+        with self._lock:
+            (done, self._done) = (self._done, [])
+        return done
+
+    def get_stats_message(self):
+        return ('%s; %d fetches failed, %d timed out'
+                % (self._cache.get_stats_message(), self.num_failures,
+                   self.num_cancelled))
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -17,13 +17,18 @@
 
 
 import base64
-import oauth2 as oauth
+import errno
+import fcntl
+import gc
 import os
-import subprocess
+import resource
+import signal
 import tempfile
 import time
-import urllib2
-from apiclient.errors import HttpError
+from gtaskqueue.blob_cache import parse_claim_check
+from gtaskqueue.cpu_placement import set_cpu_affinity
+from gtaskqueue.http_pool import get_transport_errors
+from gtaskqueue.profiling import timed
 from gtaskqueue.taskqueue_logger import logger
 from gtaskqueue.utils import build_cloudtasks_task_name
 import gflags as flags
@@ -57,6 +62,22 @@ flags.DEFINE_float(
         'task_timeout_secs',
         '3600',
         'timeout to kill the task')
+flags.DEFINE_integer(
+        'task_rlimit_as_mb',
+        None,
+        'Limit on the address space of each task process in MB.')
+flags.DEFINE_integer(
+        'task_rlimit_cpu_secs',
+        None,
+        'Limit on the CPU time of each task process in seconds.')
+flags.DEFINE_integer(
+        'task_rlimit_nofile',
+        None,
+        'Limit on the number of open files of each task process.')
+flags.DEFINE_integer(
+        'task_nice',
+        None,
+        'Niceness increment applied to each task process.')
 
 
 class ClientTaskInitError(Exception):
@@ -72,6 +93,33 @@ class ClientTaskInitError(Exception):
                         % (self.task_id, self.error_str))
 
 
+# Exit status given to a child whose status was lost, so that its task is
+# handled as failed.
+LOST_EXIT_STATUS = 255
+
+# Phases whose time is accounted in the completion record of a task.
+_PHASES = ('setup', 'run', 'post', 'ack')
+
+# Only the new lease expiry is read from a renewLease response, and nothing
+# from a cancelLease one (the mask can not be empty).
+RENEW_FIELDS = 'scheduleTime'
+CANCEL_FIELDS = 'name'
+
+# Prefix of the input and output files of the tasks in the temporary
+# directory, by which the ones left behind by a crash are found. It is
+# followed by the pid of the puller, see get_tempfile_prefix().
+TEMPFILE_PREFIX = 'gtaskqueue-'
+
+
+def get_tempfile_prefix():
+    """Returns the prefix of the temporary files of this puller.
+
+    The temporary directory may be shared by several pullers; the pid tells
+    which one a file belongs to.
+    """
+    return '%s%d-' % (TEMPFILE_PREFIX, os.getpid())
+
+
 class ClientTask(object):
     """Class to encapsulate task information pulled by taskqueue_puller module.
 
@@ -81,46 +129,159 @@ class ClientTask(object):
     the task, tracking the status of the task and also deleting the task from
     taskqeueue when completed. It also has the functionality to give the output
     back to the application by posting to the specified url.
+
+    A puller may hold many thousands of tasks, so a task keeps only the
+    fields it needs, in slots: not the lease response, nor the decoded
+    payload once it is written to the input file, nor a Popen object for its
+    child.
     """
 
-    def __init__(self, task):
-        self._task = task
-        self._process = None
+    __slots__ = (
+        'task_name', 'task_id', 'task_schedule_time', 'task_start_time',
+        '_tag', '_create_time', '_dispatch_count', '_encoded_payload',
+        '_payload_bytes', '_cpus', '_failure_policy', '_ack_queue',
+        '_output_cache', '_journal', '_output_batcher', '_blob_fetcher',
+        '_timeout_secs', '_cache_key', '_cache_hit', '_pid', '_returncode',
+        '_max_rss_bytes', '_payload_file', '_output_file', '_num_retries',
+        '_retry_time', '_lease_time', '_run_start_time', '_setup_secs',
+        '_run_secs', '_post_secs', '_ack_secs', '_outcome_logged',
+        '_batch_runner', '_in_batch', '_batch_timed_out', '_fetch')
+
+    # Appengine Access Token shared by all the tasks, loaded on first use.
+    _access_token = None
+
+    def __init__(self, task, cpus=None, failure_policy=None, ack_queue=None,
+                 output_cache=None, journal=None, output_batcher=None,
+                 blob_fetcher=None, batch_runner=None):
+        self.task_name = task.get('name')
+        self.task_id = self.task_name.rsplit('/', 1)[1]
+        self.task_schedule_time = task.get('scheduleTime')
+        self.task_start_time = None
+        message = task.get('pullMessage', {})
+        self._tag = message.get('tag')
+        # Only needed for the dead-letter record of a quarantined task.
+        self._create_time = task.get('createTime')
+        self._dispatch_count = task.get('status', {}).get(
+            'attemptDispatchCount')
+        # Dropped once decoded, unless the task may be quarantined.
+        self._encoded_payload = message.get('payload')
+        self._payload_bytes = 0
+        self._cpus = cpus
+        self._failure_policy = failure_policy
+        self._ack_queue = ack_queue
+        self._output_cache = output_cache
+        self._journal = journal
+        self._output_batcher = output_batcher
+        self._blob_fetcher = blob_fetcher
+        # Pending fetch of the input of a claim-check payload.
+        self._fetch = None
+        # Taken at lease time, so that a reload of --task_timeout_secs does
+        # not kill tasks started under the previous value.
+        self._timeout_secs = FLAGS.task_timeout_secs
+        self._cache_key = None
+        self._cache_hit = False
+        # Pid and exit status of the child running the task.
+        self._pid = None
+        self._returncode = None
+        self._max_rss_bytes = None
+        self._payload_file = None
         self._output_file = None
+        # Number of local retries made so far and the time of the next one,
+        # if the task failed and is waiting to be run again.
+        self._num_retries = 0
+        self._retry_time = None
+        # Time spent in each phase of the task, for its completion record.
+        self._lease_time = time.time()
+        self._run_start_time = None
+        self._setup_secs = None
+        self._run_secs = None
+        self._post_secs = None
+        self._ack_secs = None
+        self._outcome_logged = False
+        # Set in micro-batch mode, where the task is run by a batch of the
+        # runner instead of a child of its own. The task then has no pid.
+        self._batch_runner = batch_runner
+        self._in_batch = False
+        self._batch_timed_out = False
+
+    @classmethod
+    def get_auth_headers(cls, url):
+        """Returns the headers authenticating a post of outputs to url.
+
+        They hold the Appengine Access Token if one is specified. This
+        enables the output_url to be authenticated and not open.
+        """
+        access_token = cls.get_access_token()
+        if not access_token:
+            return {}
+        import oauth2 as oauth
+        consumer = oauth.Consumer('anonymous', 'anonymous')
+        oauth_req = oauth.Request.from_consumer_and_token(
+            consumer,
+            token=access_token,
+            http_url=url)
+        return oauth_req.to_header()
 
     # Class method that caches the Appengine Access Token if any
     @classmethod
     def get_access_token(cls):
         if not FLAGS.appengine_access_token_file:
             return None
-        if not _access_token:
+        if not cls._access_token:
+            import oauth2 as oauth
             fhandle = open(FLAGS.appengine_access_token_file, 'rb')
-            _access_token = oauth.Token.from_string(fhandle.read())
+            cls._access_token = oauth.Token.from_string(fhandle.read())
             fhandle.close()
-        return _access_token
+        return cls._access_token
 
     def init(self):
         """Extracts information from task object and intializes processing.
 
         Extracts id and payload from task object, decodes the payload and puts
         it in input file. After this, it spawns a subprocess to execute the
-        task.
+        task, or queues it for the next batch in micro-batch mode. If the
+        output for the payload is in the output cache, no subprocess is
+        spawned; the task completes with the cached output.
+        A claim-check payload is replaced by the content it references,
+        fetched through the blob cache off the main loop; the task is only
+        started once it is fetched, see is_completed().
 
         Returns:
             True if everything till task execution starts fine.
             False if anything goes wrong in initialization of task execution.
         """
         try:
-            self.task_name = self._task.get('name')
-            self.task_id = self.task_name.rsplit('/', 1)[1]
-            self.task_schedule_time = self._task.get('scheduleTime')
-            self._payload = self._decode_base64_payload(
-                self._task.get('pullMessage', {}).get('payload'))
-            self._payload_file = self._dump_payload_to_file()
-            self._start_task_execution()
+            payload = self._decode_base64_payload(self._encoded_payload)
+            self._payload_bytes = len(payload)
+            if not (self._failure_policy and
+                    self._failure_policy.may_quarantine()):
+                self._encoded_payload = None
+            reference = None
+            if self._blob_fetcher:
+                reference = parse_claim_check(payload)
+            if self._output_cache:
+                key_payload = payload
+                if reference:
+                    key_payload = reference.get_cache_key()
+                self._cache_key = self._output_cache.make_key(
+                    FLAGS.executable_binary, key_payload)
+                if self._output_cache.fetch(self._cache_key,
+                                            self._get_output_file()):
+                    self._cache_hit = True
+                    self.task_start_time = time.time()
+                    self._record('start', pid=None, status=None,
+                                 schedule_time=self.task_schedule_time,
+                                 output_file=self._get_output_file())
+                    return True
+            if reference:
+                self._start_fetch(reference)
+                return True
+            self._payload_file = self._dump_payload_to_file(payload)
+            self._start_or_queue()
             return True
         except ClientTaskInitError, ctie:
             logger.error(str(ctie))
+            self._log_outcome('init_failed')
             return False
 
     def _decode_base64_payload(self, encoded_str):
@@ -145,12 +306,12 @@ class ClientTask(object):
         except:
             raise ClientTaskInitError(self.task_id, 'Error decoding payload')
 
-    def _dump_payload_to_file(self):
+    def _dump_payload_to_file(self, payload):
         """Method to write input extracted from payload to a temporary file."""
         try:
-            (fd, fname) = tempfile.mkstemp()
+            (fd, fname) = tempfile.mkstemp(prefix=get_tempfile_prefix())
             f = os.fdopen(fd, 'w')
-            f.write(self._payload)
+            f.write(payload)
             f.close()
             return fname
         except OSError:
@@ -158,9 +319,63 @@ class ClientTask(object):
                                       (self.task_id, str(OSError)))
             raise ClientTaskInitError(self.task_id, 'Error dumping payload')
 
+    def _start_fetch(self, reference):
+        """Queues the fetch of the input of a claim-check payload."""
+        try:
+            (fd, fname) = tempfile.mkstemp(prefix=get_tempfile_prefix())
+            os.close(fd)
+        except OSError, os_error:
+            logger.error('Error creating input file of task %s. Error details '
+                         '%s' % (self.task_id, str(os_error)))
+            raise ClientTaskInitError(self.task_id, 'Error fetching input')
+        self._payload_file = fname
+        self._fetch = self._blob_fetcher.fetch(self, reference, fname)
+
+    def _check_fetch(self, task_api):
+        """Starts the task once its input is fetched, or gives it up.
+
+        The task is given up if the fetch failed, or if it is not done by its
+        deadline, so that a hanging fetch does not hold the lease.
+
+        Args:
+            task_api: handle for taskqueue api collection.
+
+        Returns:
+            True if the task is given up.
+        """
+        fetch = self._fetch
+        if not self._blob_fetcher.is_done(fetch):
+            if time.time() < fetch.deadline:
+                return False
+            if self._blob_fetcher.cancel(fetch):
+                self._fetch = None
+                logger.error('Input of task %s was not fetched in time'
+                             % self.task_id)
+                self._give_up(task_api, 'input fetch timed out',
+                              'fetch_timed_out')
+                return True
+        self._fetch = None
+        if fetch.error is not None:
+            logger.error('Error fetching input of task %s. Error details %s'
+                         % (self.task_id, str(fetch.error)))
+            self._give_up(task_api, 'input fetch failed', 'fetch_failed')
+            return True
+        try:
+            self._start_or_queue()
+        except ClientTaskInitError, ctie:
+            logger.error(str(ctie))
+            self._give_up(task_api, 'start failed', 'failed')
+            return True
+        return False
+
+    def is_fetching(self):
+        """Returns True while the input of the task is being fetched."""
+        return self._fetch is not None
+
     def _get_input_file(self):
         return self._payload_file
 
+    @timed('post_output')
     def _post_output(self):
         """Posts the outback back to specified url in the form of a byte
         array.
@@ -175,6 +390,7 @@ class ClientTask(object):
             True/False based on post status.
         """
         if FLAGS.output_url:
+            import urllib2
             try:
                 f = open(self._get_output_file(), 'rb')
                 body = f.read()
@@ -182,16 +398,7 @@ class ClientTask(object):
                 url = FLAGS.output_url + self.task_id
                 logger.debug('Posting data to url %s' % url)
                 headers = {'Content-Type': 'byte-array'}
-                # Add an access token to the headers if specified.
-                # This enables the output_url to be authenticated and not open.
-                access_token = ClientTask.get_access_token()
-                if access_token:
-                    consumer = oauth.Consumer('anonymous', 'anonymous')
-                    oauth_req = oauth.Request.from_consumer_and_token(
-                        consumer,
-                        token=access_token,
-                        http_url=url)
-                    headers.update(oauth_req.to_header())
+                headers.update(ClientTask.get_auth_headers(url))
                 # TODO: Use httplib instead of urllib for consistency.
                 req = urllib2.Request(url, body, headers)
                 urllib2.urlopen(req)
@@ -209,12 +416,202 @@ class ClientTask(object):
         """Returns the output file if it exists, else creates it and returns
         it."""
         if not self._output_file:
-            (_, self._output_file) = tempfile.mkstemp()
+            (fd, self._output_file) = tempfile.mkstemp(
+                prefix=get_tempfile_prefix())
+            os.close(fd)
         return self._output_file
 
     def get_task_id(self):
         return self.task_id
 
+    def get_temp_files(self):
+        """Returns the paths of the input and output files of the task."""
+        return [path for path in (self._payload_file, self._output_file)
+                if path]
+
+    def get_cpus(self):
+        """Returns the cpus the task is pinned to, None if not pinned."""
+        return self._cpus
+
+    def get_pid(self):
+        """Returns the pid of the subprocess executing the task.
+
+        None if no subprocess was started, as for a task answered from the
+        output cache.
+        """
+        return self._pid
+
+    def get_exit_status(self):
+        """Returns the exit status of the last run, None while it runs.
+
+        A negative status means the process was killed by that signal.
+        """
+        return self._returncode
+
+    def get_wakeup_time(self):
+        """Returns when the task needs to be looked at without an event.
+
+        That is at once for a task answered from the output cache, when the
+        fetch of its input times out, when a failed task is due for its
+        retry, or when a running task times out.
+        None if the task waits for its child to exit or has nothing left to
+        run.
+        """
+        if self._cache_hit:
+            return self.task_start_time
+        if self._fetch is not None:
+            return self._fetch.deadline
+        if self._retry_time is not None:
+            return self._retry_time
+        if self._pid is not None and self._returncode is None:
+            return self.task_start_time + self._timeout_secs
+        return None
+
+    def is_waiting_for_batch(self):
+        """Returns True while the task is queued or running in a batch."""
+        return self._in_batch
+
+    def _record(self, event, **fields):
+        """Journals an event of the task, if the puller keeps a journal."""
+        if self._journal:
+            self._journal.record(self.task_name, event, **fields)
+
+    def get_retry_time(self):
+        """Returns when a failed task is run again, None if it is not."""
+        return self._retry_time
+
+    def get_max_rss_bytes(self):
+        """Returns the peak RSS of the last finished run, None if unknown."""
+        return self._max_rss_bytes
+
+    def set_exit_status(self, status, rusage=None):
+        """Records the exit status of a subprocess reaped by the caller.
+
+        Used when the puller reaps its children itself with os.wait4().
+
+        Args:
+            status: exit status as returned by os.wait4().
+            rusage: resource usage as returned by os.wait4(), if any.
+        """
+        if os.WIFSIGNALED(status):
+            self._returncode = -os.WTERMSIG(status)
+        else:
+            self._returncode = os.WEXITSTATUS(status)
+        if rusage is not None:
+            # ru_maxrss is in KB on Linux.
+            self._max_rss_bytes = rusage.ru_maxrss * 1024
+        self._end_run()
+
+    def _end_run(self):
+        """Accounts the run time of the subprocess which just ended."""
+        if self._run_start_time is not None:
+            self._add_phase_time('run', self._run_start_time)
+            self._run_start_time = None
+
+    def _add_phase_time(self, phase, start_time):
+        attr = '_%s_secs' % phase
+        setattr(self, attr,
+                (getattr(self, attr) or 0) + time.time() - start_time)
+
+    def _log_outcome(self, outcome, reason=None):
+        """Logs the one structured record of the task once it is done.
+
+        Args:
+            outcome: succeeded, cached, post_failed, failed, timed_out,
+                quarantined, abandoned or init_failed.
+            reason: description of a failure.
+        """
+        if self._outcome_logged:
+            return
+        self._outcome_logged = True
+        fields = {
+            'task': self.task_id,
+            'tag': self._tag,
+            'outcome': outcome,
+            'retries': self._num_retries,
+            'payload_bytes': self._payload_bytes,
+            'total_secs': round(time.time() - self._lease_time, 3),
+        }
+        if reason:
+            fields['reason'] = reason
+        if self._pid is not None or self._returncode is not None:
+            fields['exit_status'] = self._returncode
+        if self._max_rss_bytes is not None:
+            fields['max_rss_bytes'] = self._max_rss_bytes
+        if self._cpus:
+            fields['cpus'] = list(self._cpus)
+        for phase in _PHASES:
+            secs = getattr(self, '_%s_secs' % phase)
+            if secs is not None:
+                fields[phase + '_secs'] = round(secs, 3)
+        logger.info('Task %s' % ' '.join('%s=%s' % (key, fields[key])
+                                          for key in sorted(fields)),
+                    extra={'fields': fields})
+
+    def _poll_process(self):
+        """Returns the exit status of the subprocess like Popen.poll().
+
+        The subprocess is reaped with os.wait4(), which also reports its
+        peak memory. A task run in a batch has its status set by the batch.
+        """
+        if self._returncode is None and self._pid is not None:
+            try:
+                (pid, status, rusage) = os.wait4(self._pid, os.WNOHANG)
+            except OSError, os_error:
+                if os_error.errno != errno.ECHILD:
+                    raise
+                # Reaped elsewhere and its status is lost. The task may have
+                # failed, so it is not acked nor its output cached.
+                logger.error('Exit status of task %s is lost' % self.task_id)
+                self._returncode = LOST_EXIT_STATUS
+                self._end_run()
+                return self._returncode
+            if pid:
+                self.set_exit_status(status, rusage)
+        return self._returncode
+
+    def _start_or_queue(self):
+        """Runs the task, or queues it for a batch in micro-batch mode."""
+        if self._batch_runner:
+            # Both files are listed in the manifest of the batch.
+            self._get_output_file()
+            self._returncode = None
+            self._in_batch = True
+            self._batch_runner.add(self)
+        else:
+            self._start_task_execution()
+
+    def batch_started(self, pid, manifest_file):
+        """Records that the batch running the task has started.
+
+        Args:
+            pid: pid of the batch process.
+            manifest_file: input manifest of the batch, which is on the
+                command line of the batch process.
+        """
+        self.task_start_time = time.time()
+        self._run_start_time = self.task_start_time
+        if not self._num_retries:
+            self._setup_secs = self.task_start_time - self._lease_time
+        self._record('start', pid=pid, status=None,
+                     schedule_time=self.task_schedule_time,
+                     input_file=self._get_input_file(),
+                     output_file=self._get_output_file(),
+                     batch_manifest=manifest_file)
+
+    def set_batch_result(self, returncode, timed_out=False):
+        """Records the outcome of the task in the batch which ran it.
+
+        Args:
+            returncode: exit status of the task, as reported in the output
+                manifest of the batch.
+            timed_out: True if the batch was killed for running too long.
+        """
+        self._in_batch = False
+        self._returncode = returncode
+        self._batch_timed_out = timed_out
+        self._end_run()
+
     def _start_task_execution(self):
         """Method to spawn subprocess to execute the tasks.
 
@@ -224,14 +621,20 @@ class ClientTask(object):
         and output files as first and second positional parameters
         respectively.
         """
-        # TODO: Add code to handle the cleanly shutdown when a process is killed
-        # by Ctrl+C.
         try:
             cmdline = FLAGS.executable_binary.split(' ')
             cmdline.append(self._get_input_file())
             cmdline.append(self._get_output_file())
-            self._process = subprocess.Popen(cmdline)
+            self._returncode = None
+            self._pid = spawn_task_process(cmdline, self._cpus)
             self.task_start_time = time.time()
+            self._run_start_time = self.task_start_time
+            if not self._num_retries:
+                self._setup_secs = self.task_start_time - self._lease_time
+            self._record('start', pid=self._pid, status=None,
+                         schedule_time=self.task_schedule_time,
+                         input_file=self._get_input_file(),
+                         output_file=self._get_output_file())
         except OSError:
             logger.error('Error creating subprocess %s. Error details %s'
                         % (self.task_id, str(OSError)))
@@ -239,8 +642,8 @@ class ClientTask(object):
             raise ClientTaskInitError(self.task_id,
                                       'Error creating subprocess')
         except ValueError:
-            logger.error('Invalid arguments while executing task ',
-                         self.task_id)
+            logger.error('Invalid arguments while executing task %s'
+                         % self.task_id)
             self._cleanup()
             raise ClientTaskInitError(self.task_id,
                                       'Invalid arguments while executing task')
@@ -250,13 +653,13 @@ class ClientTask(object):
 
         This is responsible for checking status of task execution. If the task
         has already finished executing, it deletes the task from the task
-        queue. If the task has been running since long time then it assumes
-        that there is high proabbility that it is dfunct and hence kills the
-        corresponding subprocess. In this case, task had not completed
-        successfully and hence we do not delete it form the taskqueue. In above
-        two cases, task completion status is returned as true since there is
-        nothing more to run in the task. In all other cases, task is still
-        running and hence we return false as completion status.
+        queue. If the task has failed, or has been running since long time and
+        hence is likely defunct and gets killed, it is handed to the failure
+        policy: it is either scheduled for a local retry, or its lease is
+        cancelled or delayed, or it is quarantined. A task waiting for a local
+        retry is restarted here once its backoff has passed. A task waiting for
+        its input is started here once the input is fetched. Task completion
+        status is true when there is nothing more to run in the task.
 
         Args:
             task_api: handle for taskqueue api collection.
@@ -266,27 +669,211 @@ class ClientTask(object):
         """
         status = False
         try:
-            task_status = self._process.poll()
+            if self._cache_hit:
+                self._complete_successful_task(task_api)
+                return True
+            if self._fetch is not None:
+                return self._check_fetch(task_api)
+            if self._retry_time is not None:
+                if time.time() >= self._retry_time:
+                    status = self._retry(task_api)
+                return status
+            if self._batch_timed_out:
+                self._batch_timed_out = False
+                return self._handle_failure(task_api, 'timed out',
+                                            'timed_out', may_retry=False)
+            task_status = self._poll_process()
+            if task_status is not None:
+                self._end_run()
             if task_status == 0:
                 status = True
-                if self._post_output():
-                    self._delete_task_from_queue(task_api)
-                self._cleanup()
-            elif task_status > 0:
-                logger.error('Subprocess returned unexpected value %s' % str(task_status))
-                status = True
-            elif self._has_timedout():
-                status = True
+                if self._output_cache:
+                    self._output_cache.store(self._cache_key,
+                                             self._get_output_file())
+                self._complete_successful_task(task_api)
+            elif task_status is not None:
+                self._record('finish', status=task_status)
+                # A negative status means the process was killed by a signal.
+                logger.error('Task %s returned unexpected value %s'
+                             % (self.task_id, str(task_status)))
+                status = self._handle_failure(
+                    task_api, 'exit status %s' % task_status, 'failed')
+            elif self._pid is not None and self._has_timedout():
                 self._kill_subprocess()
+                self._end_run()
+                status = self._handle_failure(task_api, 'timed out',
+                                              'timed_out', may_retry=False)
         except OSError:
             logger.error('Error during polling status of task %s, Error '
                          'details %s' % (self.task_id, str(OSError)))
         return status
 
+    def _complete_successful_task(self, task_api):
+        """Posts the output, deletes the task from the queue and cleans up."""
+        self._record('finish', status=0)
+        if self._output_batcher:
+            self._queue_output(task_api)
+            return
+        start_time = time.time()
+        posted = self._post_output()
+        self._add_phase_time('post', start_time)
+        self._finish_completed_task(task_api, posted)
+
+    def _queue_output(self, task_api):
+        """Hands the output to the batcher.
+
+        The task is acked or released from the batcher thread once the
+        batch holding its output has been posted.
+        """
+        start_time = time.time()
+        try:
+            f = open(self._get_output_file(), 'rb')
+            try:
+                output = f.read()
+            finally:
+                f.close()
+        except IOError, io_error:
+            logger.error('Error reading output of task %s. Error details %s'
+                         % (self.task_id, str(io_error)))
+            self._finish_completed_task(task_api, False)
+            return
+        # The files are not needed any more while the output waits.
+        self._cleanup()
+
+        def on_delivered(delivered):
+            self._add_phase_time('post', start_time)
+            self._finish_completed_task(task_api, delivered)
+        self._output_batcher.add(self.task_id, output, on_delivered)
+
+    def _finish_completed_task(self, task_api, posted):
+        """Acks a completed task whose output was posted, and cleans up.
+
+        Args:
+            task_api: handle for taskqueue api collection.
+            posted: whether the output was delivered.
+        """
+        if posted:
+            self._record('post', posted=True)
+            start_time = time.time()
+            self._delete_task_from_queue(task_api)
+            self._add_phase_time('ack', start_time)
+        else:
+            self._record('release')
+        self._cleanup()
+        if self._failure_policy:
+            self._failure_policy.forget(self.task_id)
+        if not posted:
+            self._log_outcome('post_failed')
+        elif self._cache_hit:
+            self._log_outcome('cached')
+        else:
+            self._log_outcome('succeeded')
+
+    def _handle_failure(self, task_api, reason, outcome, may_retry=True):
+        """Schedules a local retry of a failed task, or gives it up.
+
+        Args:
+            task_api: handle for taskqueue api collection.
+            reason: description of the failure.
+            outcome: outcome logged if the task is given up.
+            may_retry: False if the task must not be retried locally.
+
+        Returns:
+            True if the task is given up, False if it will be retried.
+        """
+        delay = None
+        if may_retry and self._failure_policy:
+            delay = self._failure_policy.retry_delay(self._num_retries + 1)
+        # The lease must outlast the backoff and the next run.
+        if delay is not None and self._renew_lease(
+                task_api, delay + self._failure_policy.lease_secs):
+            self._num_retries += 1
+            self._retry_time = time.time() + delay
+            self._remove_output_file()
+            logger.info('Retrying task %s in %.1fs (retry %d)'
+                        % (self.task_id, delay, self._num_retries))
+            return False
+        self._give_up(task_api, reason, outcome)
+        return True
+
+    def _retry(self, task_api):
+        """Runs a failed task again, or queues it for the next batch.
+
+        Returns:
+            True if the task could not be restarted and is given up.
+        """
+        self._retry_time = None
+        try:
+            self._start_or_queue()
+            return False
+        except ClientTaskInitError, ctie:
+            logger.error(str(ctie))
+            self._give_up(task_api, 'restart failed', 'failed')
+            return True
+
+    def _give_up(self, task_api, reason, outcome):
+        """Cleans up a failed task and applies the failure action.
+
+        A task which has failed too often is written to the dead-letter file
+        and acknowledged. Otherwise the lease is cancelled, so the task is
+        redelivered right away, or renewed for the failure delay, according
+        to --task_failure_action.
+
+        Args:
+            task_api: handle for taskqueue api collection.
+            reason: description of the failure.
+            outcome: outcome to log unless the task is quarantined.
+        """
+        self._cleanup()
+        policy = self._failure_policy
+        if not policy:
+            self._record('release')
+            self._log_outcome(outcome, reason)
+            return
+        failures = policy.record_failure(self.task_id)
+        if policy.should_quarantine(failures):
+            record = {
+                'name': self.task_name,
+                'reason': reason,
+                'failures': failures,
+                'local_retries': self._num_retries,
+                'create_time': self._create_time,
+                'dispatch_count': self._dispatch_count,
+                'tag': self._tag,
+                'payload': self._encoded_payload,
+            }
+            if policy.quarantine(record):
+                self._delete_task_from_queue(task_api)
+                policy.forget(self.task_id)
+                self._log_outcome('quarantined', reason)
+                return
+        if FLAGS.task_failure_action == 'cancel_lease':
+            self.cancel_lease(task_api)
+        elif FLAGS.task_failure_action == 'delay':
+            self._renew_lease(task_api, FLAGS.task_failure_delay_secs)
+        self._record('release')
+        self._log_outcome(outcome, reason)
+
+    def _renew_lease(self, task_api, lease_secs):
+        """Renews the lease on the task for lease_secs from now.
+
+        Returns:
+            True/False based on renew status.
+        """
+        schedule_time = renew_task_lease(task_api, self.task_name,
+                                         self.task_schedule_time, lease_secs)
+        if schedule_time is None:
+            return False
+        # The ack and any further lease call must use the new schedule time.
+        self.task_schedule_time = schedule_time
+        self._record('lease', schedule_time=schedule_time)
+        return True
+
     def _cleanup(self):
         """Cleans up temporary input/output files used in task execution."""
         try:
-            if os.path.exists(self._get_input_file()):
+            if (self._get_input_file() and
+                    os.path.exists(self._get_input_file())):
                 os.remove(self._get_input_file())
             if os.path.exists(self._get_output_file()):
                 os.remove(self._get_output_file())
@@ -294,14 +881,23 @@ class ClientTask(object):
             logger.error('Error during file cleanup for task %s. Error'
                          'details %s' % (self.task_id, str(OSError)))
 
+    def _remove_output_file(self):
+        """Removes the output of a failed run before the task is retried."""
+        if self._output_file:
+            try:
+                os.remove(self._output_file)
+            except OSError:
+                pass
+            self._output_file = None
+
+    @timed('delete_task_from_queue')
     def _delete_task_from_queue(self, task_api):
         """Method to delete the task from the taskqueue.
 
-        First, it tries to post the output back to speified url. On successful
-        post, the task is deleted from taskqueue since the task has produced
-        expected output. If the post was unsuccessful, the task is not deleted
-        form the tskqueue since the expected output has yet not reached the
-        application. In either case cleanup is performed on the task.
+        The task is recorded as completed first, so that it is acked again
+        rather than run again if it is redelivered. If the ack fails, it is
+        handed to the ack retry queue, which journals the ack once it goes
+        through.
 
         Args:
             task_api: handle for taskqueue api collection.
@@ -309,7 +905,9 @@ class ClientTask(object):
         Returns:
             Delete status (True/False)
         """
-
+        from apiclient.errors import HttpError
+        if self._ack_queue:
+            self._ack_queue.record_completed(self.task_id)
         try:
             name = build_cloudtasks_task_name(FLAGS.project_name, FLAGS.project_location, FLAGS.taskqueue_name,
                                               task_id=self.task_id)
@@ -318,14 +916,19 @@ class ClientTask(object):
                 name=name,
                 body=body)
             delete_request.execute()
-        except HttpError, http_error:
+            self._record('ack')
+            return True
+        except (HttpError,) + get_transport_errors(), http_error:
             logger.error('Error deleting task %s from taskqueue.'
                          'Error details %s'
                          % (self.task_id, str(http_error)))
+            if self._ack_queue:
+                self._ack_queue.add(name, self.task_schedule_time)
+            return False
 
     def _has_timedout(self):
         """Checks if task has been running since long and has timedout."""
-        if (time.time() - self.task_start_time) > FLAGS.task_timeout_secs:
+        if (time.time() - self.task_start_time) > self._timeout_secs:
             return True
         else:
             return False
@@ -333,10 +936,229 @@ class ClientTask(object):
     def _kill_subprocess(self):
         """Kills the process after cleaning up the task."""
         self._cleanup()
+        logger.info('Trying to kill task %s, since it has been running '
+                    'for long' % self.task_id)
+        self._kill_process_group()
+
+    def _kill_process_group(self):
+        """Kills the task process and all the processes it started."""
         try:
-            self._process.kill()
-            logger.info('Trying to kill task %s, since it has been running '
-                        'for long' % self.task_id)
-        except OSError:
+            os.killpg(self._pid, signal.SIGKILL)
+        except OSError, os_error:
             logger.error('Error killing task %s. Error details %s'
-                         % (self.task_id, str(OSError)))
+                         % (self.task_id, str(os_error)))
+
+    def cancel_lease(self, task_api):
+        """Gives up the lease on the task so that it is redelivered now.
+
+        Args:
+            task_api: handle for taskqueue api collection.
+
+        Returns:
+            True/False based on cancel status.
+        """
+        return cancel_task_lease(task_api, self.task_name,
+                                 self.task_schedule_time)
+
+    def abandon(self, task_api):
+        """Stops a running task and hands it back to the taskqueue.
+
+        Kills the process group of the task, cleans up its files and cancels
+        its lease so that another worker can pick it up immediately instead
+        of after the lease expires.
+
+        Args:
+            task_api: handle for taskqueue api collection.
+        """
+        if self._pid is not None and self._poll_process() is None:
+            logger.info('Killing task %s on shutdown' % self.task_id)
+            self._kill_process_group()
+        if self._fetch is not None:
+            self._blob_fetcher.cancel(self._fetch)
+            self._fetch = None
+        self._cleanup()
+        self.cancel_lease(task_api)
+        self._record('release')
+        self._log_outcome('abandoned')
+
+
+def cancel_task_lease(task_api, task_name, task_schedule_time):
+    """Cancels the lease on a task so that it is redelivered immediately.
+
+    Args:
+        task_api: handle for taskqueue api collection.
+        task_name: full name of the task.
+        task_schedule_time: scheduleTime of the task from its lease.
+
+    Returns:
+        True/False based on cancel status.
+    """
+    from apiclient.errors import HttpError
+    try:
+        body = {'scheduleTime': task_schedule_time,
+                'responseView': 'BASIC'}
+        task_api.projects().locations().queues().tasks().cancelLease(
+            name=task_name,
+            body=body,
+            fields=CANCEL_FIELDS).execute()
+        return True
+    except (HttpError,) + get_transport_errors(), http_error:
+        logger.error('Error cancelling lease of task %s. Error details %s'
+                     % (task_name, str(http_error)))
+        return False
+
+
+def renew_task_lease(task_api, task_name, task_schedule_time, lease_secs):
+    """Extends the lease on a task to lease_secs from now.
+
+    Args:
+        task_api: handle for taskqueue api collection.
+        task_name: full name of the task.
+        task_schedule_time: scheduleTime of the task from its lease.
+        lease_secs: new lease duration.
+
+    Returns:
+        The new scheduleTime of the task, or None if the renew failed.
+    """
+    from apiclient.errors import HttpError
+    try:
+        body = {'scheduleTime': task_schedule_time,
+                'leaseDuration': '%ss' % lease_secs,
+                'responseView': 'BASIC'}
+        task = task_api.projects().locations().queues().tasks().renewLease(
+            name=task_name,
+            body=body,
+            fields=RENEW_FIELDS).execute()
+        return task.get('scheduleTime')
+    except (HttpError,) + get_transport_errors(), http_error:
+        logger.error('Error renewing lease of task %s. Error details %s'
+                     % (task_name, str(http_error)))
+        return None
+
+
+def spawn_task_process(cmdline, cpus=None):
+    """Starts the process of a task, or of a batch of tasks.
+
+    Args:
+        cmdline: command line of the process.
+        cpus: cpus to pin the process to, None for no pinning.
+
+    Returns:
+        Pid of the child.
+
+    Raises:
+        OSError: if the child could not be started.
+        ValueError: if the resource controls could not be applied.
+    """
+    return _spawn(cmdline, lambda: _prepare_child(cpus))
+
+
+def _prepare_child(cpus):
+    """Applies the resource controls to the child before exec.
+
+    Runs in the forked child process, so it must not log or touch any state
+    shared with the puller. Exceptions raised here are re-raised by _spawn()
+    in the puller.
+
+    The child is made the leader of a new process group, so that the task
+    and everything it starts can be killed together, and so that a Ctrl+C
+    in the puller's terminal reaches only the puller, which then drains its
+    tasks.
+    """
+    os.setpgrp()
+    if FLAGS.task_rlimit_as_mb:
+        _set_rlimit(resource.RLIMIT_AS, FLAGS.task_rlimit_as_mb * 1024 * 1024)
+    if FLAGS.task_rlimit_cpu_secs:
+        _set_rlimit(resource.RLIMIT_CPU, FLAGS.task_rlimit_cpu_secs)
+    if FLAGS.task_rlimit_nofile:
+        _set_rlimit(resource.RLIMIT_NOFILE, FLAGS.task_rlimit_nofile)
+    if FLAGS.task_nice:
+        os.nice(FLAGS.task_nice)
+    if cpus:
+        set_cpu_affinity(0, cpus)
+
+
+def _spawn(cmdline, preexec_fn):
+    """Starts cmdline in a child process, like subprocess.Popen.
+
+    Only the pid is returned, for the caller to reap the child with
+    os.wait4(); a Popen object would cost memory per task and reap children
+    behind the puller's back once garbage collected. An exception in
+    preexec_fn or in the exec is reported through a close-on-exec pipe and
+    raised here.
+
+    Returns:
+        Pid of the child.
+
+    Raises:
+        OSError: if the child could not be started.
+        ValueError: if preexec_fn raised anything else.
+    """
+    (error_r, error_w) = os.pipe()
+    try:
+        fcntl.fcntl(error_w, fcntl.F_SETFD,
+                    fcntl.fcntl(error_w, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        # As in subprocess, no collection may run in the child before exec.
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            pid = os.fork()
+        except:
+            if gc_was_enabled:
+                gc.enable()
+            raise
+        if pid == 0:
+            try:
+                os.close(error_r)
+                preexec_fn()
+                os.execvp(cmdline[0], cmdline)
+            except BaseException, error:
+                try:
+                    if isinstance(error, OSError):
+                        report = 'OSError:%d:%s' % (error.errno or 0,
+                                                    error.strerror)
+                    else:
+                        report = 'Error:0:%s' % error
+                    os.write(error_w, report)
+                except BaseException:
+                    pass
+            finally:
+                os._exit(255)
+        if gc_was_enabled:
+            gc.enable()
+        os.close(error_w)
+        error_w = None
+        data = []
+        while True:
+            try:
+                chunk = os.read(error_r, 4096)
+            except OSError, e:
+                # SIGCHLD from other children interrupts the read.
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not chunk:
+                break
+            data.append(chunk)
+    finally:
+        os.close(error_r)
+        if error_w is not None:
+            os.close(error_w)
+    if not data:
+        return pid
+    try:
+        os.waitpid(pid, 0)
+    except OSError:
+        pass
+    (kind, error_number, message) = ''.join(data).split(':', 2)
+    if kind == 'OSError':
+        raise OSError(int(error_number), message)
+    raise ValueError(message)
+
+
+def _set_rlimit(limit, value):
+    """Sets both the soft and the hard limit, capped at the current hard."""
+    (_, hard) = resource.getrlimit(limit)
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+    resource.setrlimit(limit, (value, value))
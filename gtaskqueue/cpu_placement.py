@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""CPU affinity helpers and the core placement policy for task processes.
+
+Python 2 has no os.sched_setaffinity, so on Linux the affinity is set with
+the sched_setaffinity system call through ctypes.
+"""
+
+
+
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+from gtaskqueue.taskqueue_logger import logger
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+    return _libc
+
+
+def get_allowed_cpus():
+    """Returns the sorted list of cpus this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    try:
+        f = open('/proc/self/status')
+        try:
+            for line in f:
+                if line.startswith('Cpus_allowed_list:'):
+                    return parse_cpu_list(line.split(':', 1)[1])
+        finally:
+            f.close()
+    except IOError:
+        pass
+    return range(multiprocessing.cpu_count())
+
+
+def parse_cpu_list(cpu_list):
+    """Parses a cpu list such as "0-3,8,10-11" into a sorted list of ints."""
+    cpus = set()
+    for part in cpu_list.strip().split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def set_cpu_affinity(pid, cpus):
+    """Restricts process pid (0 for the calling process) to cpus.
+
+    Raises:
+        OSError: if the affinity could not be set.
+    """
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(pid, cpus)
+        return
+    num_words = max(cpus) // 64 + 1
+    mask = (ctypes.c_uint64 * num_words)()
+    for cpu in cpus:
+        mask[cpu // 64] |= 1 << (cpu % 64)
+    if _get_libc().sched_setaffinity(pid, ctypes.sizeof(mask), mask) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+
+class CorePlacer(object):
+    """Assigns running tasks to cores round-robin.
+
+    The allowed cpus are split into fixed sets of cores_per_task cpus. Each
+    new task gets the least loaded set, searching round-robin from the set
+    after the last one handed out, so with fewer tasks than sets every task
+    has cores of its own and with more tasks they are spread evenly.
+    """
+
+    def __init__(self, cpus, cores_per_task):
+        """Constructor.
+
+        Args:
+            cpus: list of cpus available to the tasks.
+            cores_per_task: number of cpus in each set.
+
+        Raises:
+            ValueError: if cpus is empty.
+        """
+        cpus = sorted(cpus)
+        if not cpus:
+            raise ValueError('No cpus to place tasks on')
+        cores_per_task = max(1, min(cores_per_task, len(cpus)))
+        self._core_sets = [tuple(cpus[i:i + cores_per_task])
+                           for i in range(0, len(cpus) - cores_per_task + 1,
+                                          cores_per_task)]
+        self._load = dict((core_set, 0) for core_set in self._core_sets)
+        self._next = 0
+        logger.info('Placing tasks on core sets %s' % self._core_sets)
+
+    def acquire(self):
+        """Returns the core set for a new task."""
+        num_sets = len(self._core_sets)
+        best = None
+        for i in range(num_sets):
+            core_set = self._core_sets[(self._next + i) % num_sets]
+            if best is None or self._load[core_set] < self._load[best]:
+                best = core_set
+                if not self._load[core_set]:
+                    break
+        self._next = (self._core_sets.index(best) + 1) % num_sets
+        self._load[best] += 1
+        return best
+
+    def release(self, core_set):
+        """Frees a core set returned by acquire() once its task is done."""
+        if core_set in self._load and self._load[core_set] > 0:
+            self._load[core_set] -= 1
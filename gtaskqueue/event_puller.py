@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Event driven engine for the task puller.
+
+TaskQueuePuller checks for finished tasks at fixed intervals and makes its
+lease, ack and output post calls inline, so with many tasks in flight the
+sleeps and the serial HTTP calls dominate. EventTaskQueuePuller keeps the
+same flags, leasing decisions and task table but:
+1. Sleeps on a self-pipe which is written to by a SIGCHLD handler and by the
+   worker threads, instead of sleeping for fixed intervals.
+2. Wakes up for the next task timeout or retry from the task table.
+3. Runs the lease request and the output post and ack of each finished task
+   on a pool of worker threads, over the thread-safe HTTP connection pool.
+"""
+
+
+
+import errno
+import fcntl
+import os
+import Queue
+import select
+import signal
+import time
+from gtaskqueue.taskqueue_logger import logger
+from gtaskqueue.taskqueue_puller import TaskQueuePuller
+from gtaskqueue.worker_pool import WorkerPool
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+        'event_worker_threads',
+        8,
+        'Number of threads running API calls and output posts for the '
+        'event engine. Use together with --http_pool_size.')
+
+# Kinds of work handed to the worker threads.
+_LEASE = 'lease'
+_COMPLETE = 'complete'
+
+
+class EventTaskQueuePuller(TaskQueuePuller):
+    """TaskQueuePuller driven by child exits instead of polling sweeps."""
+
+    def __init__(self):
+        TaskQueuePuller.__init__(self)
+        # Ids of the tasks whose completion is being handled by a worker.
+        self._completing = set()
+        # Ids of the failed tasks waiting for a local retry.
+        self._retrying = set()
+        self._lease_in_flight = False
+        # Set once _continue_polling() has decided that it is time for the
+        # next lease, until that lease is sent.
+        self._lease_wanted = True
+        self._done = Queue.Queue()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._workers = WorkerPool(FLAGS.event_worker_threads,
+                                   on_done=self._on_work_done,
+                                   name='puller')
+        signal.signal(signal.SIGCHLD, self._on_sigchld)
+        # Restart the blocking calls of the main thread, eg. the socket reads
+        # of an API call, rather than failing them with EINTR at every child
+        # exit. The select() of _wait_for_events() is still interrupted.
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, '\0')
+        except OSError, e:
+            # A full pipe already guarantees a wakeup.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _on_sigchld(self, signum, frame):
+        self._wakeup()
+
+    def _on_fetch_done(self):
+        self._wakeup()
+
+    def _on_work_done(self, item):
+        """Called on a worker thread when a submitted call has run."""
+        self._done.put(item)
+        self._wakeup()
+
+    def request_shutdown(self):
+        TaskQueuePuller.request_shutdown(self)
+        self._wakeup()
+
+    def request_tuning_reload(self):
+        TaskQueuePuller.request_tuning_reload(self)
+        self._wakeup()
+
+    def _wait_for_events(self, timeout):
+        """Sleeps until a child exits, a worker finishes or timeout."""
+        try:
+            readable, _, _ = select.select([self._wakeup_r], [], [],
+                                           max(0, timeout))
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if readable:
+            try:
+                while os.read(self._wakeup_r, 4096):
+                    pass
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+    def _next_lease_time(self):
+        """Returns the earliest time at which the next lease may be sent.
+
+        Mirrors the sleep in _sleep_before_next_lease() and the limit in
+        _is_rate_exceeded(), without blocking.
+        """
+        if not self._last_lease_time:
+            return 0
+        next_time = 0
+        if self._num_last_leased_tasks <= 0:
+            next_time = self._last_lease_time + FLAGS.sleep_interval_secs
+        if FLAGS.taskapi_requests_per_sec:
+            next_time = max(next_time, self._last_lease_time + (
+                1.0 * (self._num_last_leased_tasks -
+                       len(self._task_table)) /
+                FLAGS.taskapi_requests_per_sec))
+        return next_time
+
+    def _ready_to_lease(self):
+        return (not self._lease_in_flight and
+                self._num_tasks_to_lease() > 0 and
+                time.time() >= self._next_lease_time())
+
+    def lease_tasks(self):
+        """Sends a lease request on a worker thread if one is due.
+
+        Returns:
+            True/False based on if a lease request was sent.
+        """
+        if not self._lease_wanted or not self._ready_to_lease():
+            return False
+        self._lease_wanted = False
+        self._lease_in_flight = True
+        self._workers.submit(self._get_tasks_from_queue).kind = _LEASE
+        return True
+
+    def _add_running_task(self, task):
+        TaskQueuePuller._add_running_task(self, task)
+        if (task.get_pid() is None and not task.is_waiting_for_batch() and
+                not task.is_fetching()):
+            # Answered from the output cache, there is no child to wait for.
+            self._submit_completion(task)
+
+    def _submit_completion(self, task):
+        self._completing.add(task.get_task_id())
+        item = self._workers.submit(task.is_completed, self.task_api)
+        item.kind = _COMPLETE
+        item.task = task
+
+    def _reap_children(self):
+        """Collects exited children and hands their tasks to the workers."""
+        for task in self._task_table.reap_children():
+            self._submit_completion(task)
+
+    def _handle_due_tasks(self):
+        """Kills the timed out tasks, restarts the due retries and starts
+        the tasks whose input was fetched.
+
+        Runs on the main thread, so that a started child is in the task
+        table before it can be reaped.
+        """
+        for task in self._task_table.pop_due(time.time()):
+            self._check_on_main_thread(task)
+        for task in self._pop_fetched_tasks():
+            self._check_on_main_thread(task)
+
+    def _check_on_main_thread(self, task):
+        task_id = task.get_task_id()
+        if task_id in self._completing:
+            return
+        self._retrying.discard(task_id)
+        # A timed out child is killed, and must not be reaped as if it had
+        # exited by itself.
+        self._task_table.untrack_pid(task.get_pid())
+        if task.is_completed(self.task_api):
+            self._remove_task(task_id)
+        else:
+            self._task_table.track(task)
+
+    def _remove_task(self, task_id):
+        self._completing.discard(task_id)
+        self._retrying.discard(task_id)
+        task = self._task_table.get(task_id)
+        if task is not None:
+            self._remove_running_task(task)
+
+    def _process_done_work(self):
+        """Applies the outcome of the calls finished by the workers."""
+        while True:
+            try:
+                item = self._done.get_nowait()
+            except Queue.Empty:
+                return
+            if item.kind == _LEASE:
+                self._lease_in_flight = False
+                self._update_last_lease_info(item.result)
+                self._create_subprocesses_for_tasks(item.result)
+            elif item.kind == _COMPLETE:
+                task_id = item.task.get_task_id()
+                if (item.error is None and not item.result and
+                        item.task.get_retry_time() is not None):
+                    self._completing.discard(task_id)
+                    self._retrying.add(task_id)
+                    self._task_table.track(item.task)
+                else:
+                    self._remove_task(task_id)
+
+    def _wait_before_next_poll(self, timeout):
+        self._wait_for_events(timeout)
+
+    def _has_pending_work(self):
+        return bool(self._task_table) or self._lease_in_flight
+
+    def _abandon_running_tasks(self):
+        """Kills the running tasks and cancels their leases.
+
+        Tasks which have already finished and are being posted and acked by
+        a worker are left alone; _flush_pending_acks() waits for them.
+        """
+        for task_id, task in self._task_table.items():
+            if task_id not in self._completing:
+                task.abandon(self.task_api)
+                self._remove_running_task(task)
+
+    def _flush_pending_acks(self, timeout):
+        """Waits up to timeout seconds for the workers to finish acking."""
+        deadline = time.time() + timeout
+        while self._completing and time.time() < deadline:
+            self._wait_for_events(deadline - time.time())
+            self._process_done_work()
+        if self._completing:
+            logger.error('Gave up waiting for %d tasks to be acked'
+                         % len(self._completing))
+
+    def _poll_running_tasks(self):
+        self._maybe_reload_tuning()
+        self._maybe_autoscale()
+        self._reap_children()
+        self._process_done_work()
+        for task in self._start_due_batches():
+            self._submit_completion(task)
+        self._handle_due_tasks()
+
+    def poll_tasks(self):
+        """Handles task and API events until the next lease is due.
+
+        Unlike TaskQueuePuller.poll_tasks() this never sleeps for a fixed
+        interval; it waits for the next event, bounded by the time at which
+        a lease becomes due, the next task timeout or retry, and
+        sleep_before_next_poll_secs.
+        """
+        self._poll_running_tasks()
+        while not self._shutting_down:
+            if (not self._lease_wanted and not self._lease_in_flight and
+                    not self._continue_polling()):
+                self._lease_wanted = True
+            timeout = FLAGS.sleep_before_next_poll_secs
+            wakeup_time = self._get_next_wakeup_time()
+            if wakeup_time is not None:
+                timeout = min(timeout, wakeup_time - time.time())
+            if self._lease_wanted:
+                if self._ready_to_lease():
+                    return
+                timeout = min(timeout,
+                              self._next_lease_time() - time.time())
+            self._wait_for_events(timeout)
+            self._poll_running_tasks()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Background thread running the periodic jobs of the puller.
+
+Calling the prepoll URL, logging statistics, refreshing the access token
+before it expires and removing stale temporary files are not part of
+leasing and running tasks, and none of them should hold the lease and poll
+loop up: a prepoll endpoint which hangs used to freeze the whole worker.
+Housekeeper runs them on one thread of its own instead, each at its
+interval with some jitter, so that workers started together do not call
+the same endpoints in step.
+
+A job which raises is logged and counted as a failure and runs again at its
+next interval. The number of runs and failures and the time spent in each
+job are kept per job and logged with the puller statistics.
+"""
+
+
+
+import errno
+import heapq
+import itertools
+import os
+import random
+import stat
+import tempfile
+import threading
+import time
+from gtaskqueue.taskqueue_logger import logger
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_float(
+        'housekeeping_jitter',
+        0.1,
+        'Fraction of its interval by which the run of a housekeeping job is '
+        'randomly moved earlier or later.')
+flags.DEFINE_float(
+        'prepoll_timeout_secs',
+        10,
+        'Timeout of the call to --prepoll_url.')
+flags.DEFINE_float(
+        'credentials_refresh_margin_secs',
+        300,
+        'Refresh the access token in the background when it expires within '
+        'this many seconds, so that API calls do not wait for the refresh. '
+        '0 disables the early refresh.')
+flags.DEFINE_float(
+        'credentials_check_interval_secs',
+        60,
+        'Interval at which the expiry of the access token is checked.')
+flags.DEFINE_float(
+        'tempfile_gc_interval_secs',
+        3600,
+        'Interval at which temporary task files left behind by crashed '
+        'pullers are removed.')
+flags.DEFINE_float(
+        'tempfile_max_age_secs',
+        24 * 3600,
+        'Age after which a temporary task file no running task holds is '
+        'removed, once the puller which created it is gone.')
+
+
+class _Job(object):
+    """A periodic job and the statistics of its runs."""
+
+    def __init__(self, name, interval_secs, fn):
+        self.name = name
+        self.interval_secs = interval_secs
+        self.fn = fn
+        self.num_runs = 0
+        self.num_failures = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+        self.last_error = None
+
+
+class Housekeeper(object):
+    """Runs periodic jobs on a background thread."""
+
+    def __init__(self, jitter=None):
+        """Constructor.
+
+        Args:
+            jitter: fraction of the interval by which each run is randomly
+                moved, defaults to --housekeeping_jitter.
+        """
+        if jitter is None:
+            jitter = FLAGS.housekeeping_jitter
+        self._jitter = min(1.0, max(0.0, jitter))
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self._jobs = []
+        # (next run time, sequence number, job) entries in time order; the
+        # sequence number orders jobs due at the same time.
+        self._schedule = []
+        self._sequence = itertools.count()
+
+    def add_job(self, name, interval_secs, fn):
+        """Runs fn every interval_secs, the first time after one interval.
+
+        Args:
+            name: name of the job in the logs and statistics.
+            interval_secs: interval between two runs.
+            fn: callable taking no argument.
+        """
+        job = _Job(name, interval_secs, fn)
+        with self._cond:
+            self._jobs.append(job)
+            self._schedule_locked(job, time.time())
+            self._cond.notify()
+
+    def _schedule_locked(self, job, now):
+        interval = job.interval_secs * random.uniform(1 - self._jitter,
+                                                      1 + self._jitter)
+        heapq.heappush(self._schedule,
+                       (now + interval, next(self._sequence), job))
+
+    def start(self):
+        """Starts the background thread running the jobs."""
+        self._thread = threading.Thread(target=self._run,
+                                        name='housekeeping')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the background thread.
+
+        Args:
+            timeout: time to wait for a job which is running to return. A
+                job still running after that is left to finish on its
+                daemon thread.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._schedule:
+                        timeout = self._schedule[0][0] - time.time()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+                if self._stopped:
+                    return
+                job = heapq.heappop(self._schedule)[2]
+            self._run_job(job)
+            with self._cond:
+                self._schedule_locked(job, time.time())
+
+    def _run_job(self, job):
+        start_time = time.time()
+        try:
+            job.fn()
+            job.last_error = None
+        except Exception, error:
+            job.num_failures += 1
+            job.last_error = str(error)
+            logger.error('Housekeeping job %s failed. Error details %s'
+                         % (job.name, job.last_error))
+        duration = time.time() - start_time
+        job.num_runs += 1
+        job.total_secs += duration
+        job.max_secs = max(job.max_secs, duration)
+
+    def get_stats_message(self):
+        with self._cond:
+            jobs = list(self._jobs)
+        parts = []
+        for job in jobs:
+            mean = 0
+            if job.num_runs:
+                mean = job.total_secs / job.num_runs
+            part = ('%s %d runs, %d failed, mean %.3fs, max %.3fs'
+                    % (job.name, job.num_runs, job.num_failures, mean,
+                       job.max_secs))
+            if job.last_error:
+                part += ' (last error: %s)' % job.last_error
+            parts.append(part)
+        return 'Housekeeping: %s' % '; '.join(parts)
+
+
+def call_prepoll_url(url, timeout_secs):
+    """GETs url, raising on a connection error, timeout or error status."""
+    import requests
+    requests.get(url, timeout=timeout_secs).raise_for_status()
+
+
+def remove_stale_tempfiles(prefix, max_age_secs, in_use=(), directory=None):
+    """Removes the old temporary files left behind by pullers.
+
+    The files are named prefix<pid>-..., after the puller which created
+    them. As the temporary directory may be shared by several pullers, the
+    files of another puller are only removed once that puller is gone; those
+    named otherwise are never removed.
+
+    Args:
+        prefix: prefix of the names of the files to remove.
+        max_age_secs: files modified more recently are kept.
+        in_use: paths which are kept whatever their age.
+        directory: directory of the files, defaults to the temporary
+            directory.
+
+    Returns:
+        The number of files removed.
+    """
+    directory = directory or tempfile.gettempdir()
+    deadline = time.time() - max_age_secs
+    in_use = set(in_use)
+    # Whether the puller of each pid is gone, looked up once per pid.
+    gone = {os.getpid(): True}
+    num_removed = 0
+    for name in os.listdir(directory):
+        if not name.startswith(prefix):
+            continue
+        pid = name[len(prefix):].split('-', 1)[0]
+        if not pid.isdigit():
+            continue
+        pid = int(pid)
+        if pid not in gone:
+            gone[pid] = not _is_process_alive(pid)
+        if not gone[pid]:
+            continue
+        path = os.path.join(directory, name)
+        if path in in_use:
+            continue
+        try:
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode) and st.st_mtime < deadline:
+                os.remove(path)
+                num_removed += 1
+        except OSError:
+            # Removed by its task in the meantime.
+            pass
+    if num_removed:
+        logger.info('Removed %d stale temporary files from %s'
+                    % (num_removed, directory))
+    return num_removed
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        # EPERM: alive, but run by another user.
+        return e.errno != errno.ESRCH
+    return True
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Thread-safe pool of authorized HTTP transports.
+
+httplib2.Http is not thread-safe, so a single authorized instance can only
+be used from one thread at a time. AuthorizedHttpPool keeps a bounded set of
+keep-alive httplib2.Http transports, hands one out to each calling thread for
+the duration of a request and closes the ones that have been idle for too
+long.
+
+All transports share one credentials object. The access token is applied to
+each request by the pool itself rather than by credentials.authorize(), so
+that when the token expires (or the server answers 401) exactly one thread
+refreshes it and every other connection picks up the new token.
+
+Failed calls are retried by the pool with the policy of http_retry, and
+fail at once with a synthetic 503 while its circuit breaker is open, so
+that the callers only see the errors which retries did not overcome. The
+retries sleep on the calling thread; a caller which must not block, or
+which retries by itself, can have some calls attempted only once (see
+set_single_attempt()).
+
+The pool has the same request() method as httplib2.Http, so it can be passed
+as the http argument of apiclient.discovery.build() or of StaticTaskApi.
+"""
+
+
+
+import datetime
+import httplib
+import json
+import socket
+import sys
+import threading
+import time
+from gtaskqueue.http_retry import CircuitBreaker
+from gtaskqueue.http_retry import RetryPolicy
+from gtaskqueue.http_retry import get_retry_after
+from gtaskqueue.taskqueue_logger import logger
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+        'http_pool_size',
+        4,
+        'Maximum number of HTTP connections used for API calls.')
+flags.DEFINE_float(
+        'http_pool_idle_secs',
+        60,
+        'Close pooled HTTP connections which have been idle this long.')
+
+# Status codes which mean the access token needs to be refreshed.
+REFRESH_STATUS_CODES = (401,)
+
+# Same as httplib2.DEFAULT_MAX_REDIRECTS, without importing httplib2 here.
+DEFAULT_MAX_REDIRECTS = 5
+
+
+class AuthorizedHttpPool(object):
+    """Bounded pool of keep-alive transports sharing one credential."""
+
+    def __init__(self, credentials, http_factory, max_size=None,
+                 idle_secs=None, retry_policy=None, breaker=None):
+        """Constructor.
+
+        Args:
+            credentials: oauth2client credentials shared by all transports.
+            http_factory: callable returning a new, unauthorized
+                httplib2.Http or something that acts like it.
+            max_size: maximum number of transports, defaults to
+                --http_pool_size.
+            idle_secs: idle time after which a transport is closed, defaults
+                to --http_pool_idle_secs.
+            retry_policy: RetryPolicy of the calls, by default built from
+                the flags.
+            breaker: CircuitBreaker of the calls, by default built from the
+                flags.
+        """
+        self._credentials = credentials
+        self._http_factory = http_factory
+        self._max_size = max(1, max_size or FLAGS.http_pool_size)
+        if idle_secs is None:
+            idle_secs = FLAGS.http_pool_idle_secs
+        self._idle_secs = idle_secs
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        # (last used time, transport) tuples, most recently used last.
+        self._idle = []
+        self._num_transports = 0
+        self._refresh_lock = threading.Lock()
+        self._local = threading.local()
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._breaker = breaker or CircuitBreaker()
+        self._single_attempt_thread = None
+        self._single_attempt_operations = ()
+        self.num_retries = 0
+
+    def get_credentials(self):
+        return self._credentials
+
+    def set_single_attempt(self, thread=None, operations=()):
+        """Makes some calls fail at once instead of being retried.
+
+        Args:
+            thread: thread whose calls are attempted once, eg. the main loop
+                of the puller, which must not sleep between attempts.
+            operations: operations attempted once on every thread, eg.
+                acknowledge when failed acks are retried by an AckRetryQueue.
+        """
+        self._single_attempt_thread = thread
+        self._single_attempt_operations = tuple(operations)
+
+    def size(self):
+        """Returns the number of open transports."""
+        with self._lock:
+            return self._num_transports
+
+    def checkout(self):
+        """Takes a transport out of the pool, blocking while all are busy.
+
+        Returns:
+            httplib2.Http like object, to be handed back with checkin().
+        """
+        with self._available:
+            while True:
+                self._evict_idle_locked()
+                if self._idle:
+                    return self._idle.pop()[1]
+                if self._num_transports < self._max_size:
+                    self._num_transports += 1
+                    break
+                self._available.wait()
+        try:
+            return self._http_factory()
+        except:
+            with self._available:
+                self._num_transports -= 1
+                self._available.notify()
+            raise
+
+    def checkin(self, http):
+        """Returns a transport taken with checkout() to the pool."""
+        with self._available:
+            self._idle.append((time.time(), http))
+            self._available.notify()
+
+    def close(self):
+        """Closes all idle transports."""
+        with self._available:
+            idle, self._idle = self._idle, []
+            self._num_transports -= len(idle)
+            self._available.notify_all()
+        for _, http in idle:
+            _close_transport(http)
+
+    def _evict_idle_locked(self):
+        """Closes transports idle for longer than idle_secs.
+
+        Must be called with the lock held. The oldest transports are at the
+        front of the idle list.
+        """
+        if not self._idle_secs:
+            return
+        deadline = time.time() - self._idle_secs
+        num_expired = 0
+        while (num_expired < len(self._idle) and
+               self._idle[num_expired][0] < deadline):
+            num_expired += 1
+        if num_expired:
+            expired = self._idle[:num_expired]
+            del self._idle[:num_expired]
+            self._num_transports -= num_expired
+            logger.debug('Closing %d idle HTTP connections' % num_expired)
+            for _, http in expired:
+                _close_transport(http)
+
+    def refresh_credentials(self, http, stale_token):
+        """Refreshes the shared access token unless already done.
+
+        Args:
+            http: transport to use for the refresh request.
+            stale_token: the access token the caller found to be invalid. If
+                another thread has replaced it in the meantime, no refresh
+                is needed.
+        """
+        with self._refresh_lock:
+            if self._credentials.access_token == stale_token:
+                logger.info('Refreshing access token')
+                self._credentials.refresh(http)
+
+    def refresh_credentials_if_expiring(self, margin_secs):
+        """Refreshes the access token if it expires within margin_secs.
+
+        Meant to be called periodically from a background thread, so that
+        the refresh happens before the token expires instead of on the
+        first API call which finds it expired.
+
+        Returns:
+            True if the token was refreshed.
+        """
+        token = self._credentials.access_token
+        expiry = getattr(self._credentials, 'token_expiry', None)
+        if token is not None:
+            if expiry is None:
+                return False
+            # oauth2client keeps the expiry as a naive UTC datetime.
+            remaining = expiry - datetime.datetime.utcnow()
+            if remaining > datetime.timedelta(seconds=margin_secs):
+                return False
+        http = self.checkout()
+        try:
+            self.refresh_credentials(http, token)
+        finally:
+            self.checkin(http)
+        return True
+
+    def _authorize(self, http, headers):
+        """Adds the Authorization header, refreshing the token if needed.
+
+        Returns:
+            The access token that was applied.
+        """
+        token = self._credentials.access_token
+        if token is None or self._credentials.access_token_expired:
+            self.refresh_credentials(http, token)
+        self._credentials.apply(headers)
+        user_agent = getattr(self._credentials, 'user_agent', None)
+        if user_agent:
+            if 'user-agent' in headers:
+                headers['user-agent'] = (user_agent + ' ' +
+                                         headers['user-agent'])
+            else:
+                headers['user-agent'] = user_agent
+        return self._credentials.access_token
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=DEFAULT_MAX_REDIRECTS, connection_type=None):
+        """Authorized httplib2.Http.request() on a pooled transport.
+
+        Failed attempts are retried as the retry policy allows, without
+        holding a transport during the delays, unless the call is to be
+        attempted once. While the circuit breaker is open, a synthetic 503
+        response is returned and nothing is sent.
+
+        Raises:
+            The connection error of the last attempt, if it raised one.
+        """
+        call = self._retry_policy.start(uri, method)
+        while True:
+            if not self._breaker.allow():
+                return _make_breaker_response(
+                    self._breaker.get_remaining_secs())
+            resp = content = error = None
+            try:
+                resp, content = self._attempt(uri, method, body, headers,
+                                              redirections, connection_type)
+            except get_transport_errors(), error:
+                exc_info = sys.exc_info()
+            failed = self._retry_policy.is_failure(resp, error)
+            self._breaker.record(failed, get_retry_after(resp))
+            delay = None
+            if failed and self._may_retry(call):
+                delay = call.next_delay(resp, error)
+            if delay is None:
+                if error is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                return resp, content
+            self.num_retries += 1
+            logger.warn('Retrying %s call in %.1fs after %s (attempt %d)'
+                        % (call.operation, delay,
+                           error or 'status %s' % resp.status,
+                           call.num_attempts))
+            time.sleep(delay)
+
+    def _may_retry(self, call):
+        if call.operation in self._single_attempt_operations:
+            return False
+        thread = self._single_attempt_thread
+        return thread is None or threading.current_thread() is not thread
+
+    def _attempt(self, uri, method, body, headers, redirections,
+                 connection_type):
+        """Makes one attempt of a call on a pooled transport.
+
+        A thread which makes a nested request (eg. from within a response
+        callback) reuses the transport it already holds instead of taking a
+        second one, so a full pool can not deadlock on itself.
+        """
+        http = getattr(self._local, 'http', None)
+        if http is not None:
+            return self._request(http, uri, method, body, headers,
+                                 redirections, connection_type)
+        http = self.checkout()
+        self._local.http = http
+        try:
+            return self._request(http, uri, method, body, headers,
+                                 redirections, connection_type)
+        except:
+            # The connection may be broken; the next use reconnects.
+            _close_transport(http)
+            raise
+        finally:
+            self._local.http = None
+            self.checkin(http)
+
+    def _request(self, http, uri, method, body, headers, redirections,
+                 connection_type):
+        request_headers = dict(headers or {})
+        token = self._authorize(http, request_headers)
+        resp, content = http.request(uri, method, body, request_headers,
+                                     redirections, connection_type)
+        if resp.status in REFRESH_STATUS_CODES:
+            logger.info('Access token rejected with status %s' % resp.status)
+            self.refresh_credentials(http, token)
+            request_headers = dict(headers or {})
+            self._authorize(http, request_headers)
+            resp, content = http.request(uri, method, body, request_headers,
+                                         redirections, connection_type)
+        return resp, content
+
+    def get_stats_message(self):
+        return 'API calls: %d retries; %s' % (
+            self.num_retries, self._breaker.get_stats_message())
+
+
+def get_transport_errors():
+    """Returns the exceptions raised when a call could not be made."""
+    errors = (socket.error, httplib.HTTPException)
+    httplib2 = sys.modules.get('httplib2')
+    if httplib2 is not None:
+        errors += (httplib2.HttpLib2Error,)
+    return errors
+
+
+def _make_breaker_response(remaining_secs):
+    """Returns the 503 response of a call failed by the circuit breaker."""
+    import httplib2
+    resp = httplib2.Response({
+        'status': '503',
+        'retry-after': '%d' % max(1, round(remaining_secs)),
+        'content-type': 'application/json',
+    })
+    resp.reason = 'Circuit breaker open'
+    content = json.dumps({'error': {
+        'code': 503,
+        'message': 'Circuit breaker open for %.1fs after repeated API '
+                   'failures; the call was not sent' % remaining_secs,
+        'status': 'UNAVAILABLE',
+    }})
+    return resp, content
+
+
+def _close_transport(http):
+    """Closes the keep-alive connections held by an httplib2.Http."""
+    for connection in getattr(http, 'connections', {}).values():
+        try:
+            connection.close()
+        except Exception:
+            pass
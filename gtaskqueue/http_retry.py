@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Retry policy and circuit breaker for the API calls.
+
+Every API call of the puller and of the command-line tool goes through
+AuthorizedHttpPool, which retries failed calls with this policy before the
+caller sees an HttpError. Failures are classified as:
+  - rejected: 429, 503 and 408 mean that the server did not process the
+    call, which is retried whatever its method;
+  - unknown outcome: other 5xx statuses and connection errors, which are
+    retried only for calls which are safe to repeat: GET, PUT, DELETE and
+    the acknowledge, renewLease and cancelLease task methods (a repeated ack
+    fails harmlessly). A lease is not: the tasks of a lost response would
+    stay leased to nobody until their lease expires, so it is left to the
+    next poll;
+  - permanent: any other status, which is returned at once.
+
+A Retry-After header is honoured. Otherwise the delay before the next
+attempt is drawn with decorrelated jitter, uniformly between the base delay
+and three times the previous delay, up to --http_retry_max_delay_secs, so
+that pullers which failed together do not retry in step. The attempts of
+one call stop after --http_retry_max_attempts or once the next delay would
+go past the time budget of its operation (--http_retry_budget_secs), eg.
+short for lease, which is better sent again at the next poll, and longer
+for acknowledge, whose failure means running the task again. The retries
+sleep on the calling thread, so the puller has the calls of its main loop,
+and its acks, attempted once (see AuthorizedHttpPool.set_single_attempt()).
+
+The circuit breaker counts consecutive failed attempts across all calls.
+After --http_breaker_threshold of them it opens for --http_breaker_open_secs
+(or longer, if a Retry-After asks for it): calls then fail at once with a
+synthetic 503 instead of adding to the load of an API which is down. Once
+the open time has passed, one trial call is let through; its success closes
+the breaker and its failure opens it again.
+"""
+
+
+
+import random
+import threading
+import time
+import urlparse
+from email.utils import parsedate_tz
+from email.utils import mktime_tz
+from gtaskqueue.taskqueue_logger import logger
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+        'http_retry_max_attempts',
+        6,
+        'Highest number of attempts of one API call, 1 for no retries.')
+flags.DEFINE_float(
+        'http_retry_base_delay_secs',
+        0.5,
+        'Shortest delay before retrying a failed API call.')
+flags.DEFINE_float(
+        'http_retry_max_delay_secs',
+        30,
+        'Longest delay between two attempts of an API call, unless the '
+        'server asks for more with Retry-After.')
+flags.DEFINE_string(
+        'http_retry_budget_secs',
+        'lease=10,acknowledge=120,default=60',
+        'Time the retries of one API call may take, by operation: the task '
+        'method (eg. lease, acknowledge) or else the HTTP method (eg. GET), '
+        'as comma separated operation=secs pairs; "default" applies to the '
+        'other operations.')
+flags.DEFINE_integer(
+        'http_breaker_threshold',
+        10,
+        'Consecutive failed API attempts after which calls fail at once '
+        'for --http_breaker_open_secs. 0 disables the circuit breaker.')
+flags.DEFINE_float(
+        'http_breaker_open_secs',
+        30,
+        'Time for which API calls fail at once once the circuit breaker '
+        'has opened.')
+
+# Statuses meaning that the server did not process the call.
+REJECTED_STATUS_CODES = (408, 429, 503)
+
+# Statuses after which the call may or may not have been processed.
+UNKNOWN_OUTCOME_STATUS_CODES = (500, 502, 504)
+
+# HTTP methods which may be repeated without changing the outcome.
+_IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+# Task methods, sent as POSTs, which are safe to repeat.
+_RETRY_SAFE_ACTIONS = ('acknowledge', 'renewLease', 'cancelLease')
+
+_DEFAULT_OPERATION = 'default'
+
+
+def parse_budgets(spec):
+    """Parses --http_retry_budget_secs.
+
+    Returns:
+        Dict of the time budget in seconds by operation.
+
+    Raises:
+        ValueError: if spec is malformed.
+    """
+    budgets = {}
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        (operation, sep, secs) = entry.partition('=')
+        if not sep or not operation.strip():
+            raise ValueError('Expected operation=secs, got %r' % entry)
+        budgets[operation.strip()] = float(secs)
+    budgets.setdefault(_DEFAULT_OPERATION, 60.0)
+    return budgets
+
+
+def get_operation(uri, method):
+    """Returns the task method of a call, else its HTTP method."""
+    path = urlparse.urlparse(uri).path
+    last_segment = path.rsplit('/', 1)[-1]
+    if ':' in last_segment:
+        return last_segment.rsplit(':', 1)[1]
+    return method.upper()
+
+
+def get_retry_after(resp):
+    """Returns the delay asked for by a Retry-After header, None if none.
+
+    The header holds either a number of seconds or an HTTP date.
+    """
+    value = resp.get('retry-after') if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, mktime_tz(parsed) - time.time())
+
+
+class RetryPolicy(object):
+    """Decides whether and when a failed API call is attempted again."""
+
+    def __init__(self, max_attempts=None, base_delay_secs=None,
+                 max_delay_secs=None, budgets=None):
+        """Constructor; every argument defaults to its flag."""
+        if max_attempts is None:
+            max_attempts = FLAGS.http_retry_max_attempts
+        if base_delay_secs is None:
+            base_delay_secs = FLAGS.http_retry_base_delay_secs
+        if max_delay_secs is None:
+            max_delay_secs = FLAGS.http_retry_max_delay_secs
+        if budgets is None:
+            budgets = parse_budgets(FLAGS.http_retry_budget_secs)
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay_secs = base_delay_secs
+        self.max_delay_secs = max(base_delay_secs, max_delay_secs)
+        self._budgets = budgets
+
+    def start(self, uri, method):
+        """Returns the retry state of a new call."""
+        operation = get_operation(uri, method)
+        budget = self._budgets.get(operation,
+                                   self._budgets[_DEFAULT_OPERATION])
+        safe = (method.upper() in _IDEMPOTENT_METHODS or
+                operation in _RETRY_SAFE_ACTIONS)
+        return _CallState(self, operation, budget, safe)
+
+    def is_failure(self, resp, error):
+        """Returns True if an attempt failed in a way that may pass."""
+        if error is not None:
+            return True
+        return (resp.status in REJECTED_STATUS_CODES or
+                resp.status in UNKNOWN_OUTCOME_STATUS_CODES)
+
+
+class _CallState(object):
+    """Attempts of one call."""
+
+    def __init__(self, policy, operation, budget_secs, safe):
+        self.operation = operation
+        self.num_attempts = 0
+        self._policy = policy
+        self._deadline = time.time() + budget_secs
+        self._safe = safe
+        self._delay = policy.base_delay_secs
+
+    def next_delay(self, resp, error):
+        """Returns the delay before the next attempt, None to stop.
+
+        Args:
+            resp: response of the last attempt, None if it raised.
+            error: exception raised by the last attempt, if any.
+        """
+        self.num_attempts += 1
+        if not self._may_retry(resp, error):
+            return None
+        if self.num_attempts >= self._policy.max_attempts:
+            return None
+        delay = get_retry_after(resp)
+        if delay is None:
+            # Decorrelated jitter.
+            self._delay = min(self._policy.max_delay_secs,
+                              random.uniform(self._policy.base_delay_secs,
+                                             self._delay * 3))
+            delay = self._delay
+        if time.time() + delay > self._deadline:
+            return None
+        return delay
+
+    def _may_retry(self, resp, error):
+        if error is None and resp.status in REJECTED_STATUS_CODES:
+            return True
+        if error is not None or resp.status in UNKNOWN_OUTCOME_STATUS_CODES:
+            return self._safe
+        return False
+
+
+class CircuitBreaker(object):
+    """Fails calls at once while the API keeps failing."""
+
+    def __init__(self, threshold=None, open_secs=None):
+        """Constructor; both arguments default to their flag."""
+        if threshold is None:
+            threshold = FLAGS.http_breaker_threshold
+        if open_secs is None:
+            open_secs = FLAGS.http_breaker_open_secs
+        self._threshold = threshold
+        self._open_secs = open_secs
+        self._lock = threading.Lock()
+        self._num_failures = 0
+        # Time until which the breaker is open, None while closed.
+        self._open_until = None
+        self._trial_in_flight = False
+        self.num_opened = 0
+        self.num_rejected = 0
+
+    def allow(self):
+        """Returns True if a call may be attempted now.
+
+        Once the open time has passed, a single trial call is allowed until
+        its outcome is recorded.
+        """
+        if not self._threshold:
+            return True
+        with self._lock:
+            if self._open_until is None:
+                return True
+            if time.time() >= self._open_until and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self.num_rejected += 1
+            return False
+
+    def get_remaining_secs(self):
+        """Returns the time until the breaker lets a call through."""
+        with self._lock:
+            if self._open_until is None:
+                return 0
+            return max(0, self._open_until - time.time())
+
+    def record(self, failed, retry_after=None):
+        """Records the outcome of an attempt.
+
+        Args:
+            failed: True if the attempt failed in a way that may pass.
+            retry_after: delay asked for by the server, if any.
+        """
+        if not self._threshold:
+            return
+        with self._lock:
+            self._trial_in_flight = False
+            if not failed:
+                if self._open_until is not None:
+                    logger.info('API calls succeed again, closing the '
+                                'circuit breaker')
+                self._num_failures = 0
+                self._open_until = None
+                return
+            self._num_failures += 1
+            if (self._open_until is not None or
+                    self._num_failures >= self._threshold):
+                open_secs = max(self._open_secs, retry_after or 0)
+                if self._open_until is None:
+                    self.num_opened += 1
+                    logger.error('%d API attempts failed in a row, failing '
+                                 'API calls for %.1fs'
+                                 % (self._num_failures, open_secs))
+                self._open_until = time.time() + open_secs
+
+    def get_stats_message(self):
+        with self._lock:
+            state = 'closed'
+            if self._open_until is not None:
+                state = 'open'
+            return ('Circuit breaker: %s, opened %d times, %d calls failed '
+                    'fast' % (state, self.num_opened, self.num_rejected))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Scales the number of concurrent tasks of the puller with the queue lag.
+
+The lag of a leased task is the time since it was created. The lease
+response carries the scheduleTime of the new lease, not the time the task
+became due, so createTime is the closest measure the API gives of how long
+the task waited; tasks enqueued with a delay look that much later.
+
+Every autoscale_interval_secs the controller looks at the largest lag seen
+in the leases of the interval, taken as 0 when a lease came back short,
+since the queue was then drained. Above target_lag_secs the number of
+concurrent tasks grows by a quarter, unless the host load per core is over
+max_load_per_core, where more tasks would only slow the running ones down.
+Below half the target, or when the host is overloaded, it shrinks by a
+tenth. It stays between min_num_tasks and max_num_tasks.
+
+The lag, the target and the current number of tasks are written as JSON to
+autoscale_status_file for an external autoscaler to add or remove hosts.
+"""
+
+
+
+import json
+import os
+import threading
+import time
+from gtaskqueue.taskqueue_logger import logger
+from gtaskqueue.utils import parse_timestamp
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_float(
+        'target_lag_secs',
+        0,
+        'Queue lag the puller adjusts its number of concurrent tasks to '
+        'hold, between --min_num_tasks and --max_num_tasks. 0 disables '
+        'autoscaling and --num_tasks tasks are run.')
+flags.DEFINE_integer(
+        'min_num_tasks',
+        1,
+        'Lowest number of concurrent tasks when autoscaling.')
+flags.DEFINE_integer(
+        'max_num_tasks',
+        0,
+        'Highest number of concurrent tasks when autoscaling. Defaults to '
+        '--num_tasks, which is also the initial number.')
+flags.DEFINE_float(
+        'max_load_per_core',
+        1.0,
+        'One minute load average per core above which autoscaling does not '
+        'add tasks, and removes some.')
+flags.DEFINE_float(
+        'autoscale_interval_secs',
+        10,
+        'Interval between two adjustments of the number of tasks.')
+flags.DEFINE_string(
+        'autoscale_status_file',
+        None,
+        'File the current lag, target and number of tasks are written to as '
+        'JSON at each adjustment.')
+
+# Relative steps by which the number of tasks grows and shrinks.
+_GROW_FACTOR = 0.25
+_SHRINK_FACTOR = 0.1
+
+
+def get_load_per_core():
+    """Returns the one minute load average per core, None if unknown."""
+    try:
+        return os.getloadavg()[0] / os.sysconf('SC_NPROCESSORS_ONLN')
+    except (OSError, ValueError):
+        return None
+
+
+class LagAutoscaler(object):
+    """Adjusts the number of concurrent tasks to hold a target queue lag."""
+
+    def __init__(self, num_tasks, min_num_tasks, max_num_tasks,
+                 target_lag_secs, interval_secs, status_file=None):
+        """Constructor.
+
+        Args:
+            num_tasks: initial number of concurrent tasks.
+            min_num_tasks: lowest number of concurrent tasks.
+            max_num_tasks: highest number of concurrent tasks.
+            target_lag_secs: queue lag to hold.
+            interval_secs: interval between two adjustments.
+            status_file: file the status is written to, if any.
+        """
+        if min_num_tasks < 1 or max_num_tasks < min_num_tasks:
+            raise ValueError('Expected 1 <= min_num_tasks <= max_num_tasks, '
+                             'got %d and %d' % (min_num_tasks, max_num_tasks))
+        self.num_tasks = min(max_num_tasks, max(min_num_tasks, num_tasks))
+        self._min_num_tasks = min_num_tasks
+        self._max_num_tasks = max_num_tasks
+        self._target_lag_secs = target_lag_secs
+        self._interval_secs = interval_secs
+        self._status_file = status_file
+        # Leases are made from worker threads in the event engine.
+        self._lock = threading.Lock()
+        self._max_lag = None
+        self._drained = False
+        self._last_update_time = time.time()
+        self.lag_secs = 0
+
+    def record_lease(self, num_requested, tasks):
+        """Records the lag of the tasks of a lease response."""
+        now = time.time()
+        lags = []
+        for task in tasks:
+            create_time = parse_timestamp(task.get('createTime'))
+            if create_time is not None:
+                lags.append(now - create_time)
+        with self._lock:
+            if lags:
+                self._max_lag = max(self._max_lag, max(lags))
+            if len(tasks) < num_requested:
+                self._drained = True
+
+    def set_max_num_tasks(self, max_num_tasks):
+        """Changes the highest number of concurrent tasks."""
+        self._max_num_tasks = max(self._min_num_tasks, max_num_tasks)
+        self.num_tasks = min(self.num_tasks, self._max_num_tasks)
+
+    def maybe_update(self, num_running):
+        """Adjusts num_tasks once per interval.
+
+        Args:
+            num_running: number of tasks running now.
+        """
+        now = time.time()
+        if now - self._last_update_time < self._interval_secs:
+            return
+        self._last_update_time = now
+        with self._lock:
+            (max_lag, drained) = (self._max_lag, self._drained)
+            self._max_lag = None
+            self._drained = False
+        if drained:
+            self.lag_secs = 0
+        elif max_lag is not None:
+            self.lag_secs = max_lag
+        load = get_load_per_core()
+        overloaded = load is not None and load > FLAGS.max_load_per_core
+        num_tasks = self.num_tasks
+        if overloaded or self.lag_secs < self._target_lag_secs / 2:
+            num_tasks -= max(1, int(num_tasks * _SHRINK_FACTOR))
+        elif (self.lag_secs > self._target_lag_secs and
+              num_running >= self.num_tasks):
+            # Only grow when the current tasks are all in use; otherwise
+            # the lag comes from somewhere else than concurrency.
+            num_tasks += max(1, int(num_tasks * _GROW_FACTOR))
+        num_tasks = min(self._max_num_tasks,
+                        max(self._min_num_tasks, num_tasks))
+        if num_tasks != self.num_tasks:
+            logger.info('Lag %.1fs (target %.1fs), load per core %s: running '
+                        'up to %d tasks instead of %d'
+                        % (self.lag_secs, self._target_lag_secs, load,
+                           num_tasks, self.num_tasks))
+            self.num_tasks = num_tasks
+        self._write_status(load, num_running)
+
+    def _write_status(self, load, num_running):
+        if not self._status_file:
+            return
+        status = {
+            'time': time.time(),
+            'lag_secs': self.lag_secs,
+            'target_lag_secs': self._target_lag_secs,
+            'num_tasks': self.num_tasks,
+            'min_num_tasks': self._min_num_tasks,
+            'max_num_tasks': self._max_num_tasks,
+            'num_running': num_running,
+            'load_per_core': load,
+        }
+        tmp_path = self._status_file + '.tmp'
+        try:
+            f = open(tmp_path, 'w')
+            try:
+                f.write(json.dumps(status, sort_keys=True) + '\n')
+            finally:
+                f.close()
+            os.rename(tmp_path, self._status_file)
+        except (IOError, OSError), error:
+            logger.error('Error writing autoscale status %s. Error details %s'
+                         % (self._status_file, str(error)))
+
+    def get_stats_message(self):
+        return ('Autoscaler: lag %.1fs, target %.1fs, running up to %d tasks'
+                % (self.lag_secs, self._target_lag_secs, self.num_tasks))
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs many tasks per invocation of the executable binary.
+
+For tasks which take milliseconds, starting one process per task costs more
+than the tasks themselves. With --batch_max_tasks, the puller instead
+queues the tasks it leases and runs them in batches: one invocation of
+--executable_binary is given an input manifest and an output manifest in
+place of the input and output files of a single task. The input manifest
+has one JSON object per line for each task of the batch:
+    {"task_id": "...", "input_file": "...", "output_file": "..."}
+and the binary writes one line per task to the output manifest:
+    {"task_id": "...", "exit_status": 0}
+Each task is then posted, acked, retried or given up on its own, as if it
+had run in a process of its own with that exit status. A task missing from
+the output manifest failed, with the exit status of the batch if that is
+not 0.
+
+A batch is started when it is full, when its oldest task has waited
+--batch_linger_secs, or when the puller can not lease any more tasks to
+fill it. It is killed, and all its tasks time out, after
+--task_timeout_secs. The number of tasks per batch adapts to the observed
+run time per task, so that batches take about --batch_target_secs.
+"""
+
+
+
+import json
+import os
+import signal
+import tempfile
+import time
+from gtaskqueue.client_task import get_tempfile_prefix
+from gtaskqueue.client_task import spawn_task_process
+from gtaskqueue.taskqueue_logger import logger
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+        'batch_max_tasks',
+        0,
+        'Run up to this many tasks in one invocation of --executable_binary, '
+        'which is then passed an input and an output manifest instead of an '
+        'input and an output file. 0 runs one process per task.')
+flags.DEFINE_float(
+        'batch_linger_secs',
+        1,
+        'Longest time a task waits for its batch to fill up.')
+flags.DEFINE_float(
+        'batch_target_secs',
+        10,
+        'Run time per batch to which the number of tasks per batch is '
+        'adapted, up to --batch_max_tasks. 0 always fills batches up to '
+        '--batch_max_tasks.')
+
+# Weight of the last batch in the estimate of the run time per task.
+_SMOOTHING = 0.3
+
+
+def is_enabled():
+    return FLAGS.batch_max_tasks > 0
+
+
+class BatchSizer(object):
+    """Adapts the number of tasks per batch to a target run time."""
+
+    def __init__(self, max_tasks, target_secs):
+        """Constructor.
+
+        Args:
+            max_tasks: highest number of tasks per batch, also the initial
+                number.
+            target_secs: run time per batch to aim for, 0 to keep batches
+                at max_tasks.
+        """
+        self.size = max_tasks
+        self._max_tasks = max_tasks
+        self._target_secs = target_secs
+        # Moving average of the run time per task, once a batch has run.
+        self._task_secs = None
+
+    def record_batch(self, num_tasks, run_secs):
+        """Updates the batch size with the run time of a finished batch.
+
+        The start-up cost of the binary is shared by the tasks of a batch,
+        so the time per task shrinks as batches grow, until the time of the
+        tasks themselves dominates.
+        """
+        if self._target_secs <= 0 or not num_tasks:
+            return
+        task_secs = run_secs / num_tasks
+        if self._task_secs is None:
+            self._task_secs = task_secs
+        else:
+            self._task_secs += _SMOOTHING * (task_secs - self._task_secs)
+        if self._task_secs > 0:
+            size = int(self._target_secs / self._task_secs)
+        else:
+            size = self._max_tasks
+        size = min(self._max_tasks, max(1, size))
+        if size != self.size:
+            logger.info('Batches take %.3fs per task: running up to %d tasks '
+                        'per batch instead of %d'
+                        % (self._task_secs, size, self.size))
+            self.size = size
+
+
+class _Batch(object):
+    """A batch process and the tasks it runs."""
+
+    def __init__(self, tasks, manifest_file, results_file, timeout_secs):
+        self.tasks = tasks
+        self.manifest_file = manifest_file
+        self.results_file = results_file
+        self.pid = None
+        self.start_time = None
+        self.deadline = None
+        self.timeout_secs = timeout_secs
+        self.timed_out = False
+
+
+class BatchRunner(object):
+    """Queues tasks and runs them in batches.
+
+    Tasks are added by ClientTask in micro-batch mode. The runner is only
+    used from the main thread of the puller; batch processes are reaped
+    through the task table like the processes of single tasks.
+    """
+
+    def __init__(self, task_table, max_tasks=None, linger_secs=None,
+                 target_secs=None):
+        """Constructor.
+
+        Args:
+            task_table: TaskTable of the puller, which reaps the batches.
+            max_tasks: highest number of tasks per batch, defaults to
+                --batch_max_tasks.
+            linger_secs: longest wait of a task for its batch to fill,
+                defaults to --batch_linger_secs.
+            target_secs: run time per batch to aim for, defaults to
+                --batch_target_secs.
+        """
+        if target_secs is None:
+            target_secs = FLAGS.batch_target_secs
+        if linger_secs is None:
+            linger_secs = FLAGS.batch_linger_secs
+        self._task_table = task_table
+        self._linger_secs = linger_secs
+        self._sizer = BatchSizer(max_tasks or FLAGS.batch_max_tasks,
+                                 target_secs)
+        # Tasks waiting for a batch, oldest first, and when the oldest was
+        # queued.
+        self._queue = []
+        self._queue_start_time = None
+        # Running batches by pid.
+        self._running = {}
+        self.num_batches = 0
+        self.num_batched_tasks = 0
+
+    def add(self, task):
+        """Queues a task for the next batch."""
+        if not self._queue:
+            self._queue_start_time = time.time()
+        self._queue.append(task)
+
+    def poll(self, now, can_lease=True):
+        """Kills the batches which timed out and starts the due ones.
+
+        Args:
+            now: current time.
+            can_lease: False if the puller can not lease more tasks, in
+                which case queued tasks do not wait for their batch to
+                fill.
+
+        Returns:
+            List of the tasks whose batch could not be started; they have
+            failed.
+        """
+        for batch in self._running.values():
+            if not batch.timed_out and now >= batch.deadline:
+                logger.info('Killing batch of %d tasks, since it has been '
+                            'running for long' % len(batch.tasks))
+                batch.timed_out = True
+                _kill_process_group(batch.pid)
+        failed = []
+        while self._queue and (
+                len(self._queue) >= self._sizer.size or not can_lease or
+                now - self._queue_start_time >= self._linger_secs):
+            tasks = self._queue[:self._sizer.size]
+            del self._queue[:len(tasks)]
+            self._queue_start_time = now
+            failed.extend(self._start(tasks))
+        return failed
+
+    def get_next_wakeup_time(self):
+        """Returns when a batch is due to start or time out, None if never."""
+        times = [batch.deadline for batch in self._running.values()
+                 if not batch.timed_out]
+        if self._queue:
+            times.append(self._queue_start_time + self._linger_secs)
+        if not times:
+            return None
+        return min(times)
+
+    def get_temp_files(self):
+        """Returns the paths of the manifests of the running batches."""
+        paths = []
+        for batch in self._running.values():
+            paths.extend((batch.manifest_file, batch.results_file))
+        return paths
+
+    def kill_all(self):
+        """Kills the running batches, on shutdown.
+
+        Their tasks are abandoned by the puller, so the batches are not
+        reaped; their manifests are removed here.
+        """
+        for batch in self._running.values():
+            _kill_process_group(batch.pid)
+            _remove_files(batch)
+        self._running.clear()
+
+    def _start(self, tasks):
+        """Writes the manifests of a batch and starts its process.
+
+        Returns:
+            The tasks, if the batch could not be started; none otherwise.
+        """
+        batch = _Batch(tasks, _make_temp_file(), _make_temp_file(),
+                       FLAGS.task_timeout_secs)
+        try:
+            f = open(batch.manifest_file, 'w')
+            try:
+                for task in tasks:
+                    (input_file, output_file) = task.get_temp_files()
+                    f.write(json.dumps({'task_id': task.get_task_id(),
+                                        'input_file': input_file,
+                                        'output_file': output_file}) + '\n')
+            finally:
+                f.close()
+            cmdline = FLAGS.executable_binary.split(' ')
+            cmdline.append(batch.manifest_file)
+            cmdline.append(batch.results_file)
+            cpus = set()
+            for task in tasks:
+                cpus.update(task.get_cpus() or ())
+            batch.pid = spawn_task_process(cmdline, sorted(cpus) or None)
+        except (IOError, OSError, ValueError), error:
+            logger.error('Error starting batch of %d tasks. Error details %s'
+                         % (len(tasks), str(error)))
+            _remove_files(batch)
+            for task in tasks:
+                task.set_batch_result(255)
+            return tasks
+        batch.start_time = time.time()
+        batch.deadline = batch.start_time + batch.timeout_secs
+        self._running[batch.pid] = batch
+        self._task_table.add_child(
+            batch.pid,
+            lambda status, rusage: self._on_exit(batch, status))
+        for task in tasks:
+            task.batch_started(batch.pid, batch.manifest_file)
+        self.num_batches += 1
+        self.num_batched_tasks += len(tasks)
+        return []
+
+    def _on_exit(self, batch, status):
+        """Hands the results of a reaped batch to its tasks.
+
+        Returns:
+            The tasks of the batch.
+        """
+        del self._running[batch.pid]
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        results = {}
+        if not batch.timed_out:
+            results = _read_results(batch)
+            self._sizer.record_batch(len(batch.tasks),
+                                     time.time() - batch.start_time)
+        _remove_files(batch)
+        missing_status = returncode or 1
+        for task in batch.tasks:
+            task.set_batch_result(
+                results.get(task.get_task_id(), missing_status),
+                timed_out=batch.timed_out)
+        return batch.tasks
+
+    def get_stats_message(self):
+        mean = 0
+        if self.num_batches:
+            mean = float(self.num_batched_tasks) / self.num_batches
+        return ('Micro-batches: %d run, %.1f tasks per batch, up to %d'
+                % (self.num_batches, mean, self._sizer.size))
+
+
+def _make_temp_file():
+    (fd, path) = tempfile.mkstemp(prefix=get_tempfile_prefix())
+    os.close(fd)
+    return path
+
+
+def _read_results(batch):
+    """Returns the exit status of each task by id, from the output manifest.
+
+    Lines which can not be parsed are skipped, so their tasks fail.
+    """
+    results = {}
+    try:
+        f = open(batch.results_file)
+    except IOError, io_error:
+        logger.error('Error reading batch output manifest %s. Error details '
+                     '%s' % (batch.results_file, str(io_error)))
+        return results
+    try:
+        for line in f:
+            try:
+                record = json.loads(line)
+                results[record['task_id']] = int(record['exit_status'])
+            except (ValueError, KeyError, TypeError):
+                logger.warn('Skipping bad line in batch output manifest: %r'
+                            % line)
+    finally:
+        f.close()
+    return results
+
+
+def _remove_files(batch):
+    for path in (batch.manifest_file, batch.results_file):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _kill_process_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError, os_error:
+        logger.error('Error killing batch process %d. Error details %s'
+                     % (pid, str(os_error)))
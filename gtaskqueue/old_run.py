@@ -25,10 +25,6 @@ import webbrowser
 import gflags
 from six.moves import input
 
-from oauth2client import client
-from oauth2client.tools import ClientRedirectHandler
-from oauth2client.tools import ClientRedirectServer
-
 
 FLAGS = gflags.FLAGS
 
@@ -84,6 +80,13 @@ def run(flow, storage, http=None):
   Returns:
     Credentials, the obtained credential.
   """
+  # oauth2client is only needed when we actually have to walk through the
+  # authorization flow, so keep it off the import path of the command line
+  # tools.
+  from oauth2client import client
+  from oauth2client.tools import ClientRedirectHandler
+  from oauth2client.tools import ClientRedirectServer
+
   logging.warning('This function, oauth2client.tools.run(), and the use of '
       'the gflags library are deprecated and will be removed in a future '
       'version of the library.')
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coalesces the outputs of many tasks into one POST.
+
+With --output_batch_url, the outputs of completed tasks are not posted one
+by one to output_url + task_id but queued, and a background thread posts
+them together as a multipart/mixed body once the batch holds
+output_batch_max_tasks outputs or output_batch_max_bytes bytes, or its
+oldest output has waited output_batch_linger_secs. Each part has the task id
+as its Content-ID and the output as its body.
+
+The handler answers with a JSON object mapping each task id to an HTTP
+status for its output, eg. {"t1": 200, "t2": 500}. A task is acked only if
+its output got a 2xx status; the outputs of a failed or timed out POST, and
+those missing from the response or without an integer status, count as not
+delivered and their tasks are redelivered when their leases expire.
+"""
+
+
+
+import json
+import threading
+import time
+import uuid
+from gtaskqueue.taskqueue_logger import logger
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+        'output_batch_url',
+        None,
+        'Post task outputs in batches to this url instead of one by one to '
+        'output_url. Disabled if not set.')
+flags.DEFINE_integer(
+        'output_batch_max_tasks',
+        100,
+        'Post a batch once it holds this many outputs.')
+flags.DEFINE_integer(
+        'output_batch_max_bytes',
+        1024 * 1024,
+        'Post a batch once its outputs add up to this many bytes.')
+flags.DEFINE_float(
+        'output_batch_linger_secs',
+        0.5,
+        'Post a batch once its oldest output has waited this long.')
+flags.DEFINE_float(
+        'output_batch_timeout_secs',
+        30,
+        'Timeout of the post of a batch, after which its outputs count as '
+        'not delivered. Keep it well under --lease_secs.')
+
+
+class OutputBatcher(object):
+    """Posts queued task outputs in batches from a background thread."""
+
+    def __init__(self, url, max_tasks, max_bytes, linger_secs, timeout_secs,
+                 get_headers=None):
+        """Constructor.
+
+        Args:
+            url: url the batches are posted to.
+            max_tasks: number of outputs which triggers a post.
+            max_bytes: size of the outputs which triggers a post.
+            linger_secs: time an output may wait for others.
+            timeout_secs: timeout of the post of a batch.
+            get_headers: optional callable returning extra headers for a
+                post to a url, eg. for authentication.
+        """
+        self._url = url
+        self._max_tasks = max_tasks
+        self._max_bytes = max_bytes
+        self._linger_secs = linger_secs
+        self._timeout_secs = timeout_secs
+        self._get_headers = get_headers
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        # (task id, output, callback) tuples of the batch being built.
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_start_time = None
+        self._stopping = False
+        self._num_posting = 0
+        self.num_batches = 0
+        self.num_outputs = 0
+        self._thread = threading.Thread(target=self._run,
+                                        name='output-batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, task_id, output, callback):
+        """Queues the output of a task.
+
+        Args:
+            task_id: id of the task.
+            output: output of the task.
+            callback: called with True or False once the output has been
+                delivered or not, on the batcher thread.
+        """
+        with self._changed:
+            if not self._batch:
+                self._batch_start_time = time.time()
+            self._batch.append((task_id, output, callback))
+            self._batch_bytes += len(output)
+            self._changed.notify()
+
+    def _is_full(self):
+        return (len(self._batch) >= self._max_tasks or
+                self._batch_bytes >= self._max_bytes)
+
+    def _take_batch(self):
+        """Waits for a batch to be due and takes it; None when stopped."""
+        with self._changed:
+            while True:
+                if self._batch and (self._stopping or self._is_full()):
+                    break
+                if self._batch:
+                    wait = (self._batch_start_time + self._linger_secs -
+                            time.time())
+                    if wait <= 0:
+                        break
+                    self._changed.wait(wait)
+                elif self._stopping:
+                    return None
+                else:
+                    self._changed.wait()
+            batch = self._batch[:self._max_tasks]
+            del self._batch[:len(batch)]
+            self._batch_bytes -= sum(len(output) for (_, output, _) in batch)
+            self._batch_start_time = time.time()
+            self._num_posting += 1
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch is None:
+                return
+            try:
+                self._post_and_complete(batch)
+            except Exception:
+                # A bad batch must not stop the batches after it.
+                logger.exception('Error handling a batch of %d outputs'
+                                 % len(batch))
+            finally:
+                with self._changed:
+                    self._num_posting -= 1
+                    self._changed.notify_all()
+
+    def _post_and_complete(self, batch):
+        """Posts a batch and calls back each of its tasks."""
+        statuses = self._post(batch)
+        for (task_id, _, callback) in batch:
+            status = statuses.get(task_id)
+            delivered = _is_success_status(status)
+            if not delivered:
+                logger.error('Output of task %s not delivered, status %s'
+                             % (task_id, status))
+            try:
+                callback(delivered)
+            except Exception:
+                logger.exception('Error completing task %s' % task_id)
+
+    def _post(self, batch):
+        """Posts a batch.
+
+        Returns:
+            Dict of the status of each output by task id, empty on error.
+        """
+        import urllib2
+        boundary = uuid.uuid4().hex
+        parts = []
+        for (task_id, output, _) in batch:
+            parts.append('--%s\r\nContent-Type: byte-array\r\n'
+                         'Content-ID: %s\r\nContent-Length: %d\r\n\r\n'
+                         % (boundary, task_id, len(output)))
+            parts.append(output)
+            parts.append('\r\n')
+        parts.append('--%s--\r\n' % boundary)
+        headers = {'Content-Type': 'multipart/mixed; boundary=%s' % boundary}
+        if self._get_headers:
+            headers.update(self._get_headers(self._url))
+        try:
+            response = urllib2.urlopen(
+                urllib2.Request(self._url, ''.join(parts), headers),
+                timeout=self._timeout_secs)
+            statuses = json.loads(response.read())
+        except Exception, error:
+            logger.error('Error posting a batch of %d outputs. Error details '
+                         '%s' % (len(batch), str(error)))
+            return {}
+        if not isinstance(statuses, dict):
+            logger.error('Unexpected response to a batch of outputs: %s'
+                         % str(statuses)[:200])
+            return {}
+        self.num_batches += 1
+        self.num_outputs += len(batch)
+        return statuses
+
+    def close(self, timeout):
+        """Posts the queued outputs and stops, waiting up to timeout secs.
+
+        Returns:
+            True if all the outputs have been posted.
+        """
+        with self._changed:
+            self._stopping = True
+            self._changed.notify_all()
+        self._thread.join(timeout)
+        with self._lock:
+            return not self._batch and not self._num_posting
+
+    def get_stats_message(self):
+        mean = 0
+        if self.num_batches:
+            mean = float(self.num_outputs) / self.num_batches
+        return ('Output batches: %d posted, %.1f outputs per batch'
+                % (self.num_batches, mean))
+
+
+def _is_success_status(status):
+    """Returns True if a status from the handler is a 2xx integer."""
+    if isinstance(status, bool) or not isinstance(status, (int, long)):
+        return False
+    return 200 <= status < 300
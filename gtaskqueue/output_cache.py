@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Content addressed cache of task outputs.
+
+Tasks with the same payload run by the same executable_binary are expected
+to produce the same output, so the output of a successful run is stored
+under the sha256 of the two, and a later task with the same key is answered
+from the cache without running the binary.
+
+Entries are files in the cache directory named after their key. They are
+evicted least recently used first once the cache is over its size, and
+expire ttl_secs after being stored. Outputs are hard linked in and out of
+the cache when the task files are on the same filesystem, and copied
+otherwise.
+"""
+
+
+
+import collections
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from gtaskqueue.taskqueue_logger import logger
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+        'output_cache_dir',
+        None,
+        'Directory caching the output of tasks by payload and '
+        'executable_binary. A task whose output is cached is posted and '
+        'acked without being run. Disabled if not set.')
+flags.DEFINE_integer(
+        'output_cache_max_mb',
+        1024,
+        'Size of the output cache in MB.')
+flags.DEFINE_float(
+        'output_cache_ttl_secs',
+        24 * 3600,
+        'Time after which a cached output expires.')
+
+
+class OutputCache(object):
+    """Disk cache of task outputs keyed by binary and payload."""
+
+    def __init__(self, directory, max_bytes, ttl_secs):
+        """Constructor.
+
+        Indexes the entries left in directory by a previous run.
+
+        Args:
+            directory: directory holding the cached outputs.
+            max_bytes: total size above which entries are evicted.
+            ttl_secs: time after which an entry expires.
+        """
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._ttl_secs = ttl_secs
+        self._lock = threading.Lock()
+        # Key to (size, store time), least recently used first.
+        self._entries = collections.OrderedDict()
+        # Key to store time, oldest first, so that expired entries are at
+        # the head.
+        self._store_times = collections.OrderedDict()
+        self._total_bytes = 0
+        self.num_lookups = 0
+        self.num_hits = 0
+        self.bytes_saved = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        entries = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.startswith('.'):
+                # Partial write of a previous run.
+                _remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for (mtime, name, size) in sorted(entries):
+            self._entries[name] = (size, mtime)
+            self._store_times[name] = mtime
+            self._total_bytes += size
+        with self._lock:
+            self._evict()
+        logger.info('Output cache %s holds %d entries, %d bytes'
+                    % (directory, len(self._entries), self._total_bytes))
+
+    @staticmethod
+    def make_key(executable_binary, payload):
+        """Returns the cache key of payload run by executable_binary."""
+        digest = hashlib.sha256(executable_binary)
+        digest.update('\0')
+        digest.update(payload)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key)
+
+    def fetch(self, key, output_file):
+        """Copies the cached output of key to output_file.
+
+        Returns:
+            True on a hit, False if key is not cached or has expired.
+        """
+        with self._lock:
+            self.num_lookups += 1
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            (size, store_time) = entry
+            if time.time() - store_time > self._ttl_secs:
+                self._drop(key)
+                return False
+            try:
+                link_or_copy(self._path(key), output_file)
+            except (IOError, OSError), error:
+                logger.error('Error reading cached output %s. Error details '
+                             '%s' % (key, str(error)))
+                self._drop(key)
+                return False
+            del self._entries[key]
+            self._entries[key] = entry
+            self.num_hits += 1
+            self.bytes_saved += size
+            return True
+
+    def store(self, key, output_file):
+        """Adds the output of a successful run to the cache."""
+        try:
+            size = os.path.getsize(output_file)
+            if size > self._max_bytes:
+                return
+            (fd, tmp_path) = tempfile.mkstemp(dir=self._directory,
+                                              prefix='.')
+            os.close(fd)
+            link_or_copy(output_file, tmp_path)
+            os.rename(tmp_path, self._path(key))
+        except (IOError, OSError), error:
+            logger.error('Error caching output %s. Error details %s'
+                         % (key, str(error)))
+            return
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)[0]
+                del self._store_times[key]
+            now = time.time()
+            self._entries[key] = (size, now)
+            self._store_times[key] = now
+            self._total_bytes += size
+            self._evict()
+
+    def _drop(self, key):
+        """Removes an entry; the caller holds the lock."""
+        self._total_bytes -= self._entries.pop(key)[0]
+        del self._store_times[key]
+        _remove(self._path(key))
+
+    def _evict(self):
+        """Evicts expired and least recently used entries.
+
+        Both only look at the head of their order, so a store costs the
+        number of entries it evicts, not the size of the cache.
+        """
+        deadline = time.time() - self._ttl_secs
+        while self._store_times:
+            key = next(iter(self._store_times))
+            if self._store_times[key] >= deadline:
+                break
+            self._drop(key)
+        while self._total_bytes > self._max_bytes and self._entries:
+            self._drop(next(iter(self._entries)))
+
+    def get_stats_message(self):
+        hit_rate = 0
+        if self.num_lookups:
+            hit_rate = 100.0 * self.num_hits / self.num_lookups
+        return ('Output cache: %d hits in %d lookups (%.1f%%), %d bytes '
+                'saved, %d entries, %d bytes'
+                % (self.num_hits, self.num_lookups, hit_rate,
+                   self.bytes_saved, len(self._entries), self._total_bytes))
+
+
+def link_or_copy(src, dst):
+    """Hard links src to dst, copying if they are on different devices."""
+    _remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
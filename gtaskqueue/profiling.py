@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Profiling hooks for the puller and the command line tool.
+
+1. --profile=<file> runs the tool under cProfile and writes the pstats dump
+   to the file when it exits; read it with "python -m pstats <file>".
+2. In a running puller, SIGUSR1 starts a stack sampler and a second SIGUSR1
+   stops it and writes the sampled stacks of all threads, collapsed one per
+   line with their count, to --stack_sample_file. The file can be fed to
+   flamegraph.pl as is.
+3. The puller accumulates the wall clock time of its main phases; SIGUSR2
+   logs the count, total, mean and max time of each phase.
+"""
+
+
+
+import collections
+import contextlib
+import signal
+import sys
+import threading
+import time
+from gtaskqueue.taskqueue_logger import logger
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+        'profile',
+        None,
+        'Run under cProfile and write the pstats dump to this file on exit.')
+flags.DEFINE_string(
+        'stack_sample_file',
+        '/tmp/taskqueue-puller-stacks.txt',
+        'File the stack sampler started and stopped by SIGUSR1 writes the '
+        'collapsed stacks to.')
+flags.DEFINE_float(
+        'stack_sample_interval_secs',
+        0.01,
+        'Interval between two samples of the stack sampler.')
+
+
+def run_profiled(fn, *args, **kwargs):
+    """Calls fn, under cProfile if --profile is set.
+
+    Returns:
+        The result of fn.
+    """
+    if not FLAGS.profile:
+        return fn(*args, **kwargs)
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        profiler.dump_stats(FLAGS.profile)
+        logger.info('Wrote profile to %s' % FLAGS.profile)
+
+
+class PhaseTimers(object):
+    """Wall clock time spent in named phases, from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Phase to [count, total secs, max secs].
+        self._phases = {}
+
+    def add(self, phase, secs):
+        with self._lock:
+            stats = self._phases.get(phase)
+            if stats is None:
+                self._phases[phase] = [1, secs, secs]
+            else:
+                stats[0] += 1
+                stats[1] += secs
+                stats[2] = max(stats[2], secs)
+
+    @contextlib.contextmanager
+    def time(self, phase):
+        """Context manager timing its block as phase."""
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - start_time)
+
+    def get_stats_message(self):
+        with self._lock:
+            lines = ['Phase timers (count, total, mean, max secs):']
+            for phase, (count, total, max_secs) in sorted(
+                    self._phases.items()):
+                lines.append('  %-28s %8d %10.3f %8.4f %8.4f'
+                             % (phase, count, total, total / count,
+                                max_secs))
+            return '\n'.join(lines)
+
+
+phase_timers = PhaseTimers()
+
+
+def timed(phase):
+    """Decorator timing each call of the function as phase."""
+    def decorator(fn):
+        def wrapper(*args, **kwargs):
+            with phase_timers.time(phase):
+                return fn(*args, **kwargs)
+        wrapper.__name__ = fn.__name__
+        wrapper.__doc__ = fn.__doc__
+        return wrapper
+    return decorator
+
+
+class StackSampler(object):
+    """Samples the stacks of all threads from a background thread.
+
+    Sampling with sys._current_frames() sees every thread, where a profiling
+    timer signal only interrupts the main one, and costs nothing between
+    samples.
+    """
+
+    def __init__(self, path, interval_secs):
+        self._path = path
+        self._interval_secs = interval_secs
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def is_running(self):
+        return self._thread is not None
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='stack-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling; the sampler thread writes the stacks and exits."""
+        self._stopped.set()
+        self._thread = None
+
+    def _run(self):
+        own_ident = threading.current_thread().ident
+        counts = collections.defaultdict(int)
+        num_samples = 0
+        while not self._stopped.wait(self._interval_secs):
+            names = dict((thread.ident, thread.name)
+                         for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                counts[_collapse(names.get(ident, str(ident)), frame)] += 1
+            num_samples += 1
+        try:
+            f = open(self._path, 'w')
+            try:
+                for stack, count in sorted(counts.items()):
+                    f.write('%s %d\n' % (stack, count))
+            finally:
+                f.close()
+        except IOError, error:
+            logger.error('Error writing stack samples to %s. Error details %s'
+                         % (self._path, str(error)))
+            return
+        logger.info('Wrote %d stack samples to %s'
+                    % (num_samples, self._path))
+
+
+def _collapse(thread_name, frame):
+    """Returns the stack of frame as thread;outer;...;inner."""
+    functions = []
+    while frame is not None:
+        code = frame.f_code
+        functions.append('%s (%s:%d)' % (code.co_name, code.co_filename,
+                                         code.co_firstlineno))
+        frame = frame.f_back
+    functions.append(thread_name)
+    functions.reverse()
+    return ';'.join(functions)
+
+
+def install_signal_handlers():
+    """Toggles a StackSampler on SIGUSR1 and logs phase_timers on SIGUSR2."""
+    sampler = StackSampler(FLAGS.stack_sample_file,
+                           FLAGS.stack_sample_interval_secs)
+
+    def on_sample_signal(signum, frame):
+        if sampler.is_running():
+            sampler.stop()
+        else:
+            logger.info('Sampling stacks every %ss until the next SIGUSR1'
+                        % FLAGS.stack_sample_interval_secs)
+            sampler.start()
+
+    def on_timers_signal(signum, frame):
+        logger.info(phase_timers.get_stats_message())
+
+    signal.signal(signal.SIGUSR1, on_sample_signal)
+    signal.signal(signal.SIGUSR2, on_timers_signal)
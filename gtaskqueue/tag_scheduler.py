@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Spreads the lease requests of the puller over several task tags.
+
+Each tag has a priority and a maximum number of concurrently running tasks.
+A lease round fills the free task slots tag by tag, highest priority first
+and round-robin among tags of equal priority, never going over the limit of
+a tag. So a slow, bulky tag limited to a few slots can not hold back a
+cheap, urgent one. A tag whose lease came back short is skipped for
+sleep_interval_secs, so that an empty tag does not delay the others.
+
+The tag oldest_tag() leases the tasks with the oldest tag, whatever it is.
+Tasks count towards the limit of the entry they were leased through, so
+tasks leased through oldest_tag() count towards its limit even if their tag
+has an entry of its own.
+"""
+
+
+
+import threading
+import time
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_list(
+        'tags',
+        None,
+        'Tags to lease tasks for, as tag:priority:max_concurrency entries, '
+        'eg. "urgent:10:4,bulk:1:2,oldest_tag():0:0". Higher priorities are '
+        'leased first; a max_concurrency of 0 means no limit. Replaces '
+        '--tag.')
+
+OLDEST_TAG = 'oldest_tag()'
+
+
+class TagSpec(object):
+    """A tag with its priority and concurrency limit."""
+
+    def __init__(self, tag, priority, max_concurrency):
+        self.tag = tag
+        self.priority = priority
+        self.max_concurrency = max_concurrency
+        self.num_running = 0
+        self.last_lease_time = 0
+        # Time before which the tag is not leased, after a short lease.
+        self.idle_until = 0
+
+    def free_slots(self):
+        """Returns the number of tasks the tag may start, None if no limit."""
+        if not self.max_concurrency:
+            return None
+        return max(0, self.max_concurrency - self.num_running)
+
+
+def parse_tag_specs(entries):
+    """Parses --tags entries into a list of TagSpec.
+
+    Raises:
+        ValueError: if an entry is malformed or a tag is repeated.
+    """
+    specs = []
+    for entry in entries:
+        parts = entry.rsplit(':', 2)
+        if len(parts) != 3 or not parts[0]:
+            raise ValueError('Expected tag:priority:max_concurrency, got "%s"'
+                             % entry)
+        spec = TagSpec(parts[0], int(parts[1]), int(parts[2]))
+        if spec.max_concurrency < 0:
+            raise ValueError('Negative max_concurrency in "%s"' % entry)
+        if spec.tag in [other.tag for other in specs]:
+            raise ValueError('Tag "%s" given twice' % spec.tag)
+        specs.append(spec)
+    return specs
+
+
+class TagScheduler(object):
+    """Chooses the tag and size of each lease request.
+
+    The running counts are updated from the main thread of the puller while
+    the lease requests may be made from a worker thread, so all the methods
+    lock.
+    """
+
+    def __init__(self, specs):
+        self._specs = specs
+        self._by_tag = dict((spec.tag, spec) for spec in specs)
+        self._lock = threading.Lock()
+        # Tag entry of each leased task not started yet, by task name.
+        self._lease_tags = {}
+
+    def free_slots(self):
+        """Returns the number of tasks all tags may start, None if no limit."""
+        with self._lock:
+            total = 0
+            for spec in self._specs:
+                free = spec.free_slots()
+                if free is None:
+                    return None
+                total += free
+            return total
+
+    def choose(self, num_slots, exclude=()):
+        """Picks the tag of the next lease request.
+
+        Args:
+            num_slots: number of task slots free in the puller.
+            exclude: tags already leased in this round.
+
+        Returns:
+            (tag, max_tasks) tuple, or None if no tag should be leased now.
+        """
+        now = time.time()
+        with self._lock:
+            best = None
+            for spec in self._specs:
+                if spec.tag in exclude or spec.idle_until > now:
+                    continue
+                if spec.free_slots() == 0:
+                    continue
+                if best is None or (
+                        (spec.priority, -spec.last_lease_time) >
+                        (best.priority, -best.last_lease_time)):
+                    best = spec
+            if best is None or num_slots <= 0:
+                return None
+            best.last_lease_time = now
+            max_tasks = num_slots
+            if best.free_slots() is not None:
+                max_tasks = min(max_tasks, best.free_slots())
+            return (best.tag, max_tasks)
+
+    def record_lease(self, tag, num_requested, tasks):
+        """Records the outcome of a lease request for tag.
+
+        Args:
+            tag: tag the request was made for.
+            num_requested: maxTasks of the request.
+            tasks: tasks returned by the request.
+        """
+        with self._lock:
+            for task in tasks:
+                self._lease_tags[task.get('name')] = tag
+            if len(tasks) < num_requested:
+                self._by_tag[tag].idle_until = (time.time() +
+                                                FLAGS.sleep_interval_secs)
+
+    def task_started(self, task_name):
+        """Counts a started task against the entry it was leased through.
+
+        Returns:
+            The entry counted against, to pass to task_finished().
+        """
+        with self._lock:
+            spec = self._by_tag.get(self._lease_tags.pop(task_name, None))
+            if spec is not None:
+                spec.num_running += 1
+                return spec.tag
+            return None
+
+    def forget_leases(self, task_names):
+        """Drops the leased tasks which were not started."""
+        with self._lock:
+            for task_name in task_names:
+                self._lease_tags.pop(task_name, None)
+
+    def task_finished(self, tag):
+        with self._lock:
+            spec = self._by_tag.get(tag)
+            if spec is not None and spec.num_running > 0:
+                spec.num_running -= 1
+
+    def get_stats_message(self):
+        with self._lock:
+            return 'Running tasks by tag: %s' % ', '.join(
+                '%s=%d' % (spec.tag, spec.num_running)
+                for spec in self._specs)
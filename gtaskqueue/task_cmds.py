@@ -26,11 +26,15 @@ from gtaskqueue.taskqueue_cmd_base import GoogleTaskCommand
 
 from google.apputils import app
 from google.apputils import appcommands
+from gtaskqueue.utils import LEASE_FIELDS
 from gtaskqueue.utils import build_cloudtasks_queue_name, build_cloudtasks_task_name
 import gflags as flags
 
 FLAGS = flags.FLAGS
 
+# Task fields read by clear, which only needs the names to delete.
+CLEAR_LIST_FIELDS = 'tasks/name'
+
 
 class GetTaskCommand(GoogleTaskCommand):
     """Get properties of an existing task."""
@@ -91,7 +95,8 @@ class LeaseTaskCommand(GoogleTaskCommand):
             'responseView': 'FULL',
         }
         return task_api.lease(parent=parent,
-                              body=body)
+                              body=body,
+                              fields=LEASE_FIELDS)
 
     def print_result(self, result):
         """Override to optionally strip the payload since it can be long."""
@@ -196,7 +201,8 @@ class ClearTaskQueueCommand(GoogleTaskCommand):
         parent = build_cloudtasks_task_name(self._flag_values.project_name, self._flag_values.project_location, self._flag_values.taskqueue_name)
         list_request = tasks.list(parent=parent,
                                   responseView='BASIC',
-                                  pageSize=100)
+                                  pageSize=100,
+                                  fields=CLEAR_LIST_FIELDS)
         result = list_request.execute()
         n_deleted = 0
         if result:
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Policy for tasks whose process fails or times out.
+
+A failed task goes through the following steps:
+1. It is re-run in place up to task_max_local_retries times, with
+   exponential backoff, renewing its lease to cover the wait.
+2. Once the local retries are used up, its lease is cancelled (or renewed
+   for task_failure_delay_secs) so the taskqueue redelivers it promptly
+   instead of after the full lease.
+3. A task which has failed task_max_failures times on this puller is
+   quarantined: it is written to the dead-letter file and acknowledged, so
+   it stops coming back.
+"""
+
+
+
+import collections
+import json
+import threading
+import time
+from gtaskqueue.taskqueue_logger import logger
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+        'task_max_local_retries',
+        0,
+        'Number of times a failed task is re-run by the puller before its '
+        'lease is given up.')
+flags.DEFINE_float(
+        'task_retry_backoff_secs',
+        1,
+        'Wait before the first local retry of a failed task; doubled for '
+        'every further retry.')
+flags.DEFINE_float(
+        'task_retry_max_backoff_secs',
+        60,
+        'Upper limit of the wait between local retries.')
+flags.DEFINE_enum(
+        'task_failure_action',
+        'cancel_lease',
+        ['cancel_lease', 'delay', 'none'],
+        'What to do with the lease of a task which failed: "cancel_lease" '
+        'makes it available again immediately, "delay" renews the lease for '
+        'task_failure_delay_secs, "none" waits for the lease to expire.')
+flags.DEFINE_float(
+        'task_failure_delay_secs',
+        30,
+        'Delay before a failed task is redelivered with '
+        '--task_failure_action=delay.')
+flags.DEFINE_integer(
+        'task_max_failures',
+        0,
+        'Quarantine a task in the dead-letter file once it has failed this '
+        'many times on this puller. 0 disables quarantine.')
+flags.DEFINE_string(
+        'dead_letter_file',
+        '/tmp/taskqueue-puller-dead-letter.json',
+        'File to which quarantined tasks are appended, one JSON object per '
+        'line.')
+flags.DEFINE_integer(
+        'task_failure_history_size',
+        10000,
+        'Number of failing tasks whose failure count is remembered.')
+
+
+class TaskFailurePolicy(object):
+    """Retry, redelivery and quarantine decisions for failed tasks.
+
+    Shared by all the tasks of a puller. The methods may be called from
+    several threads.
+    """
+
+    def __init__(self, lease_secs):
+        """Constructor.
+
+        Args:
+            lease_secs: lease duration used to cover a local retry.
+        """
+        self.lease_secs = lease_secs
+        self._lock = threading.Lock()
+        # Failure counts of recently failed tasks, least recent first.
+        self._failures = collections.OrderedDict()
+
+    def retry_delay(self, attempt):
+        """Returns the wait before local retry number attempt (from 1).
+
+        Returns:
+            Seconds to wait, or None if no local retry is left.
+        """
+        if attempt > FLAGS.task_max_local_retries:
+            return None
+        return min(FLAGS.task_retry_max_backoff_secs,
+                   FLAGS.task_retry_backoff_secs * 2 ** (attempt - 1))
+
+    def record_failure(self, task_id):
+        """Counts a failure of task_id.
+
+        Returns:
+            Number of times the task has failed on this puller.
+        """
+        with self._lock:
+            count = self._failures.pop(task_id, 0) + 1
+            self._failures[task_id] = count
+            while len(self._failures) > FLAGS.task_failure_history_size:
+                self._failures.popitem(last=False)
+            return count
+
+    def forget(self, task_id):
+        """Drops the failure count of a task which succeeded or is gone."""
+        with self._lock:
+            self._failures.pop(task_id, None)
+
+    def may_quarantine(self):
+        """Returns True if tasks may be quarantined, which keeps payloads."""
+        return FLAGS.task_max_failures > 0
+
+    def should_quarantine(self, failures):
+        return (FLAGS.task_max_failures > 0 and
+                failures >= FLAGS.task_max_failures)
+
+    def quarantine(self, record):
+        """Appends a task to the dead-letter file.
+
+        Args:
+            record: JSON-serializable description of the task.
+
+        Returns:
+            True/False based on if the record was written.
+        """
+        record = dict(record, quarantine_time=time.time())
+        with self._lock:
+            try:
+                f = open(FLAGS.dead_letter_file, 'a')
+                try:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+                finally:
+                    f.close()
+            except IOError, io_error:
+                logger.error('Error writing to dead-letter file %s. Error '
+                             'details %s' % (FLAGS.dead_letter_file,
+                                             str(io_error)))
+                return False
+        logger.error('Quarantined task %s after %s failures'
+                     % (record.get('name'), record.get('failures')))
+        return True
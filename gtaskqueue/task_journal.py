@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Write-ahead journal of the tasks held by the puller.
+
+Every task the puller starts is journaled from its lease to its ack, so
+that a puller which died can clean up after itself when it is restarted:
+finished tasks are acked instead of run again, orphaned task processes are
+killed, and the leases of the other tasks are cancelled so that they are
+redelivered at once.
+
+The journal is a file of JSON lines, one per event:
+    start    task process started (or answered from the output cache),
+             with its schedule time, pid and files.
+    lease    lease renewed, with the new schedule time.
+    finish   task process exited, with its status.
+    post     output posted.
+    ack      task acked, or its ack handed to the ack retry queue.
+    release  task given up: its lease was cancelled, delayed or left to
+             expire.
+Tasks are forgotten after ack or release. Events are buffered and written
+with a single write and fsync every journal_flush_secs by a background
+thread, so journaling adds no I/O to the task handling; a crash loses at
+most the events of the last interval. The file is compacted to one line per
+live task once it holds many more lines than that.
+"""
+
+
+
+import errno
+import json
+import os
+import signal
+import threading
+import time
+from gtaskqueue.taskqueue_logger import logger
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+        'journal_file',
+        None,
+        'Write-ahead journal of the tasks held by the puller, replayed when '
+        'the puller starts. Each puller needs a file of its own. Disabled '
+        'if not set.')
+flags.DEFINE_float(
+        'journal_flush_secs',
+        0.2,
+        'Interval at which journal events are written out.')
+
+# Events after which the task is forgotten.
+_FINAL_EVENTS = ('ack', 'release')
+
+
+class TaskJournal(object):
+    """Append-only journal of task events, batched and compacted."""
+
+    def __init__(self, path, flush_secs):
+        """Constructor.
+
+        Loads the tasks left live by the previous run; see
+        get_recovered_tasks().
+
+        Args:
+            path: journal file.
+            flush_secs: interval at which buffered events are written.
+        """
+        self._path = path
+        self._flush_secs = flush_secs
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._buffer = []
+        # Merged state of every live task, by task name.
+        self._tasks = {}
+        self._num_records = 0
+        self._recovered = self._load()
+        self._compact()
+        self._thread = threading.Thread(target=self._run,
+                                        name='journal')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _load(self):
+        tasks = {}
+        try:
+            f = open(self._path)
+        except IOError:
+            return tasks
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A line cut short by a crash.
+                    continue
+                _apply(tasks, record)
+        finally:
+            f.close()
+        return tasks
+
+    def get_recovered_tasks(self):
+        """Returns the state of the tasks live when the last run ended.
+
+        Returns:
+            List of dicts with the merged fields of the events of each task,
+            and the name of the last event in 'event'.
+        """
+        return self._recovered.values()
+
+    def record(self, task_name, event, **fields):
+        """Journals an event of a task; cheap, the write happens later."""
+        fields['name'] = task_name
+        fields['event'] = event
+        fields['time'] = time.time()
+        with self._lock:
+            self._buffer.append(fields)
+
+    def flush(self):
+        """Writes out the buffered events."""
+        with self._flush_lock:
+            with self._lock:
+                records, self._buffer = self._buffer, []
+            if not records:
+                return
+            for record in records:
+                _apply(self._tasks, record)
+            data = ''.join(json.dumps(record) + '\n' for record in records)
+            try:
+                f = open(self._path, 'a')
+                try:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                finally:
+                    f.close()
+            except (IOError, OSError), error:
+                logger.error('Error writing journal %s. Error details %s'
+                             % (self._path, str(error)))
+            self._num_records += len(records)
+            if self._num_records > 2 * len(self._tasks) + 1000:
+                self._compact()
+
+    def _compact(self):
+        """Rewrites the journal with one line per live task."""
+        tmp_path = self._path + '.tmp'
+        try:
+            f = open(tmp_path, 'w')
+            try:
+                for task in self._tasks.values():
+                    f.write(json.dumps(task) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(tmp_path, self._path)
+            self._num_records = len(self._tasks)
+        except (IOError, OSError), error:
+            logger.error('Error compacting journal %s. Error details %s'
+                         % (self._path, str(error)))
+
+    def _run(self):
+        while not self._stopped.wait(self._flush_secs):
+            self.flush()
+
+    def close(self):
+        """Stops the background writer and writes out all events."""
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+        with self._flush_lock:
+            self._compact()
+
+
+def _apply(tasks, record):
+    """Merges a journal record into the state of its task."""
+    if record['event'] in _FINAL_EVENTS:
+        tasks.pop(record['name'], None)
+    else:
+        tasks.setdefault(record['name'], {}).update(record)
+
+
+def kill_orphan(pid, input_file):
+    """Kills the process group of a task process left by a dead puller.
+
+    The pid may have been reused since, so the process is only killed if
+    its command line still holds the task's input file, whose name is
+    unique.
+
+    Returns:
+        True/False based on if the process group was killed.
+    """
+    try:
+        f = open('/proc/%d/cmdline' % pid)
+        try:
+            cmdline = f.read().split('\0')
+        finally:
+            f.close()
+    except IOError:
+        return False
+    if not input_file or input_file not in cmdline:
+        return False
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError, os_error:
+        if os_error.errno != errno.ESRCH:
+            logger.error('Error killing orphaned task process %d. Error '
+                         'details %s' % (pid, str(os_error)))
+        return False
+    return True
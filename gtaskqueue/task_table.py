@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Table of the tasks held by the puller.
+
+The puller needs to find a task by its id (on redelivery), by its pid (when
+a child exits) and by time (when a task times out or a failed task is due
+for a retry). Sweeping every task for the last two makes each poll cost as
+much as the number of tasks in flight; the table keeps a pid index and a
+heap of wakeup times instead, so a poll only touches the tasks which have
+something to do.
+
+Heap entries are not removed when a task finishes or its wakeup time
+changes; they are dropped when they come up and no longer match the wakeup
+time of their task, or when they outnumber the tasks and the heap is
+rebuilt. A task which comes up is unscheduled until it is tracked again.
+"""
+
+
+
+import errno
+import heapq
+import os
+
+# Number of stale heap entries tolerated before the heap is rebuilt.
+_MIN_STALE_WAKEUPS = 1024
+
+
+class TaskTable(object):
+    """Running tasks by task id and by pid, with a heap of wakeup times.
+
+    Only used from the main thread of the puller.
+    """
+
+    def __init__(self):
+        # ClientTask objects by task id.
+        self._tasks = {}
+        # Task ids by the pid of their running child.
+        self._pids = {}
+        # Exit callbacks of the children which do not belong to one task,
+        # by pid.
+        self._children = {}
+        # Wakeup time of each task, and the (wakeup time, task id) entries
+        # in time order.
+        self._wakeup_times = {}
+        self._wakeups = []
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __contains__(self, task_id):
+        return task_id in self._tasks
+
+    def get(self, task_id):
+        return self._tasks.get(task_id)
+
+    def values(self):
+        return self._tasks.values()
+
+    def items(self):
+        return self._tasks.items()
+
+    def add(self, task):
+        self._tasks[task.get_task_id()] = task
+        self.track(task)
+
+    def remove(self, task_id):
+        """Forgets a task.
+
+        Returns:
+            The task, None if it was not in the table.
+        """
+        task = self._tasks.pop(task_id, None)
+        if task is not None:
+            self.untrack_pid(task.get_pid())
+            self._wakeup_times.pop(task_id, None)
+        return task
+
+    def track(self, task):
+        """Indexes the current child and wakeup time of a task.
+
+        Called again whenever a task may have started a new child or
+        changed its wakeup time, eg. after a failed run was scheduled for a
+        retry or restarted.
+        """
+        task_id = task.get_task_id()
+        pid = task.get_pid()
+        if pid is not None and task.get_exit_status() is None:
+            self._pids[pid] = task_id
+        wakeup_time = task.get_wakeup_time()
+        if wakeup_time is None:
+            self._wakeup_times.pop(task_id, None)
+        elif self._wakeup_times.get(task_id) != wakeup_time:
+            self._wakeup_times[task_id] = wakeup_time
+            heapq.heappush(self._wakeups, (wakeup_time, task_id))
+            if (len(self._wakeups) >
+                    2 * len(self._wakeup_times) + _MIN_STALE_WAKEUPS):
+                self._compact()
+
+    def add_child(self, pid, on_exit):
+        """Tracks a child which runs for several tasks, eg. a batch.
+
+        Args:
+            pid: pid of the child.
+            on_exit: called with the exit status and resource usage of the
+                child once it is reaped; returns the list of tasks the exit
+                concerns.
+        """
+        self._children[pid] = on_exit
+
+    def untrack_pid(self, pid):
+        """Stops mapping pid to its task, eg. once the child is killed."""
+        if pid is not None:
+            self._pids.pop(pid, None)
+
+    def reap_children(self):
+        """Collects the exited children of the tasks without blocking.
+
+        Every child of the process is reaped; the exit status of a task
+        child is recorded on its task, and that of a child added with
+        add_child() is passed to its callback.
+
+        Returns:
+            List of the tasks whose child exited.
+        """
+        tasks = []
+        while True:
+            try:
+                (pid, status, rusage) = os.wait4(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                break
+            if not pid:
+                break
+            on_exit = self._children.pop(pid, None)
+            if on_exit is not None:
+                tasks.extend(on_exit(status, rusage))
+                continue
+            task = self._tasks.get(self._pids.pop(pid, None))
+            if task is None:
+                continue
+            task.set_exit_status(status, rusage)
+            tasks.append(task)
+        return tasks
+
+    def _compact(self):
+        """Rebuilds the heap with the current wakeup times only.
+
+        Tasks mostly finish long before their timeout, so without this the
+        heap would hold an entry for every task run in the last timeout.
+        """
+        self._wakeups = [(wakeup_time, task_id) for (task_id, wakeup_time)
+                         in self._wakeup_times.iteritems()]
+        heapq.heapify(self._wakeups)
+
+    def pop_due(self, now):
+        """Returns the tasks whose wakeup time has come, in time order."""
+        tasks = []
+        while self._wakeups and self._wakeups[0][0] <= now:
+            (wakeup_time, task_id) = heapq.heappop(self._wakeups)
+            if self._wakeup_times.get(task_id) == wakeup_time:
+                del self._wakeup_times[task_id]
+                tasks.append(self._tasks[task_id])
+        return tasks
+
+    def get_next_wakeup_time(self):
+        """Returns the earliest wakeup time, None if there is none.
+
+        It may be that of a finished task, which only causes an early poll.
+        """
+        if not self._wakeups:
+            return None
+        return self._wakeups[0][0]
@@ -21,12 +21,8 @@
 import os
 import sys
 import urlparse
-from apiclient.discovery import build
-from apiclient.errors import HttpError
-import httplib2
 import json
-from oauth2client.file import Storage
-from oauth2client.client import OAuth2WebServerFlow
+from gtaskqueue.http_pool import AuthorizedHttpPool
 from gtaskqueue.taskqueue_logger import logger
 from gtaskqueue.utils import get_env_variable
 from gtaskqueue.old_run import run
@@ -59,19 +55,33 @@ flags.DEFINE_string(
         'credentials_file',
         'taskqueue.dat',
         'File where you want to store the auth credentails for later user')
+flags.DEFINE_bool(
+        'use_static_client',
+        False,
+        'Use the hand-written client for the task methods instead of the '
+        'discovery based one. Skips fetching the discovery document and '
+        'the per request schema validation.')
+
 
-# Set up a Flow object to be used if we need to authenticate. This
-# sample uses OAuth 2.0, and we set up the OAuth2WebServerFlow with
-# the information it needs to authenticate. Note that it is called
-# the Web Server Flow, but it can also handle the flow for native
-# applications <http://code.google.com/apis/accounts/docs/OAuth2.html#IA>
-# The client_id client_secret are copied from the Identity tab on
-# the Google APIs Console <http://code.google.com/apis/console>
-FLOW = OAuth2WebServerFlow(
-    client_id=get_env_variable('GOOGLE_CLIENT_ID'),
-    client_secret=get_env_variable('GOOGLE_CLIENT_SECRET'),
-    scope='https://www.googleapis.com/auth/cloud-tasks',
-    user_agent='taskqueue-cmdline-sample/1.0')
+def get_flow():
+    """Returns the Flow object to be used if we need to authenticate.
+
+    This sample uses OAuth 2.0, and we set up the OAuth2WebServerFlow with
+    the information it needs to authenticate. Note that it is called
+    the Web Server Flow, but it can also handle the flow for native
+    applications <http://code.google.com/apis/accounts/docs/OAuth2.html#IA>
+    The client_id client_secret are read from the GOOGLE_CLIENT_ID and
+    GOOGLE_CLIENT_SECRET environment variables.
+
+    The flow is only needed when no valid stored credentials exist, so it
+    (and oauth2client) is built on demand rather than at import time.
+    """
+    from oauth2client.client import OAuth2WebServerFlow
+    return OAuth2WebServerFlow(
+        client_id=get_env_variable('GOOGLE_CLIENT_ID'),
+        client_secret=get_env_variable('GOOGLE_CLIENT_SECRET'),
+        scope='https://www.googleapis.com/auth/cloud-tasks',
+        user_agent='taskqueue-cmdline-sample/1.0')
 
 
 class TaskQueueClient:
@@ -81,6 +91,10 @@ class TaskQueueClient:
         if not FLAGS.project_name:
             raise app.UsageError('You must specify a project name'
                                  ' using the "--project_name" flag.')
+        from apiclient.discovery import build
+        from apiclient.errors import HttpError
+        import httplib2
+        from oauth2client.file import Storage
         discovery_uri = (
             FLAGS.api_host + 'discovery/v1/apis/{api}/{apiVersion}/rest')
         logger.info(discovery_uri)
@@ -94,13 +108,22 @@ class TaskQueueClient:
             storage = Storage(FLAGS.credentials_file)
             credentials = storage.get()
             if credentials is None or credentials.invalid == True:
-                credentials = run(FLOW, storage)
-            http = credentials.authorize(self._dump_request_wrapper(
-                    httplib2.Http()))
-            self.task_api = build('cloudtasks',
-                                  FLAGS.service_version,
-                                  http=http,
-                                  discoveryServiceUrl=discovery_uri)
+                credentials = run(get_flow(), storage)
+            # All API calls go through a pool of authorized transports, so
+            # the task_api handler can be used from several threads at once.
+            self.http_pool = AuthorizedHttpPool(
+                credentials,
+                lambda: self._dump_request_wrapper(httplib2.Http()))
+            if FLAGS.use_static_client:
+                from gtaskqueue.taskqueue_rest_client import StaticTaskApi
+                self.task_api = StaticTaskApi(self.http_pool,
+                                              FLAGS.api_host,
+                                              FLAGS.service_version)
+            else:
+                self.task_api = build('cloudtasks',
+                                      FLAGS.service_version,
+                                      http=self.http_pool,
+                                      discoveryServiceUrl=discovery_uri)
         except HttpError, http_error:
             logger.error('Error gettin task_api: %s' % http_error)
 
@@ -108,6 +131,10 @@ class TaskQueueClient:
         """Returns handler for tasks  API from taskqueue API collection."""
         return self.task_api
 
+    def get_http_pool(self):
+        """Returns the thread-safe pool of authorized HTTP transports."""
+        return self.http_pool
+
 
     def _dump_request_wrapper(self, http):
         """Dumps the outgoing HTTP request if requested.
@@ -118,6 +145,7 @@ class TaskQueueClient:
         Returns:
             httplib2.Http like object.
         """
+        import httplib2
         request_orig = http.request
 
         def new_request(uri, method='GET', body=None, headers=None,
@@ -26,12 +26,9 @@ import urlparse
 import json
 
 
-from apiclient.discovery import build
-from apiclient.errors import HttpError
-import httplib2
-from oauth2client.file import Storage
-from oauth2client.client import OAuth2WebServerFlow
+from gtaskqueue.http_pool import AuthorizedHttpPool
 from gtaskqueue.old_run import run
+from gtaskqueue.profiling import run_profiled
 
 from google.apputils import app
 from google.apputils import appcommands
@@ -81,18 +78,26 @@ flags.DEFINE_string(
     None,
     'Task name')
 
-# Set up a Flow object to be used if we need to authenticate. This
-# sample uses OAuth 2.0, and we set up the OAuth2WebServerFlow with
-# the information it needs to authenticate. Note that it is called
-# the Web Server Flow, but it can also handle the flow for native
-# applications <http://code.google.com/apis/accounts/docs/OAuth2.html#IA>
-# The client_id client_secret are copied from the Identity tab on
-# the Google APIs Console <http://code.google.com/apis/console>
-FLOW = OAuth2WebServerFlow(
-    client_id='157776985798.apps.googleusercontent.com',
-    client_secret='tlpVCmaS6yLjxnnPu0ARIhNw',
-    scope='https://www.googleapis.com/auth/cloud-tasks',
-    user_agent='taskqueue-cmdline-sample/1.0')
+
+def get_flow():
+    """Returns the Flow object to be used if we need to authenticate.
+
+    This sample uses OAuth 2.0, and we set up the OAuth2WebServerFlow with
+    the information it needs to authenticate. Note that it is called
+    the Web Server Flow, but it can also handle the flow for native
+    applications <http://code.google.com/apis/accounts/docs/OAuth2.html#IA>
+    The client_id client_secret are copied from the Identity tab on
+    the Google APIs Console <http://code.google.com/apis/console>
+
+    The flow is built on demand so that oauth2client is only imported by
+    commands that actually talk to the API.
+    """
+    from oauth2client.client import OAuth2WebServerFlow
+    return OAuth2WebServerFlow(
+        client_id='157776985798.apps.googleusercontent.com',
+        client_secret='tlpVCmaS6yLjxnnPu0ARIhNw',
+        scope='https://www.googleapis.com/auth/cloud-tasks',
+        user_agent='taskqueue-cmdline-sample/1.0')
 
 class GoogleTaskQueueCommandBase(appcommands.Cmd):
     """Base class for all the Google TaskQueue client commands."""
@@ -111,6 +116,7 @@ class GoogleTaskQueueCommandBase(appcommands.Cmd):
         Returns:
             httplib2.Http like object.
         """
+        import httplib2
         request_orig = http.request
 
         def new_request(uri, method='GET', body=None, headers=None,
@@ -172,9 +178,18 @@ class GoogleTaskQueueCommandBase(appcommands.Cmd):
         Args:
             argv: The non-flag arguments to the command.
         """
+        run_profiled(self._run, argv)
+
+    def _run(self, argv):
         if not FLAGS.project_name:
             raise app.UsageError('You must specify a project name'
                                  ' using the "--project_name" flag.')
+        # The API client stack is by far the most expensive thing we import,
+        # so only pull it in once we know a command is going to run.
+        from apiclient.discovery import build
+        from apiclient.errors import HttpError
+        import httplib2
+        from oauth2client.file import Storage
         discovery_uri = (
                 FLAGS.api_host + 'discovery/v1/apis/{api}/{apiVersion}/rest')
         try:
@@ -188,9 +203,12 @@ class GoogleTaskQueueCommandBase(appcommands.Cmd):
             storage = Storage(FLAGS.credentials_file)
             credentials = storage.get()
             if credentials is None or credentials.invalid == True:
-                credentials = run(FLOW, storage)
-            http = credentials.authorize(self._dump_request_wrapper(
-                    httplib2.Http()))
+                credentials = run(get_flow(), storage)
+            # Calls go through a pool of authorized transports, so that a
+            # command can use the api handle from several threads.
+            http = AuthorizedHttpPool(
+                credentials,
+                lambda: self._dump_request_wrapper(httplib2.Http()))
             api = build('cloudtasks',
                        FLAGS.service_version,
                        http=http,
@@ -21,13 +21,109 @@ __version__ = '0.0.1'
 
 
 
+import time
+
 from gtaskqueue.taskqueue_cmd_base import GoogleTaskQueueCommand
+from gtaskqueue.worker_pool import WorkerPool
 
 from google.apputils import appcommands
 from gtaskqueue.utils import build_cloudtasks_queue_name, build_cloudtasks_task_name
+from gtaskqueue.utils import parse_timestamp
 import gflags as flags
 
 FLAGS = flags.FLAGS
+flags.DEFINE_integer(
+        'stats_count_max_pages',
+        0,
+        'When the server does not return the stats of a queue, count them '
+        'from a listing of its tasks of at most this many pages of 1000 '
+        'tasks; larger queues are shown as ">=" the tasks counted. 0 does '
+        'not list the tasks.')
+
+# Queue fields read for the stats; stats are only returned when asked for.
+STATS_READ_MASK = 'name,stats'
+# Task fields read when the stats have to be counted from a task listing.
+LIST_FIELDS = 'nextPageToken,tasks(scheduleTime)'
+LIST_PAGE_SIZE = 1000
+
+# Wait for a poll of watchqueues in slices, as an Event.wait() without a
+# timeout can not be interrupted by Ctrl+C on Python 2.
+_WAIT_SLICE_SECS = 0.5
+# Time given to the workers to finish their poll once watchqueues stops.
+_SHUTDOWN_SECS = 1
+
+
+def get_queue_stats(queues_api, name, max_pages=None):
+    """Gets the stats of a queue with a response holding only them.
+
+    The stats are read with a read mask. If the server does not return them
+    and max_pages is set, they are counted from a listing of the tasks which
+    only holds their schedule time: the tasks scheduled in the future are
+    leased, and the earliest schedule time of the others is the oldest
+    arrival time. A queue with more tasks than the pages hold has
+    tasksCountIsLowerBound set in its stats.
+
+    Args:
+        queues_api: The handle to the queues collection API.
+        name: Full name of the queue.
+        max_pages: highest number of pages of tasks listed, defaults to
+            --stats_count_max_pages; 0 does not list the tasks.
+    Returns:
+        Queue dict with its name and QueueStats like stats, which are empty
+        if they could not be read.
+    """
+    if max_pages is None:
+        max_pages = FLAGS.stats_count_max_pages
+    from apiclient.errors import HttpError
+    try:
+        result = queues_api.get(name=name,
+                                readMask=STATS_READ_MASK,
+                                fields=STATS_READ_MASK).execute()
+        if result.get('stats'):
+            return result
+    except HttpError, http_error:
+        if http_error.resp.status != 400:
+            raise
+    if max_pages <= 0:
+        return {'name': name, 'stats': {}}
+    return {'name': name,
+            'stats': _count_tasks(queues_api.tasks(), name, max_pages)}
+
+
+def _count_tasks(tasks_api, parent, max_pages):
+    """Counts the tasks of a queue from a minimal listing."""
+    now = time.time()
+    num_tasks = 0
+    num_leased = 0
+    oldest = None
+    page_token = None
+    for _ in range(max_pages):
+        kwargs = {}
+        if page_token:
+            kwargs['pageToken'] = page_token
+        result = tasks_api.list(parent=parent,
+                                responseView='BASIC',
+                                pageSize=LIST_PAGE_SIZE,
+                                fields=LIST_FIELDS,
+                                **kwargs).execute()
+        for task in result.get('tasks', []):
+            num_tasks += 1
+            schedule_time = task.get('scheduleTime')
+            if parse_timestamp(schedule_time) > now:
+                num_leased += 1
+            elif oldest is None or (parse_timestamp(schedule_time) <
+                                    parse_timestamp(oldest)):
+                oldest = schedule_time
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            break
+    stats = {'tasksCount': str(num_tasks),
+             'concurrentDispatchesCount': str(num_leased)}
+    if page_token:
+        stats['tasksCountIsLowerBound'] = True
+    if oldest:
+        stats['oldestEstimatedArrivalTime'] = oldest
+    return stats
 
 
 class GetTaskQueueCommand(GoogleTaskQueueCommand):
@@ -40,6 +136,28 @@ class GetTaskQueueCommand(GoogleTaskQueueCommand):
                              flag_values=flag_values)
         super(GetTaskQueueCommand, self).__init__(name, flag_values)
 
+    def run_with_api_and_flags(self, api, flag_values):
+        """Run the command, returning the result.
+
+        With --get_stats, only the name and stats of the queue are returned.
+
+        Args:
+            api: The handle to the Google TaskQueue API.
+            flag_values: The parsed command flags.
+        Returns:
+            The result of running the command.
+        """
+        if not flag_values.get_stats:
+            return super(GetTaskQueueCommand, self).run_with_api_and_flags(
+                api, flag_values)
+        return get_queue_stats(api.projects().locations().queues(),
+                               self._get_queue_name(flag_values))
+
+    def _get_queue_name(self, flag_values):
+        return build_cloudtasks_queue_name(flag_values.project_name,
+                                           flag_values.project_location,
+                                           flag_values.taskqueue_name)
+
     def build_request(self, taskqueue_api, flag_values):
         """Build a request to get properties of a TaskQueue.
 
@@ -49,11 +167,142 @@ class GetTaskQueueCommand(GoogleTaskQueueCommand):
         Returns:
             The properties of the taskqueue.
         """
-        name = build_cloudtasks_queue_name(flag_values.project_name,
-                                           flag_values.project_location,
-                                           flag_values.taskqueue_name)
-        return taskqueue_api.get(name=name)
+        return taskqueue_api.get(name=self._get_queue_name(flag_values))
+
+
+class WatchTaskQueuesCommand(GoogleTaskQueueCommand):
+    """Periodically prints the stats of several task queues.
+
+    The queues are polled concurrently over one pool of connections, and
+    each poll only reads the queue stats. A line is printed for a queue
+    when its stats changed since the previous poll, with
+        depth     number of tasks in the queue and its change,
+        enq/s     tasks added per second, from the change of the depth and
+                  the tasks completed meanwhile,
+        lease/s   tasks leased and completed per second, as reported by the
+                  queue for the last minute,
+        leased    tasks currently leased,
+        oldest    age of the oldest task waiting to be leased.
+    Rates which can not be known are printed as "-". When the server does
+    not return the stats, they are only counted with
+    --stats_count_max_pages, and a depth over what was counted is printed
+    as ">=N".
+    """
+
+    def __init__(self, name, flag_values):
+        flags.DEFINE_list('queues',
+                          None,
+                          'Names of the queues to watch; defaults to '
+                          '--taskqueue_name',
+                          flag_values=flag_values)
+        flags.DEFINE_float('watch_interval_secs',
+                           10,
+                           'Interval between two polls of the queues',
+                           flag_values=flag_values)
+        flags.DEFINE_integer('watch_count',
+                             0,
+                             'Number of polls; 0 polls until interrupted',
+                             flag_values=flag_values)
+        super(WatchTaskQueuesCommand, self).__init__(name, flag_values)
+
+    def run_with_api_and_flags(self, api, flag_values):
+        """Polls the queues and prints their changes until done.
+
+        Args:
+            api: The handle to the Google TaskQueue API.
+            flag_values: The parsed command flags.
+        Returns:
+            None; the stats are printed as they come.
+        """
+        queues_api = api.projects().locations().queues()
+        queue_ids = flag_values.queues or [flag_values.taskqueue_name]
+        names = [build_cloudtasks_queue_name(flag_values.project_name,
+                                             flag_values.project_location,
+                                             queue_id)
+                 for queue_id in queue_ids]
+        pool = WorkerPool(min(len(names), FLAGS.http_pool_size),
+                          name='watch')
+        # Stats and time of the previous poll, by queue name.
+        previous = {}
+        print '%-8s %-24s %8s %7s %8s %8s %7s %9s' % (
+            'time', 'queue', 'depth', 'change', 'enq/s', 'lease/s', 'leased',
+            'oldest')
+        num_polls = 0
+        try:
+            while True:
+                poll_time = time.time()
+                items = [(name, pool.submit(get_queue_stats, queues_api, name))
+                         for name in names]
+                for (name, item) in items:
+                    while not item.done.wait(_WAIT_SLICE_SECS):
+                        pass
+                    queue_id = name.rsplit('/', 1)[1]
+                    if item.error:
+                        print '%s %-24s error: %s' % (
+                            time.strftime('%H:%M:%S'), queue_id,
+                            str(item.error))
+                        continue
+                    stats = item.result.get('stats', {})
+                    last = previous.get(name)
+                    previous[name] = (poll_time, stats)
+                    if last is not None and last[1] == stats:
+                        continue
+                    print _format_stats_line(queue_id, poll_time, stats, last)
+                num_polls += 1
+                if num_polls == flag_values.watch_count:
+                    break
+                time.sleep(max(0, poll_time + flag_values.watch_interval_secs -
+                               time.time()))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pool.shutdown(_SHUTDOWN_SECS)
+        return None
+
+    def print_result(self, result):
+        pass
+
+
+def _format_stats_line(queue_id, poll_time, stats, last):
+    """Formats the stats of a queue and their change since last."""
+    if 'tasksCount' not in stats:
+        return '%s %-24s no stats (see --stats_count_max_pages)' % (
+            time.strftime('%H:%M:%S', time.localtime(poll_time)), queue_id)
+    depth = int(stats['tasksCount'])
+    lower_bound = stats.get('tasksCountIsLowerBound')
+    lease_rate = None
+    if 'executedLastMinuteCount' in stats:
+        lease_rate = int(stats['executedLastMinuteCount']) / 60.0
+    change = None
+    enqueue_rate = None
+    if (last is not None and 'tasksCount' in last[1] and not lower_bound and
+            not last[1].get('tasksCountIsLowerBound')):
+        change = depth - int(last[1]['tasksCount'])
+        elapsed = poll_time - last[0]
+        if elapsed > 0 and lease_rate is not None:
+            enqueue_rate = max(0, change / elapsed + lease_rate)
+    oldest_age = None
+    arrival_time = parse_timestamp(stats.get('oldestEstimatedArrivalTime'))
+    if arrival_time is not None:
+        oldest_age = max(0, poll_time - arrival_time)
+    depth_text = str(depth)
+    if lower_bound:
+        depth_text = '>=' + depth_text
+    return '%s %-24s %8s %7s %8s %8s %7s %9s' % (
+        time.strftime('%H:%M:%S', time.localtime(poll_time)), queue_id,
+        depth_text,
+        _format_value('%+d', change), _format_value('%.2f', enqueue_rate),
+        _format_value('%.2f', lease_rate),
+        stats.get('concurrentDispatchesCount', '-'),
+        _format_value('%.0fs', oldest_age))
+
+
+def _format_value(format_string, value):
+    if value is None:
+        return '-'
+    return format_string % value
 
 
 def add_commands():
     appcommands.AddCmd('getqueue', GetTaskQueueCommand)
+    appcommands.AddCmd('watchqueues', WatchTaskQueuesCommand)
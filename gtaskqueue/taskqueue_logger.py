@@ -14,12 +14,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Log settings for taskqueue_puller module."""
+"""Log settings for taskqueue_puller module.
 
+Records are written by a background thread: the logger only appends them to
+a queue, so logging on the hot paths of the puller never waits for the disk
+or for a log rotation.
+"""
 
 
+
+import atexit
+import collections
+import errno
+import fcntl
+import json
 import logging
 import logging.config
+import logging.handlers
+import os
+import threading
 from google.apputils import app
 import gflags as flags
 
@@ -28,26 +41,185 @@ flags.DEFINE_string(
         'log_output_file',
         '/tmp/taskqueue-puller.log',
         'Logfile name for taskqueue_puller.')
+flags.DEFINE_enum(
+        'log_format',
+        'text',
+        ['text', 'json'],
+        'Format of the log records; "json" writes one JSON object per line.')
+flags.DEFINE_integer(
+        'log_max_bytes',
+        1024 * 1024,
+        'Size at which the log file is rotated. 0 disables size based '
+        'rotation.')
+flags.DEFINE_integer(
+        'log_backup_count',
+        5,
+        'Number of rotated log files kept.')
+flags.DEFINE_string(
+        'log_rotate_when',
+        None,
+        'Rotate the log file on time instead of size, eg. "midnight" or "H" '
+        '(see logging.handlers.TimedRotatingFileHandler).')
+flags.DEFINE_boolean(
+        'log_async',
+        True,
+        'Write log records from a background thread.')
 
 
 logger = logging.getLogger('TaskQueueClient')
 
 
+class JsonFormatter(logging.Formatter):
+    """Formats records as JSON objects.
+
+    The fields of a record logged with extra={'fields': {...}} are added to
+    the object.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'logger': record.name,
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, sort_keys=True)
+
+
+class QueueHandler(logging.Handler):
+    """Hands records to a QueueListener; logging.handlers has none in 2.x.
+
+    The records are appended to a deque, which needs no lock, so a record
+    can safely be logged from a signal handler which interrupted another
+    logging call.
+    """
+
+    def __init__(self, records, listener=None):
+        logging.Handler.__init__(self)
+        self.records = records
+        self.listener = listener
+
+    def prepare(self, record):
+        """Formats the message now; args may change before it is written."""
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.records.append(self.prepare(record))
+            if self.listener:
+                self.listener.wakeup()
+        except Exception:
+            self.handleError(record)
+
+    def createLock(self):
+        # Appending to the deque needs no lock.
+        self.lock = None
+
+
+class QueueListener(object):
+    """Writes the records queued by a QueueHandler on a background thread."""
+
+    def __init__(self, records, *handlers):
+        self.records = records
+        self.handlers = handlers
+        self._stopped = False
+        self._thread = None
+        # The writer thread blocks on a self-pipe rather than a Condition:
+        # a record may be logged from a signal handler which interrupted the
+        # holder of a lock, while writing to a pipe takes none.
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        fcntl.fcntl(self._wakeup_w, fcntl.F_SETFL,
+                    fcntl.fcntl(self._wakeup_w, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._monitor,
+                                        name='log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wakeup(self):
+        """Wakes up the writer thread for a new record."""
+        try:
+            os.write(self._wakeup_w, '\0')
+        except OSError, e:
+            # A full pipe already guarantees a wakeup.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _monitor(self):
+        while True:
+            stopped = self._stopped
+            while self.records:
+                self.handle(self.records.popleft())
+            if stopped:
+                return
+            os.read(self._wakeup_r, 4096)
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                try:
+                    handler.handle(record)
+                except Exception:
+                    # Reported on stderr; later records are still written.
+                    handler.handleError(record)
+
+    def stop(self):
+        """Writes the remaining records and stops the thread."""
+        if self._thread:
+            self._stopped = True
+            self.wakeup()
+            self._thread.join()
+            self._thread = None
+        for handler in self.handlers:
+            handler.flush()
+
+
+def _create_file_handler():
+    if FLAGS.log_rotate_when:
+        return logging.handlers.TimedRotatingFileHandler(
+            FLAGS.log_output_file,
+            when=FLAGS.log_rotate_when,
+            backupCount=FLAGS.log_backup_count)
+    # Set size of the log file and the backup count  for rotated log files.
+    return logging.handlers.RotatingFileHandler(
+        FLAGS.log_output_file,
+        maxBytes=FLAGS.log_max_bytes,
+        backupCount=FLAGS.log_backup_count)
+
+
 def set_logger():
     """Settings for taskqueue_puller logger."""
     logger.setLevel(logging.INFO)
 
     # create formatter
-    formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    if FLAGS.log_format == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+                '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-    # Set size of the log file and the backup count  for rotated log files.
-    handler = logging.handlers.RotatingFileHandler(FLAGS.log_output_file,
-                                                   maxBytes = 1024 * 1024,
-                                                   backupCount = 5)
+    handler = _create_file_handler()
     # add formatter to handler
     handler.setFormatter(formatter)
-    # add formatter to handler
+    if FLAGS.log_async:
+        records = collections.deque()
+        listener = QueueListener(records, handler)
+        listener.start()
+        atexit.register(listener.stop)
+        handler = QueueHandler(records, listener)
+    # add handler to logger
     logger.addHandler(handler)
 
 if __name__ == '__main__':
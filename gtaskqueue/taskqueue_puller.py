@@ -0,0 +1,908 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Puller which leases tasks from TaskQueues and executes them.
+
+This module does the following in an infinite loop.
+1. Connects to Task API (of TaskQueues API collection) to request lease on
+   certain number of tasks (specified by user).
+2. Spawns parallel processes to execute the leased tasks.
+3. Polls all the tasks continously till they finish.
+4. Deletes the tasks from taskqueue on their successful completion.
+5. It lets the user specify when to invoke the lease request instead of polling
+   tasks status in a tight loop for better resource utilization:
+      a. Invoke the Lease request when runnning tasks go beyound certain
+         threshold (min_running_tasks)
+      b. Wait time becomes more than specified poll-time-out interval.
+6. Repeat the steps from 1 to 5 when either all tasks have finished executing
+   or one of the conditions in 5) is met. """
+
+
+
+import os
+import sys
+import threading
+import time
+from gtaskqueue import admission
+from gtaskqueue import micro_batch
+from gtaskqueue.ack_queue import AckRetryQueue
+from gtaskqueue.blob_cache import BlobCache
+from gtaskqueue.blob_cache import BlobFetcher
+from gtaskqueue.client_task import ClientTask
+from gtaskqueue.client_task import TEMPFILE_PREFIX
+from gtaskqueue.client_task import cancel_task_lease
+from gtaskqueue.cpu_placement import CorePlacer
+from gtaskqueue.cpu_placement import get_allowed_cpus
+from gtaskqueue.cpu_placement import parse_cpu_list
+from gtaskqueue.housekeeping import Housekeeper
+from gtaskqueue.housekeeping import call_prepoll_url
+from gtaskqueue.housekeeping import remove_stale_tempfiles
+from gtaskqueue.http_pool import get_transport_errors
+from gtaskqueue.lag_autoscaler import LagAutoscaler
+from gtaskqueue.micro_batch import BatchRunner
+from gtaskqueue.output_batcher import OutputBatcher
+from gtaskqueue.output_cache import OutputCache
+from gtaskqueue.task_failures import TaskFailurePolicy
+from gtaskqueue.task_journal import TaskJournal
+from gtaskqueue.task_journal import kill_orphan
+from gtaskqueue.task_table import TaskTable
+from gtaskqueue.tag_scheduler import TagScheduler
+from gtaskqueue.tag_scheduler import parse_tag_specs
+from gtaskqueue.taskqueue_client import TaskQueueClient
+from gtaskqueue.taskqueue_logger import logger
+from gtaskqueue.tuning import TuningFile
+from gtaskqueue.tuning import get_tuning_message
+from gtaskqueue.utils import LEASE_FIELDS
+from gtaskqueue.utils import build_cloudtasks_queue_name
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+        'project_name',
+        'default',
+        'The name of the Taskqueue API project.')
+flags.DEFINE_string(
+        'taskqueue_name',
+        'testpuller',
+        'taskqueue to which client wants to connect to')
+flags.DEFINE_string(
+        'project_location',
+        'us-central1',
+        'The location of the Cloud Tasks project')
+flags.DEFINE_integer(
+        'lease_secs',
+        30,
+        'The lease for the task in seconds')
+flags.DEFINE_integer(
+        'num_tasks',
+        10,
+        'The number of tasks to lease')
+flags.DEFINE_integer(
+        'min_running_tasks',
+        0,
+        'minmum number of tasks below which lease can be invoked')
+flags.DEFINE_float(
+        'sleep_interval_secs',
+        2,
+        'sleep interval when no tasks are found in the taskqueue')
+flags.DEFINE_float(
+        'timeout_secs_for_next_lease_request',
+        600,
+        'Wait time before next poll when no tasks are found in the'
+        'queue (in seconds)')
+flags.DEFINE_integer(
+        'taskapi_requests_per_sec',
+        None,
+        'limit on task_api requests per second')
+flags.DEFINE_float(
+        'sleep_before_next_poll_secs',
+        2,
+        'sleep interval before next poll')
+flags.DEFINE_string(
+        'tag',
+        None,
+        'only retrieve tasks with tag')
+flags.DEFINE_string(
+        'prepoll_url',
+        None,
+        'URL to call periodically, from a background thread, eg. to wake '
+        'up the app enqueueing the tasks.')
+flags.DEFINE_integer(
+        'prepoll_interval_secs',
+        180,
+        'interval to call prepoll_url')
+flags.DEFINE_float(
+        'shutdown_grace_secs',
+        30,
+        'On SIGTERM or SIGINT, time given to running tasks to finish before '
+        'they are killed and their leases cancelled.')
+flags.DEFINE_float(
+        'shutdown_ack_flush_secs',
+        10,
+        'On shutdown, time given to acks which are still being sent.')
+flags.DEFINE_integer(
+        'task_cores_per_task',
+        0,
+        'Pin each running task to a set of this many cores, assigned '
+        'round-robin. 0 disables pinning.')
+flags.DEFINE_string(
+        'task_cpu_list',
+        None,
+        'Cores available to the tasks when pinning, eg. "2-15". Defaults to '
+        'all the cores the puller may run on.')
+flags.DEFINE_float(
+        'stats_interval_secs',
+        300,
+        'Interval at which the puller logs its statistics, from a '
+        'background thread.')
+
+
+# On shutdown, time given to a housekeeping job which is running to return.
+_HOUSEKEEPING_STOP_SECS = 1
+
+
+class TaskQueuePuller(object):
+    """Maintains state information for TaskQueuePuller.
+
+    The puller reaps all of its children with os.wait4(-1), so nothing else
+    in the process should rely on waiting for its own subprocesses.
+    """
+
+    def __init__(self, task_api=None, clock=time, task_factory=ClientTask):
+        """Constructor.
+
+        Args:
+            task_api: handle for taskqueue api collection; by default one is
+                built from the flags.
+            clock: object with the time() and sleep() functions of the time
+                module, which is the default. All the scheduling decisions
+                of the puller are timed with it, so that they can be
+                replayed against a virtual clock.
+            task_factory: callable making a task object from a leased task
+                and the keyword arguments of ClientTask.
+        """
+        self._clock = clock
+        self._task_factory = task_factory
+        self._last_lease_time = None
+        self._poll_timeout_start = None
+        self._num_last_leased_tasks = 0
+        self._shutting_down = False
+        # Running tasks by task id and by pid, with their timeouts.
+        self._task_table = TaskTable()
+        self._batch_runner = None
+        if micro_batch.is_enabled():
+            self._batch_runner = BatchRunner(self._task_table)
+        self._core_placer = None
+        if FLAGS.task_cores_per_task > 0:
+            try:
+                if FLAGS.task_cpu_list:
+                    cpus = parse_cpu_list(FLAGS.task_cpu_list)
+                else:
+                    cpus = get_allowed_cpus()
+                self._core_placer = CorePlacer(cpus,
+                                               FLAGS.task_cores_per_task)
+            except ValueError, value_error:
+                logger.error('Not placing tasks on cores: %s (cpu list %r)'
+                             % (str(value_error), FLAGS.task_cpu_list))
+        self._failure_policy = TaskFailurePolicy(FLAGS.lease_secs)
+        self._admission = None
+        if admission.is_enabled():
+            self._admission = admission.AdmissionController()
+        self._tag_scheduler = None
+        # Tag entry each running task counts against, by task id.
+        self._task_tags = {}
+        if FLAGS.tags:
+            if FLAGS.tag:
+                raise ValueError('--tag and --tags can not be used together')
+            self._tag_scheduler = TagScheduler(parse_tag_specs(FLAGS.tags))
+        self._output_cache = None
+        if FLAGS.output_cache_dir:
+            self._output_cache = OutputCache(
+                FLAGS.output_cache_dir,
+                FLAGS.output_cache_max_mb * 1024 * 1024,
+                FLAGS.output_cache_ttl_secs)
+        self._blob_fetcher = None
+        if FLAGS.claim_check_payloads:
+            self._blob_fetcher = BlobFetcher(
+                BlobCache(FLAGS.blob_cache_dir,
+                          FLAGS.blob_cache_max_mb * 1024 * 1024,
+                          FLAGS.claim_check_local_roots),
+                on_done=self._on_fetch_done)
+        self._output_batcher = None
+        if FLAGS.output_batch_url:
+            self._output_batcher = OutputBatcher(
+                FLAGS.output_batch_url,
+                FLAGS.output_batch_max_tasks,
+                FLAGS.output_batch_max_bytes,
+                FLAGS.output_batch_linger_secs,
+                FLAGS.output_batch_timeout_secs,
+                ClientTask.get_auth_headers)
+        self._autoscaler = None
+        if FLAGS.target_lag_secs > 0:
+            self._autoscaler = LagAutoscaler(
+                FLAGS.num_tasks,
+                FLAGS.min_num_tasks,
+                FLAGS.max_num_tasks or FLAGS.num_tasks,
+                FLAGS.target_lag_secs,
+                FLAGS.autoscale_interval_secs,
+                FLAGS.autoscale_status_file)
+        self._tuning = None
+        if FLAGS.tuning_file:
+            self._tuning = TuningFile(FLAGS.tuning_file,
+                                      FLAGS.tuning_check_interval_secs)
+            self._maybe_reload_tuning()
+        else:
+            logger.info(get_tuning_message())
+        self.task_api = task_api
+        self._http_pool = http_pool = None
+        if task_api is None:
+            from apiclient.errors import HttpError
+            try:
+                self.__tcq = TaskQueueClient()
+                self.task_api = self.__tcq.get_taskapi()
+                self._http_pool = http_pool = self.__tcq.get_http_pool()
+            except HttpError, http_error:
+                logger.error('Could not get TaskQueue API handler and hence' \
+                           'exiting: %s' % str(http_error))
+                sys.exit()
+        self._journal = None
+        if FLAGS.journal_file:
+            self._journal = TaskJournal(FLAGS.journal_file,
+                                        FLAGS.journal_flush_secs)
+        self._ack_queue = AckRetryQueue(self.task_api, journal=self._journal)
+        if http_pool:
+            # The main loop must not sleep through retries: its calls are
+            # made again at a later poll. Failed acks are retried, without
+            # blocking anyone, by the ack retry queue.
+            http_pool.set_single_attempt(threading.current_thread(),
+                                         ['acknowledge'])
+        if self._journal:
+            self._recover_from_journal()
+        self._ack_queue.start()
+        self._housekeeper = Housekeeper()
+        self._add_housekeeping_jobs(http_pool)
+        self._housekeeper.start()
+
+    def _add_housekeeping_jobs(self, http_pool):
+        """Schedules the periodic jobs which run off the lease loop.
+
+        Args:
+            http_pool: AuthorizedHttpPool of the API calls, None when the
+                task_api handle was given to the constructor.
+        """
+        if FLAGS.prepoll_url:
+            self._housekeeper.add_job(
+                'prepoll', FLAGS.prepoll_interval_secs,
+                lambda: call_prepoll_url(FLAGS.prepoll_url,
+                                         FLAGS.prepoll_timeout_secs))
+        self._housekeeper.add_job('stats', FLAGS.stats_interval_secs,
+                                  self._log_stats)
+        if http_pool and FLAGS.credentials_refresh_margin_secs > 0:
+            self._housekeeper.add_job(
+                'credentials', FLAGS.credentials_check_interval_secs,
+                lambda: http_pool.refresh_credentials_if_expiring(
+                    FLAGS.credentials_refresh_margin_secs))
+        self._housekeeper.add_job('tempfile_gc',
+                                  FLAGS.tempfile_gc_interval_secs,
+                                  self._remove_stale_tempfiles)
+
+    def _remove_stale_tempfiles(self):
+        """Removes task files left behind by pullers which crashed.
+
+        Runs on the housekeeping thread; values() copies the tasks in one
+        step, and a file created since is too recent to be removed anyway.
+        """
+        in_use = []
+        for task in self._task_table.values():
+            in_use.extend(task.get_temp_files())
+        if self._batch_runner:
+            in_use.extend(self._batch_runner.get_temp_files())
+        remove_stale_tempfiles(TEMPFILE_PREFIX, FLAGS.tempfile_max_age_secs,
+                               in_use)
+
+    def _recover_from_journal(self):
+        """Cleans up after the tasks of a previous run which died.
+
+        Tasks which finished are acked, through the ack retry queue. The
+        process groups of tasks which were still running are killed, as
+        their exit status can not be collected by this process, and the
+        leases of all the other tasks are cancelled so that they are
+        redelivered at once.
+        """
+        tasks = self._journal.get_recovered_tasks()
+        if not tasks:
+            return
+        logger.info('Recovering %d tasks from journal %s'
+                    % (len(tasks), FLAGS.journal_file))
+        for task in tasks:
+            task_name = task['name']
+            if (task.get('status') == 0 and
+                    (task.get('posted') or
+                     not (FLAGS.output_url or FLAGS.output_batch_url))):
+                logger.info('Acking task %s finished by the previous run'
+                            % task_name)
+                self._ack_queue.record_completed(task_name.rsplit('/', 1)[1])
+                self._ack_queue.add(task_name, task.get('schedule_time'))
+            else:
+                if task.get('pid') and task.get('status') is None:
+                    # A batch process has the manifest on its command line.
+                    if kill_orphan(task['pid'], task.get('batch_manifest') or
+                                   task.get('input_file')):
+                        logger.info('Killed orphaned process %d of task %s'
+                                    % (task['pid'], task_name))
+                cancel_task_lease(self.task_api, task_name,
+                                  task.get('schedule_time'))
+            for path in (task.get('input_file'), task.get('output_file')):
+                if path and os.path.exists(path):
+                    os.remove(path)
+
+    def _can_lease(self):
+        """Determines if new tasks can be leased.
+
+        Determines if new taks can be leased based on
+            1. Number of tasks already running in the system.
+            2. Limit on accessing the taskqueue apirary.
+
+        Returns:
+            True/False.
+        """
+        if self._num_tasks_to_lease() > 0 and not self._is_rate_exceeded():
+            return True
+        else:
+            return False
+
+    def _is_rate_exceeded(self):
+
+        """Determines if requests/second to TaskQueue API has exceeded limit.
+
+        We do not access the APIs beyond the specified permissible limit.
+        If we have run N tasks in elapsed time since last lease, we have
+        already made N+1 requests to API (1 for collective lease and N for
+        their individual delete operations). If K reqs/sec is the limit on
+        accessing APIs, then we sould not invoke any request to API before
+        N+1/K sec approximately. The above condition is formulated in the
+        following method.
+        Returns:
+          True/False
+        """
+        if not FLAGS.taskapi_requests_per_sec:
+            return False
+        if not self._last_lease_time:
+            return False
+        curr_time = self._clock.time()
+        if ((curr_time - self._last_lease_time) <
+                ((1.0 * (self._num_last_leased_tasks -
+                         len(self._task_table)) /
+                    FLAGS.taskapi_requests_per_sec))):
+            return True
+        else:
+            return False
+
+    def _num_tasks_to_lease(self):
+
+        """Determines how many tasks can be leased.
+
+        num_tasks is upper limit to running tasks in the system and hence
+        number of tasks which could be leased is difference of numtasks and
+        currently running tasks.
+
+        With --target_lag_secs, the upper limit is set by the autoscaler
+        instead. With --tags, it is also limited by the free slots of the
+        tags, and with admission budgets by the number of average tasks
+        which fit.
+
+        Returns:
+            Number of tasks to lease.
+        """
+        max_running_tasks = FLAGS.num_tasks
+        if self._autoscaler:
+            max_running_tasks = self._autoscaler.num_tasks
+        num_tasks = max_running_tasks - len(self._task_table)
+        if self._tag_scheduler:
+            free_slots = self._tag_scheduler.free_slots()
+            if free_slots is not None:
+                num_tasks = min(num_tasks, free_slots)
+        if self._admission and num_tasks > 0:
+            num_tasks = self._admission.max_tasks_to_lease(num_tasks)
+        return num_tasks
+
+    def _update_last_lease_info(self, result):
+
+        """Updates the information regarding last lease.
+
+        Args:
+            result: Response object from TaskQueue API, containing list of
+            tasks.
+        """
+        self._last_lease_time = self._clock.time()
+        if result:
+            if result.get('tasks'):
+                self._num_last_leased_tasks = len(result.get('tasks'))
+            else:
+                self._num_last_leased_tasks = 0
+        else:
+            self._num_last_leased_tasks = 0
+
+    def _update_poll_timeout_start(self):
+
+        """Updates the start time for poll-timeout."""
+        if not self._poll_timeout_start:
+            self._poll_timeout_start = self._clock.time()
+
+    def _continue_polling(self):
+
+        """Checks whether lease can be invoked based on running tasks and
+        timeout.
+
+        Lease can be invoked if
+        1. Running tasks in the sytem has gone below the specified
+           threshold (min_running_tasks).
+        2. Wait time has exceeded beyond time-out specified and at least one
+           tas has finished since last lease invocation.
+
+        By doing this, we are essentially trying to batch the lease requests.
+        If this is not done and we start off leasing N tasks, its likely tasks
+        may finish slightly one after another, and we make N lease requests for
+        each task for next N tasks and so on. This can result in unnecessary
+        lease API call and hence to avoid that, we try and batch the lease
+        requests. Also we put certain limit on wait time for batching the
+        requests by incororating the time-out.
+
+        Returns:
+            True/False
+        """
+        if len(self._task_table) <= FLAGS.min_running_tasks:
+            return False
+        if self._poll_timeout_start:
+            elapsed_time = self._clock.time() - self._poll_timeout_start
+            if elapsed_time > FLAGS.timeout_secs_for_next_lease_request:
+                self._poll_timeout_start = None
+                return False
+        return True
+
+    def _get_tasks_from_queue(self):
+
+        """Gets the available tasks from the taskqueue.
+
+        With --tags, the free task slots are filled with one lease request
+        per tag, in the order chosen by the tag scheduler, and the tasks of
+        all the requests are returned together.
+
+        Returns:
+            Lease response object.
+        """
+        if not self._tag_scheduler:
+            return self._lease_tasks_with_tag(self._num_tasks_to_lease(),
+                                              FLAGS.tag)
+        result = None
+        tags = []
+        while True:
+            num_slots = self._num_tasks_to_lease()
+            if result:
+                num_slots -= len(result.get('tasks', []))
+            choice = self._tag_scheduler.choose(num_slots, tags)
+            if not choice:
+                if result is None and not tags:
+                    # No tag may be leased now, which is not an error.
+                    return {}
+                return result
+            (tag, max_tasks) = choice
+            tags.append(tag)
+            tag_result = self._lease_tasks_with_tag(max_tasks, tag)
+            if tag_result is None:
+                continue
+            tasks = tag_result.get('tasks', [])
+            self._tag_scheduler.record_lease(tag, max_tasks, tasks)
+            if result is None:
+                result = {}
+            if tasks:
+                result.setdefault('tasks', []).extend(tasks)
+
+    def _lease_tasks_with_tag(self, max_tasks, tag):
+
+        """Sends a lease request for up to max_tasks tasks.
+
+        Args:
+            max_tasks: number of tasks to lease.
+            tag: only lease tasks with this tag, if set.
+
+        Returns:
+            Lease response object, None on error.
+        """
+        from apiclient.errors import HttpError
+        try:
+            parent = build_cloudtasks_queue_name(FLAGS.project_name, FLAGS.project_location, FLAGS.taskqueue_name)
+            body = {
+                'maxTasks': max_tasks,
+                'leaseDuration': '%ss' % FLAGS.lease_secs,
+                'responseView': 'FULL',
+            }
+            if tag:
+                body['filter'] = 'tag=' + tag
+            lease_req = self.task_api.projects().locations().queues().tasks().lease(
+                parent=parent,
+                body=body,
+                fields=LEASE_FIELDS
+            )
+            result = lease_req.execute()
+            if self._autoscaler:
+                self._autoscaler.record_lease(max_tasks,
+                                              result.get('tasks', []))
+            return result
+        except (HttpError,) + get_transport_errors(), http_error:
+            # Sent again at the next poll.
+            logger.error('Error during lease request: %s' % str(http_error))
+            return None
+
+    def _create_subprocesses_for_tasks(self, result):
+
+        """Spawns parallel sub processes to execute tasks for better
+        throughput.
+
+        Args:
+            result: lease resonse dictionary object.
+        """
+        if not result:
+            logger.debug('Error: result is not defined')
+            return None
+        if self._tag_scheduler:
+            names = [task.get('name') for task in result.get('tasks', [])]
+        if self._shutting_down:
+            # A lease sent before the shutdown request came back; hand the
+            # tasks straight back to the queue instead of starting them.
+            for task in result.get('tasks', []):
+                cancel_task_lease(self.task_api, task.get('name'),
+                                  task.get('scheduleTime'))
+            if self._tag_scheduler:
+                self._tag_scheduler.forget_leases(names)
+            return None
+        if result.get('tasks'):
+            for task in result.get('tasks'):
+                task_name = task.get('name')
+                task_id = task_name.rsplit('/', 1)[1]
+                task_schedule_time = task.get('scheduleTime')
+                # Given that a task may be leased multiple times, we may get a
+                # task which we are currently executing on, so make sure we
+                # dont spaw another subprocess for it.
+                if self._ack_queue.was_completed(task_id):
+                    # Completed here before but its ack did not go through;
+                    # ack it with the schedule time of this lease.
+                    logger.info('Re-acking completed task %s' % task_id)
+                    self._ack_queue.add(task_name, task_schedule_time)
+                elif task_id in self._task_table:
+                    pass
+                elif (self._admission and
+                      not self._admission.admit(task_id, task)):
+                    # Hand the task to a worker with room for it now rather
+                    # than holding it while its lease runs.
+                    logger.info('Task %s does not fit in the admission '
+                                'budgets, cancelling its lease' % task_id)
+                    cancel_task_lease(self.task_api, task_name,
+                                      task_schedule_time)
+                else:
+                    if self._journal:
+                        self._journal.record(task_name, 'lease',
+                                             schedule_time=task_schedule_time)
+                    cpus = None
+                    if self._core_placer:
+                        cpus = self._core_placer.acquire()
+                    ct = self._task_factory(
+                        task, cpus=cpus,
+                        failure_policy=self._failure_policy,
+                        ack_queue=self._ack_queue,
+                        output_cache=self._output_cache,
+                        journal=self._journal,
+                        output_batcher=self._output_batcher,
+                        blob_fetcher=self._blob_fetcher,
+                        batch_runner=self._batch_runner)
+                    # Check if tasks got initialized properly and then pu them
+                    # in running tasks map.
+                    if ct.init():
+                        self._add_running_task(ct)
+                    else:
+                        if self._journal:
+                            self._journal.record(task_name, 'release')
+                        if self._admission:
+                            self._admission.release(task_id)
+                        if cpus:
+                            self._core_placer.release(cpus)
+        if self._tag_scheduler:
+            self._tag_scheduler.forget_leases(names)
+
+    def _log_stats(self):
+        """Logs the statistics of the puller.
+
+        Runs on the housekeeping thread, so the statistics of each part
+        are read under its own lock or as plain counters.
+        """
+        if self._output_cache:
+            logger.info(self._output_cache.get_stats_message())
+        if self._tag_scheduler:
+            logger.info(self._tag_scheduler.get_stats_message())
+        if self._admission:
+            logger.info(self._admission.get_stats_message())
+        if self._autoscaler:
+            logger.info(self._autoscaler.get_stats_message())
+        if self._output_batcher:
+            logger.info(self._output_batcher.get_stats_message())
+        if self._blob_fetcher:
+            logger.info(self._blob_fetcher.get_stats_message())
+        if self._batch_runner:
+            logger.info(self._batch_runner.get_stats_message())
+        if self._http_pool:
+            logger.info(self._http_pool.get_stats_message())
+        logger.info(self._housekeeper.get_stats_message())
+
+    def _maybe_autoscale(self):
+        if self._autoscaler:
+            self._autoscaler.maybe_update(len(self._task_table))
+
+    def request_tuning_reload(self):
+        """Rereads the tuning file; called from the signal handler."""
+        if self._tuning:
+            self._tuning.request_reload()
+
+    def _maybe_reload_tuning(self):
+        """Applies the tuning file if it changed.
+
+        Flags are read where they are used, so most changes apply by
+        themselves from the next lease on; this updates the state derived
+        from them. Running tasks are never killed: above a lower num_tasks,
+        no task is leased until enough of them have finished.
+        """
+        if not self._tuning:
+            return
+        changed = self._tuning.maybe_reload()
+        if 'lease_secs' in changed:
+            self._failure_policy.lease_secs = FLAGS.lease_secs
+        if (self._autoscaler and 'num_tasks' in changed and
+                not FLAGS.max_num_tasks):
+            self._autoscaler.set_max_num_tasks(FLAGS.num_tasks)
+        if 'num_tasks' in changed and self._num_tasks_to_lease() < 0:
+            logger.info('%d tasks running, above the new limit; leasing '
+                        'resumes once they drain below it'
+                        % len(self._task_table))
+
+    def _add_running_task(self, task):
+        """Starts tracking a task whose execution has started.
+
+        Args:
+            task: ClientTask object.
+        """
+        # Keep track of the clientTask objects, which are used later to
+        # delete the tasks from taskqueue
+        self._task_table.add(task)
+        if self._tag_scheduler:
+            self._task_tags[task.get_task_id()] = (
+                self._tag_scheduler.task_started(task.task_name))
+
+    def _remove_running_task(self, task):
+        """Stops tracking a task which has completed.
+
+        Args:
+            task: ClientTask object.
+        """
+        self._task_table.remove(task.get_task_id())
+        if self._admission:
+            self._admission.release(task.get_task_id(),
+                                    task.get_max_rss_bytes())
+        if self._tag_scheduler:
+            self._tag_scheduler.task_finished(
+                self._task_tags.pop(task.get_task_id(), None))
+        if self._core_placer and task.get_cpus():
+            self._core_placer.release(task.get_cpus())
+        # updates scheduling information for later use.
+        self._update_poll_timeout_start()
+
+    def _poll_running_tasks(self):
+
+        """Polls the running tasks and delete them from taskqueue if
+        completed.
+
+        Only the tasks whose child exited, and those due for a timeout or a
+        retry, are looked at.
+        """
+        self._maybe_reload_tuning()
+        self._maybe_autoscale()
+        for task in self._task_table.reap_children():
+            self._check_task(task)
+        for task in self._start_due_batches():
+            self._check_task(task)
+        for task in self._task_table.pop_due(self._clock.time()):
+            self._check_task(task)
+        for task in self._pop_fetched_tasks():
+            self._check_task(task)
+
+    def _on_fetch_done(self):
+        """Called on a fetcher thread when the input of a task is fetched.
+
+        The task is started by the next poll.
+        """
+
+    def _pop_fetched_tasks(self):
+        """Returns the tasks whose input was fetched since the last call.
+
+        Tasks given up or abandoned in the meantime are left out.
+        """
+        if not self._blob_fetcher:
+            return []
+        return [task for task in self._blob_fetcher.pop_done()
+                if task.is_fetching() and
+                self._task_table.get(task.get_task_id()) is task]
+
+    def _start_due_batches(self):
+        """Starts the batches which are due in micro-batch mode.
+
+        Returns:
+            List of the tasks whose batch failed to start.
+        """
+        if not self._batch_runner:
+            return []
+        return self._batch_runner.poll(self._clock.time(),
+                                       self._num_tasks_to_lease() > 0)
+
+    def _get_next_wakeup_time(self):
+        """Returns when a task or batch needs looking at, None if never."""
+        wakeup_time = self._task_table.get_next_wakeup_time()
+        if self._batch_runner:
+            batch_time = self._batch_runner.get_next_wakeup_time()
+            if wakeup_time is None or (batch_time is not None and
+                                       batch_time < wakeup_time):
+                wakeup_time = batch_time
+        return wakeup_time
+
+    def _check_task(self, task):
+        """Completes, retries or times out a task, as its state requires."""
+        if task.is_completed(self.task_api):
+            self._remove_running_task(task)
+        else:
+            self._task_table.track(task)
+
+    def _sleep_before_next_lease(self):
+
+        """Sleeps before invoking lease if required based on last lease info.
+
+        It sleeps when no tasks were found on the taskqueue during last lease
+        request. To note, it discount the time taken in polling the tasks and
+        sleeps for (sleep_interval - time taken in poll). This avoids the
+        unnecessary wait if tasks could be leased. If no time was taken in
+        poll since there were not tasks in the system, it waits for full sleep
+        interval and thus optimizes the CPU cycles.
+        It does not sleep if the method is called for the first time (when no
+        lease request has ever been made).
+        """
+        if not self._last_lease_time:
+            sleep_secs = 0
+        elif self._num_last_leased_tasks <= 0:
+            time_elpased_since_last_lease = (self._clock.time() -
+                                             self._last_lease_time)
+            sleep_secs = (FLAGS.sleep_interval_secs -
+                          time_elpased_since_last_lease)
+            if sleep_secs > 0:
+                logger.debug('No tasks found and hence sleeping for sometime')
+                self._clock.sleep(FLAGS.sleep_interval_secs)
+
+    def lease_tasks(self):
+
+        """Requests lease for specified number of tasks.
+
+        It invokes lease request for appropriate number of tasks, spawns
+        parallel processes to execute them and also maintains scheduling
+        information.
+
+        LeaseTask also takes care of waiting(sleeping) before invoking lease if
+        there are no tasks which can be leased in the taskqueue. This results
+        in better resource utilization. Apart from this, it also controls the
+        number of requests being sent to taskqueue APIs.
+
+        Returns:
+        True/False based on if tasks could be leased or not.
+        """
+        if self._shutting_down:
+            return False
+        self._sleep_before_next_lease()
+        if not self._shutting_down and self._can_lease():
+            result = self._get_tasks_from_queue()
+            self._update_last_lease_info(result)
+            self._create_subprocesses_for_tasks(result)
+            return True
+        return False
+
+    def poll_tasks(self):
+
+        """Polls the status of running tasks of the system.
+
+        Polls the status of tasks and then decides if it should continue to
+        poll depending on number of tasks running in the system and timeouts.
+        Instead of polling in a tight loop, it sleeps for sometime before the
+        next poll to avoid any unnecessary CPU cycles. poll_tasks returns
+        only when system has capability to accomodate at least one new task.
+        """
+
+        self._poll_running_tasks()
+        while not self._shutting_down and self._continue_polling():
+            logger.debug('Sleeping before next poll')
+            self._wait_before_next_poll(FLAGS.sleep_before_next_poll_secs)
+            self._poll_running_tasks()
+
+    def _wait_before_next_poll(self, timeout):
+        """Sleeps for timeout seconds between two polls."""
+        self._clock.sleep(max(0, timeout))
+
+    def request_shutdown(self):
+        """Stops leasing new tasks; called from the signal handler."""
+        self._shutting_down = True
+
+    def is_shutting_down(self):
+        return self._shutting_down
+
+    def _has_pending_work(self):
+        """Returns True while there are tasks which may still complete."""
+        return bool(self._task_table)
+
+    def _abandon_running_tasks(self):
+        """Kills the running tasks and cancels their leases."""
+        for task in self._task_table.values():
+            task.abandon(self.task_api)
+            self._remove_running_task(task)
+
+    def _flush_pending_acks(self, timeout):
+        """Waits up to timeout seconds for outstanding acks to be sent.
+
+        Acks are sent inline by this engine, so there is nothing to wait for.
+        """
+        pass
+
+    def drain(self, grace_secs):
+        """Shuts the puller down without losing or delaying work.
+
+        No new tasks are leased. Running tasks get up to grace_secs to
+        finish and be acknowledged as usual; the ones still running after
+        that are killed together with their process group and their leases
+        cancelled, so other workers can pick them up immediately instead of
+        after the lease expires.
+
+        Args:
+            grace_secs: time given to the running tasks to finish.
+        """
+        self.request_shutdown()
+        logger.info('Shutting down, waiting up to %ss for %d running tasks'
+                    % (grace_secs, len(self._task_table)))
+        deadline = self._clock.time() + grace_secs
+        self._poll_running_tasks()
+        while self._has_pending_work() and self._clock.time() < deadline:
+            self._wait_before_next_poll(
+                min(FLAGS.sleep_before_next_poll_secs,
+                    deadline - self._clock.time()))
+            self._poll_running_tasks()
+        if self._task_table:
+            logger.info('Abandoning %d tasks still running'
+                        % len(self._task_table))
+        if self._batch_runner:
+            self._batch_runner.kill_all()
+        self._abandon_running_tasks()
+        deadline = self._clock.time() + FLAGS.shutdown_ack_flush_secs
+        self._flush_pending_acks(FLAGS.shutdown_ack_flush_secs)
+        if self._output_batcher and not self._output_batcher.close(
+                max(0, deadline - self._clock.time())):
+            logger.error('Gave up waiting for batched outputs to be posted')
+        self._ack_queue.flush(max(0, deadline - self._clock.time()))
+        self._ack_queue.stop()
+        if self._journal:
+            self._journal.close()
+        self._housekeeper.stop(_HOUSEKEEPING_STOP_SECS)
+        self._log_stats()
+        logger.info('Shutdown complete')
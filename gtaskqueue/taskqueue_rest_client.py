@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Hand-written client for the Cloud Tasks endpoints used in a tight loop.
+
+The discovery based client returned by apiclient.discovery.build creates
+method objects, validates every parameter against the discovery document and
+serializes through its model layer on each call. For the handful of task
+methods the puller calls over and over that work is pure overhead, so this
+module builds the requests directly. It mirrors the resource layout of the
+discovery client:
+
+    api.projects().locations().queues().tasks().lease(parent=..., body=...)
+
+so it can be used wherever the discovery client is, and errors are raised as
+apiclient.errors.HttpError just like the discovery client does.
+"""
+
+
+
+import json
+import urllib
+
+# Google APIs only compress responses for clients whose user agent contains
+# "gzip", as the discovery client's does.
+USER_AGENT = 'gtaskqueue-static-client/1.0 (gzip)'
+
+
+class StaticHttpRequest(object):
+    """A single prepared API request, executed with execute()."""
+
+    def __init__(self, http, method, uri, body=None):
+        self.http = http
+        self.method = method
+        self.uri = uri
+        self.body = body
+
+    def execute(self, http=None):
+        """Executes the request.
+
+        Args:
+            http: Optional httplib2.Http like object to use instead of the one
+                the request was created with.
+
+        Returns:
+            The deserialized JSON response, {} for an empty response.
+
+        Raises:
+            apiclient.errors.HttpError: if the response was not a 2xx.
+        """
+        http = http or self.http
+        headers = {'accept': 'application/json',
+                   'accept-encoding': 'gzip, deflate',
+                   'user-agent': USER_AGENT}
+        body = None
+        if self.body is not None:
+            headers['content-type'] = 'application/json'
+            body = json.dumps(self.body)
+        resp, content = http.request(self.uri, method=self.method, body=body,
+                                     headers=headers)
+        if resp.status >= 300:
+            from apiclient.errors import HttpError
+            raise HttpError(resp, content, uri=self.uri)
+        if not content:
+            return {}
+        return json.loads(content)
+
+
+class _Resource(object):
+    """Base for the resources, holds the transport and the base url."""
+
+    def __init__(self, http, base_url):
+        self._http = http
+        self._base_url = base_url
+
+    def _request(self, method, path, query=None, body=None):
+        uri = self._base_url + path
+        if query:
+            query = dict((k, v) for (k, v) in query.iteritems()
+                         if v is not None)
+            if query:
+                uri += '?' + urllib.urlencode(sorted(query.items()))
+        return StaticHttpRequest(self._http, method, uri, body)
+
+
+class TasksResource(_Resource):
+    """The projects.locations.queues.tasks collection.
+
+    Every method accepts extra keyword arguments which are sent as query
+    parameters (for example fields or quotaUser), like the standard
+    parameters of the discovery client.
+    """
+
+    def lease(self, parent, body, **query):
+        return self._request('POST', parent + '/tasks:lease', query, body)
+
+    def acknowledge(self, name, body, **query):
+        return self._request('POST', name + ':acknowledge', query, body)
+
+    def renewLease(self, name, body, **query):
+        return self._request('POST', name + ':renewLease', query, body)
+
+    def cancelLease(self, name, body, **query):
+        return self._request('POST', name + ':cancelLease', query, body)
+
+    def get(self, name, responseView=None, **query):
+        query['responseView'] = responseView
+        return self._request('GET', name, query)
+
+    def list(self, parent, responseView=None, pageSize=None, pageToken=None,
+             **query):
+        query.update({'responseView': responseView,
+                      'pageSize': pageSize,
+                      'pageToken': pageToken})
+        return self._request('GET', parent + '/tasks', query)
+
+    def delete(self, name, **query):
+        return self._request('DELETE', name, query)
+
+
+class QueuesResource(_Resource):
+    """The projects.locations.queues collection."""
+
+    def tasks(self):
+        return TasksResource(self._http, self._base_url)
+
+
+class LocationsResource(_Resource):
+    """The projects.locations collection."""
+
+    def queues(self):
+        return QueuesResource(self._http, self._base_url)
+
+
+class ProjectsResource(_Resource):
+    """The projects collection."""
+
+    def locations(self):
+        return LocationsResource(self._http, self._base_url)
+
+
+class StaticTaskApi(_Resource):
+    """Drop-in replacement for the discovery built cloudtasks client.
+
+    Only the task methods used by the puller are implemented: lease,
+    acknowledge, renewLease, cancelLease, get, list and delete.
+    """
+
+    def __init__(self, http, api_host, service_version):
+        """Constructor.
+
+        Args:
+            http: An authorized httplib2.Http or something that acts like it.
+            api_host: API host, eg. https://cloudtasks.googleapis.com/.
+            service_version: API version, eg. v2beta2.
+        """
+        if not api_host.endswith('/'):
+            api_host += '/'
+        _Resource.__init__(self, http, api_host + service_version + '/')
+
+    def projects(self):
+        return ProjectsResource(self._http, self._base_url)
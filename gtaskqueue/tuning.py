@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reloads the tuning flags of a running puller from a file.
+
+The tuning file holds flags in the flagfile syntax, one per line:
+    # Comments and blank lines are ignored.
+    --num_tasks=40
+    --lease_secs=60
+Only the flags in TUNABLE_FLAGS may be set. The file is read at startup,
+whenever its mtime changes (checked every tuning_check_interval_secs) and on
+SIGHUP. A flag which is removed from the file goes back to its command line
+value. A file with an unknown flag or a bad value is rejected as a whole and
+the current values are kept.
+
+The new values apply from the next lease on: the running tasks keep their
+leases and timeouts, and a lower num_tasks stops leasing until enough
+running tasks have finished, rather than killing any.
+"""
+
+
+
+import os
+import time
+from gtaskqueue.taskqueue_logger import logger
+import gflags as flags
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+        'tuning_file',
+        None,
+        'File of tuning flags, eg. "--num_tasks=40", reloaded when it '
+        'changes and on SIGHUP without restarting the puller.')
+flags.DEFINE_float(
+        'tuning_check_interval_secs',
+        5,
+        'Interval at which the mtime of --tuning_file is checked.')
+
+# Flags which may be changed while the puller runs, and the lowest value
+# each of them accepts.
+TUNABLE_FLAGS = (
+    ('num_tasks', 1),
+    ('min_running_tasks', 0),
+    ('taskapi_requests_per_sec', 0),
+    ('lease_secs', 1),
+    ('task_timeout_secs', 1),
+)
+
+
+class TuningError(Exception):
+    """Raised when the tuning file can not be applied."""
+
+
+def get_tuning_message():
+    """Returns the current values of the tunable flags."""
+    return 'Tuning: ' + ' '.join(
+        '%s=%s' % (name, getattr(FLAGS, name)) for (name, _) in TUNABLE_FLAGS)
+
+
+def parse_tuning(text):
+    """Parses the content of a tuning file.
+
+    Returns:
+        Dict of the flag values by flag name.
+
+    Raises:
+        TuningError: if a line is not a tunable flag with a valid value.
+    """
+    lower_bounds = dict(TUNABLE_FLAGS)
+    values = {}
+    for (line_number, line) in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        (name, sep, value) = line.lstrip('-').partition('=')
+        if not line.startswith('--') or not sep:
+            raise TuningError('Line %d: expected --<flag>=<value>, got %r'
+                              % (line_number, line))
+        if name not in lower_bounds:
+            raise TuningError('Line %d: %s can not be tuned at run time'
+                              % (line_number, name))
+        try:
+            value = FLAGS[name].parser.Parse(value.strip())
+        except ValueError, error:
+            raise TuningError('Line %d: bad value for %s: %s'
+                              % (line_number, name, error))
+        if value < lower_bounds[name]:
+            raise TuningError('Line %d: %s must be at least %s'
+                              % (line_number, name, lower_bounds[name]))
+        values[name] = value
+    return values
+
+
+class TuningFile(object):
+    """Applies the flags of a tuning file when it changes."""
+
+    def __init__(self, path, check_interval_secs):
+        """Constructor.
+
+        Args:
+            path: tuning file.
+            check_interval_secs: interval between two mtime checks.
+        """
+        self._path = path
+        self._check_interval_secs = check_interval_secs
+        # Values given on the command line, restored when a flag is removed
+        # from the file.
+        self._defaults = dict((name, getattr(FLAGS, name))
+                              for (name, _) in TUNABLE_FLAGS)
+        self._mtime = None
+        self._last_check_time = 0
+        self._reload_requested = True
+
+    def request_reload(self):
+        """Rereads the file on the next check; safe in a signal handler."""
+        self._reload_requested = True
+
+    def maybe_reload(self):
+        """Applies the file if it changed or a reload was requested.
+
+        Returns:
+            List of the names of the flags which changed.
+        """
+        now = time.time()
+        if (not self._reload_requested and
+                now - self._last_check_time < self._check_interval_secs):
+            return []
+        self._last_check_time = now
+        requested = self._reload_requested
+        self._reload_requested = False
+        try:
+            mtime = os.stat(self._path).st_mtime
+        except OSError, error:
+            if requested or self._mtime is not None:
+                logger.error('Error reading tuning file %s. Error details %s'
+                             % (self._path, str(error)))
+                self._mtime = None
+            return []
+        if mtime == self._mtime and not requested:
+            return []
+        self._mtime = mtime
+        try:
+            f = open(self._path)
+            try:
+                values = parse_tuning(f.read())
+            finally:
+                f.close()
+        except (IOError, TuningError), error:
+            logger.error('Ignoring tuning file %s, keeping the current '
+                         'values. Error details %s' % (self._path, str(error)))
+            return []
+        changed = []
+        for (name, _) in TUNABLE_FLAGS:
+            value = values.get(name, self._defaults[name])
+            if getattr(FLAGS, name) != value:
+                setattr(FLAGS, name, value)
+                changed.append(name)
+        logger.info('Loaded tuning file %s, changed %s. %s'
+                    % (self._path, ', '.join(changed) or 'nothing',
+                       get_tuning_message()))
+        return changed
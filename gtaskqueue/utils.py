@@ -1,4 +1,13 @@
+import calendar
 import os
+import time
+
+# Fields of a leased task read by the puller; lease responses are limited to
+# them, which leaves out the view and the other status fields. Kept here so
+# that the command-line tool shares them without importing the puller.
+TASK_FIELDS = ('name,scheduleTime,createTime,status/attemptDispatchCount,'
+               'pullMessage')
+LEASE_FIELDS = 'tasks(%s)' % TASK_FIELDS
 
 def get_env_variable(var):
     """
@@ -19,3 +28,22 @@ def build_cloudtasks_task_name(project_name, project_location, queue_name, task_
 def build_cloudtasks_queue_name(project_name, project_location, queue_name):
     s = 'projects/%s/locations/%s/queues/%s' % (project_name, project_location, queue_name)
     return s
+
+
+def parse_timestamp(value):
+    """Converts an RFC 3339 UTC timestamp to seconds since the epoch.
+
+    Returns:
+        The time in seconds, None if value is not a timestamp.
+    """
+    try:
+        secs = calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+    fraction = value[19:].rstrip('Z')
+    if fraction.startswith('.'):
+        try:
+            secs += float(fraction)
+        except ValueError:
+            pass
+    return secs
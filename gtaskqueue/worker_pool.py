@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Small pool of daemon threads to run blocking calls off the main loop."""
+
+
+
+import Queue
+import threading
+from gtaskqueue.taskqueue_logger import logger
+
+
+class WorkItem(object):
+    """A call submitted to a WorkerPool and, once run, its outcome."""
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.fn(*self.args, **self.kwargs)
+        except Exception, e:
+            logger.exception('Error running %s' % getattr(self.fn, '__name__',
+                                                          self.fn))
+            self.error = e
+        self.done.set()
+
+
+class WorkerPool(object):
+    """Runs submitted calls on a fixed number of daemon threads."""
+
+    def __init__(self, num_threads, on_done=None, name='worker'):
+        """Constructor.
+
+        Args:
+            num_threads: number of worker threads.
+            on_done: optional callable invoked with each WorkItem, on the
+                worker thread, once it has run.
+            name: prefix for the thread names.
+        """
+        self._queue = Queue.Queue()
+        self._on_done = on_done
+        self._threads = []
+        for i in range(max(1, num_threads)):
+            thread = threading.Thread(target=self._work,
+                                      name='%s-%d' % (name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        """Queues fn(*args, **kwargs) to be run by a worker.
+
+        Returns:
+            WorkItem for the call.
+        """
+        item = WorkItem(fn, args, kwargs)
+        self._queue.put(item)
+        return item
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            item.run()
+            if self._on_done:
+                try:
+                    self._on_done(item)
+                except Exception:
+                    logger.exception('Error in work completion callback')
+
+    def shutdown(self, timeout=None):
+        """Stops the workers once the queued calls have been run."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)